@@ -0,0 +1,86 @@
+"""Per-step overhead of Sequence and Repetition dispatch.
+
+Compares direct dispatch with the old way of running every step in
+a freshly created `State` thread. Leaves are in-process no-ops, so
+what's measured is purely engine overhead.
+
+    python benchmarks/bench_dispatch.py [steps]
+"""
+import sys
+import time
+
+import petriish
+
+
+class Noop(petriish.WorkflowPattern):
+    def execute(self, input):
+        return petriish.Result(True, input)
+
+
+class Countdown(petriish.WorkflowPattern):
+    """Succeeds while input is positive, decrementing it"""
+
+    def __init__(self, exit):
+        self.exit = exit
+
+    def execute(self, input):
+        if (input <= 0) == self.exit:
+            return petriish.Result(True, input - 1)
+        return petriish.Result(False)
+
+
+class ThreadPerStepSequence(petriish.Sequence):
+    def execute(self, input):
+        for child_pattern in self.children:
+            state = child_pattern.instantiate(input)
+            state.start()
+            state.join()
+            if not state.result.success:
+                return state.result
+            input = state.result.output
+        return petriish.Result(success=True, output=input)
+
+
+class ThreadPerStepRepetition(petriish.Repetition):
+    def execute(self, input):
+        while True:
+            states = {
+                k: pattern.instantiate(input)
+                for k, (pattern, input) in self._branches(input).items()
+            }
+            for state in states.values():
+                state.start()
+            for state in states.values():
+                state.join()
+            results = {k: state.result for k, state in states.items()}
+            result = self._step(results)
+            if result is not None:
+                return result
+            input = results['child'].output
+
+
+def measure(pattern, input, steps):
+    start = time.perf_counter()
+    result = petriish.run_workflow_pattern(pattern, input)
+    elapsed = time.perf_counter() - start
+    assert result.success
+    return elapsed / steps * 1e6
+
+
+def main(steps):
+    children = [Noop()] * steps
+    loop = (Countdown(exit=False), Countdown(exit=True))
+    cases = [
+        ('sequence', 'thread per step', ThreadPerStepSequence(children), None),
+        ('sequence', 'direct', petriish.Sequence(children), None),
+        ('repetition', 'thread per step', ThreadPerStepRepetition(*loop), steps),
+        ('repetition', 'direct', petriish.Repetition(*loop), steps),
+    ]
+    for name, dispatch, pattern, input in cases:
+        print('{:<12} {:<16} {:8.2f} us/step'.format(
+            name, dispatch, measure(pattern, input, steps),
+        ))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -0,0 +1,47 @@
+"""Big bytes input given to many commands reading it on stdin at once.
+
+Parallelization of `consumers` commands (`wc -c`) gets a blob of `size`
+MiB. Reports wall time and CPU time of petriish itself (commands
+excluded), with the blob fed through a pipe to every command and with
+it put to a memory file once (`FAN_OUT_THRESHOLD`).
+
+    python benchmarks/bench_fan_out.py [consumers] [size]
+"""
+import resource
+import sys
+import time
+
+import petriish
+from petriish.patterns.posix import SimpleCommand
+
+
+def measure(pattern, input, engine):
+    before = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.perf_counter()
+    result = petriish.run_workflow_pattern(pattern, input, engine=engine)
+    elapsed = time.perf_counter() - start
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    assert result.success
+    cpu = (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+    return elapsed, cpu
+
+
+def main(consumers=50, size=64):
+    blob = b'x' * (size * 2 ** 20)
+    pattern = petriish.Parallelization({
+        i: SimpleCommand(['wc', '-c'], pass_stdin=True, capture_stdout=True)
+        for i in range(consumers)
+    })
+    threshold = petriish.FAN_OUT_THRESHOLD
+    for engine in ('threading', 'asyncio'):
+        for label, fan_out_threshold in (('pipes', float('inf')), ('memory file', threshold)):
+            petriish.FAN_OUT_THRESHOLD = fan_out_threshold
+            elapsed, cpu = measure(pattern, blob, engine)
+            print('{:<10} {:<12} {} x {} MiB: {:.3f} s, petriish CPU {:.3f} s'.format(
+                engine, label, consumers, size, elapsed, cpu,
+            ))
+    petriish.FAN_OUT_THRESHOLD = threshold
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,69 @@
+"""Startup time of a big generated workflow.
+
+Compares the pure-Python YAML loader with `petriish.loading.load` (libyaml
+if available), a plan cache hit, and lazy loading - there the time until
+the first child of the top-level sequence is ready is what matters.
+
+    python benchmarks/bench_loading.py [branches]
+"""
+import logging
+import sys
+import tempfile
+import time
+
+import yaml
+
+import petriish
+from petriish import loading, serialization
+
+
+def description(branches):
+    def branch(i):
+        return {'type': 'parallelization', 'children': {
+            'fetch': {'type': 'command', 'command': ['fetch', str(i)], 'capture_stdout': True},
+            'check': {'type': 'alternative', 'children': [
+                {'type': 'command', 'command': ['check', str(i)]},
+                {'type': 'command', 'command': ['repair', str(i)]},
+            ]},
+        }}
+
+    return yaml.safe_dump(
+        {'type': 'sequence', 'children': [branch(i) for i in range(branches)]},
+        default_flow_style=False, sort_keys=False,
+    ).encode()
+
+
+def timed(f):
+    start = time.perf_counter()
+    f()
+    return time.perf_counter() - start
+
+
+def main(branches):
+    data = description(branches)
+    print('{:.1f} MB, {} nodes'.format(len(data) / 2 ** 20, branches * 5 + 1))
+
+    def pure_python():
+        workflow = serialization.deserialize(yaml.load(data, Loader=yaml.SafeLoader))
+        try:
+            petriish.check_types(workflow)
+        except petriish.types.TypeResolutionError:
+            pass
+
+    with tempfile.TemporaryDirectory() as directory:
+        cache = loading.PlanCache(directory)
+        logging.disable(logging.WARNING)  # the tree doesn't type check
+        loading.load(data, cache=cache)
+        cases = [
+            ('pure python loader', pure_python),
+            ('loading.load', lambda: loading.load(data)),
+            ('plan cache hit', lambda: loading.load(data, cache=cache)),
+            ('lazy, first child', lambda: loading.load(data, lazy=True).children[0]),
+        ]
+        print('loader: {}'.format(loading.Loader.__name__))
+        for name, f in cases:
+            print('{:<20} {:8.3f} s'.format(name, timed(f)))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
@@ -0,0 +1,64 @@
+"""Engine overhead on big trees: recursive asyncio engine vs compiled plan.
+
+Leaves are in-process coroutines doing nothing, so what's measured is
+the engine itself - time per node and peak memory traced by tracemalloc.
+
+    python benchmarks/bench_plan.py [nodes]
+"""
+import sys
+import time
+import tracemalloc
+
+import petriish
+
+
+class Noop(petriish.WorkflowPattern):
+    async def execute_async(self, input):
+        return petriish.Result(True, input)
+
+
+class Countdown(petriish.WorkflowPattern):
+    def __init__(self, exit):
+        self.exit = exit
+
+    async def execute_async(self, input):
+        if (input <= 0) == self.exit:
+            return petriish.Result(True, input - 1)
+        return petriish.Result(False)
+
+
+def trees(nodes):
+    leaf = Noop()
+    width = int(nodes ** 0.5)
+    return [
+        ('wide', petriish.Parallelization({i: leaf for i in range(nodes)}), None, nodes),
+        ('grid', petriish.Parallelization({
+            i: petriish.Sequence([leaf] * width) for i in range(width)
+        }), None, width * width),
+        ('repetition', petriish.Repetition(Countdown(False), Countdown(True)), nodes // 2, nodes),
+    ]
+
+
+def measure(pattern, input, engine):
+    """Time a run, then trace memory of another one - tracing slows it down"""
+    start = time.perf_counter()
+    assert petriish.run_workflow_pattern(pattern, input, engine=engine).success
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    petriish.run_workflow_pattern(pattern, input, engine=engine)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main(nodes):
+    for name, pattern, input, count in trees(nodes):
+        for engine in ('asyncio', 'plan'):
+            elapsed, peak = measure(pattern, input, engine)
+            print('{:<12} {:<8} {:8.2f} us/node {:8.0f} B/node'.format(
+                name, engine, elapsed / count * 1e6, peak / count,
+            ))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
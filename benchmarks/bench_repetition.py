@@ -0,0 +1,54 @@
+"""Wall time of Repetition loops, lockstep versus speculative.
+
+Child and exit are in-process sleeps, so the difference comes from
+overlapping iterations only. Speculation pays off when `exit` is the
+slower of the two; with slow `child` both modes are bound by it.
+
+    python benchmarks/bench_repetition.py [iterations]
+"""
+import sys
+import time
+
+import petriish
+
+
+class Countdown(petriish.WorkflowPattern):
+    """Succeeds while input is positive, decrementing it, after a delay"""
+
+    def __init__(self, exit, delay):
+        self.exit = exit
+        self.delay = delay
+
+    def execute(self, input):
+        time.sleep(self.delay)
+        if (input <= 0) == self.exit:
+            return petriish.Result(True, input - 1)
+        return petriish.Result(False)
+
+
+def measure(pattern, iterations, engine):
+    start = time.perf_counter()
+    result = petriish.run_workflow_pattern(pattern, iterations - 1, engine=engine)
+    elapsed = time.perf_counter() - start
+    assert result.success
+    return elapsed
+
+
+def main(iterations):
+    fast, slow = 0.0005, 0.002
+    for name, child_delay, exit_delay in [('slow exit', fast, slow), ('slow child', slow, fast)]:
+        for engine in sorted(petriish.engines):
+            for speculative in (False, True):
+                pattern = petriish.Repetition(
+                    child=Countdown(exit=False, delay=child_delay),
+                    exit=Countdown(exit=True, delay=exit_delay),
+                    speculative=speculative,
+                )
+                print('{:<11} {:<10} {:<12} {:8.3f} s'.format(
+                    name, engine, 'speculative' if speculative else 'lockstep',
+                    measure(pattern, iterations, engine),
+                ))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
@@ -0,0 +1,53 @@
+"""Deserializing a workflow repeating the same subtrees over and over.
+
+Branches of the generated description differ only in a few of their
+commands, the rest repeats - like in workflows generated from a
+template. Reports memory of the deserialized tree and time to type
+check it, with identical subtrees shared by `deserialize` and without
+(every branch made distinct by a unique command).
+
+    python benchmarks/bench_sharing.py [branches]
+"""
+import sys
+import time
+import tracemalloc
+
+import petriish
+from petriish.serialization import deserialize
+
+
+def command(argv, **kwargs):
+    return dict({'type': 'command', 'command': argv}, **kwargs)
+
+
+def description(branches, distinct):
+    def branch(i):
+        return {'type': 'sequence', 'children': [
+            command(['fetch', str(i) if distinct else 'all'], capture_stdout=True, cacheable=True),
+            command(['normalize'], pass_stdin=True, capture_stdout=True, cacheable=True),
+            {'type': 'alternative', 'children': [
+                command(['validate', '--strict'], pass_stdin=True),
+                command(['validate', '--lenient'], pass_stdin=True),
+            ]},
+            command(['publish']),
+        ]}
+
+    return {'type': 'parallelization', 'children': {str(i): branch(i) for i in range(branches)}}
+
+
+def measure(obj):
+    tracemalloc.start()
+    pattern = deserialize(obj)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    start = time.perf_counter()
+    petriish.check_types(pattern)
+    return size, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    branches = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    print('{} branches, 7 nodes each'.format(branches))
+    for name, distinct in [('distinct', True), ('shared', False)]:
+        size, check_time = measure(description(branches, distinct))
+        print('{:10} {:8.1f} B/branch  type check {:.3f} s'.format(name, size / branches, check_time))
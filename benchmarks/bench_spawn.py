@@ -0,0 +1,42 @@
+"""Spawn rate of launchers, running thousands of `true` leaves in a Parallelization.
+
+`--ballast` makes the petriish process big first, the way it gets
+when holding large captured outputs - that's what makes fork slow.
+
+    python benchmarks/bench_spawn.py [--leaves N] [--jobs N] [--ballast MB]
+"""
+import argparse
+import time
+
+import petriish
+from petriish import launchers
+from petriish.patterns.posix import SimpleCommand
+
+
+def measure(launcher_class, leaves, jobs):
+    pattern = petriish.Parallelization({i: SimpleCommand('true') for i in range(leaves)})
+    with launcher_class() as launcher, launchers.launching(launcher):
+        start = time.perf_counter()
+        result = petriish.run_workflow_pattern(pattern, {}, jobs=jobs)
+        elapsed = time.perf_counter() - start
+    assert result.success
+    return leaves / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--leaves', type=int, default=2000)
+    parser.add_argument('--jobs', type=int, default=32)
+    parser.add_argument('--ballast', type=int, default=0, help="megabytes of memory to touch first")
+    arguments = parser.parse_args()
+    ballast = bytearray(arguments.ballast * 2 ** 20)
+    for i in range(0, len(ballast), 4096):
+        ballast[i] = 1
+    for name, launcher_class in sorted(launchers.launchers.items()):
+        print('{:<12} {:8.0f} spawns/s'.format(
+            name, measure(launcher_class, arguments.leaves, arguments.jobs),
+        ))
+
+
+if __name__ == '__main__':
+    main()
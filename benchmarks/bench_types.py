@@ -0,0 +1,70 @@
+"""Type checking time of a big generated tree.
+
+Tree has about `nodes` nodes, all distinct objects, as if loaded from
+a file: parallelizations of sequences of commands and repetitions,
+passing both bytes and records around.
+
+    python benchmarks/bench_types.py [nodes]
+"""
+import sys
+import time
+
+import petriish
+from petriish.patterns.posix import SimpleCommand
+
+
+def branch(i):
+    return petriish.Sequence([
+        SimpleCommand(['producer', str(i)], capture_stdout=True),
+        SimpleCommand(['filter', str(i)], pass_stdin=True, capture_stdout=True),
+        petriish.Alternative([
+            SimpleCommand(['consumer', str(i)], pass_stdin=True),
+            petriish.Repetition(
+                SimpleCommand(['retry', str(i)], pass_stdin=True, capture_stdout=True),
+                SimpleCommand(['check', str(i)], pass_stdin=True),
+            ),
+        ]),
+        SimpleCommand(['done', str(i)]),
+    ])
+
+
+def tree(nodes, shared=False):
+    """Return the tree and the number of its nodes.
+
+    With `shared` all the branches are the same object, like in trees
+    generated programmatically (or hash-consed on load).
+    """
+    # a branch has 9 nodes, group them by 100 in a parallelization each
+    shared_branch = branch(0)
+    branches = [shared_branch if shared else branch(i) for i in range(nodes // 9)]
+    groups = [
+        petriish.Parallelization({j: b for j, b in enumerate(branches[i:i + 100])})
+        for i in range(0, len(branches), 100)
+    ]
+    return petriish.Parallelization(dict(enumerate(groups))), len(branches) * 9 + len(groups) + 1
+
+
+def chain(nodes):
+    """Repetitions nested in each other, checked with polymorphic input"""
+    pattern = SimpleCommand(['leaf'], pass_stdin=True, capture_stdout=True)
+    for i in range(nodes // 2):
+        pattern = petriish.Repetition(pattern, SimpleCommand(['exit', str(i)], pass_stdin=True, capture_stdout=True))
+    return pattern, nodes // 2 * 2 + 1
+
+
+def main(nodes):
+    cases = [
+        ('distinct', tree(nodes), None),
+        ('shared', tree(nodes, shared=True), None),
+        ('repetitions', chain(min(nodes, 1500)), petriish.types.PolymorphicType()),
+    ]
+    for name, (pattern, count), input_type in cases:
+        start = time.perf_counter()
+        petriish.check_types(pattern, input_type)
+        elapsed = time.perf_counter() - start
+        print('{:<12} {:6} nodes in {:.3f} s, {:.2f} us/node'.format(name, count, elapsed, elapsed / count * 1e6))
+
+
+if __name__ == '__main__':
+    sys.setrecursionlimit(10000)
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50000)
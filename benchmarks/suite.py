@@ -0,0 +1,228 @@
+"""Benchmark suite: engine overhead, spawn throughput, memory and threads.
+
+Synthetic trees - long and deeply nested sequences, wide
+parallelizations, long repetitions, alternatives with many branches and
+a map over many lines - run with in-process leaves doing nothing, so
+what's measured is the engine. `spawn` runs real `true` commands side by side instead.
+
+Every case runs in a fresh interpreter, once for time and once more
+counting threads, and reports its peak RSS. Results are
+JSON. Given a `--compare` baseline (an earlier `--output`), cases slower
+per node by more than `--tolerance` are listed and the exit status is 1.
+
+    python benchmarks/suite.py [--size N] [--case CASE] [--engine ENGINE]
+        [--repeat N] [--output results.json] [--compare baseline.json] [--tolerance 0.25]
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import petriish  # noqa: E402
+from petriish.patterns.posix import SimpleCommand  # noqa: E402
+
+
+class Noop(petriish.WorkflowPattern):
+    def execute(self, input):
+        return petriish.Result(True, input)
+
+    async def execute_async(self, input):
+        return petriish.Result(True, input)
+
+
+class Fail(petriish.WorkflowPattern):
+    def execute(self, input):
+        return petriish.Result(False)
+
+    async def execute_async(self, input):
+        return petriish.Result(False)
+
+
+class Countdown(petriish.WorkflowPattern):
+    """Succeeds while input is positive, decrementing it"""
+
+    def __init__(self, exit):
+        self.exit = exit
+
+    def execute(self, input):
+        if (input <= 0) == self.exit:
+            return petriish.Result(True, input - 1)
+        return petriish.Result(False)
+
+    async def execute_async(self, input):
+        return self.execute(input)
+
+
+# Nesting is limited by the recursion of the recursive engines.
+MAX_DEPTH = 100
+
+
+def _deep(size):
+    depth = min(size, MAX_DEPTH)
+    pattern = Noop()
+    for _ in range(depth):
+        pattern = petriish.Sequence([Noop(), pattern])
+    return pattern, None, 2 * depth + 1
+
+
+def _repetition(size):
+    # both child and exit run every iteration
+    return petriish.Repetition(Countdown(False), Countdown(True)), size // 2, size // 2 * 2
+
+
+def _alternative(size):
+    return petriish.Alternative([Noop()] + [Fail()] * (size - 1)), None, size + 1
+
+
+def _spawn(size):
+    count = max(size // 50, 1)
+    return petriish.Parallelization({i: SimpleCommand(['true']) for i in range(count)}), {}, count
+
+
+# name -> size -> (pattern, input, number of nodes)
+cases = {
+    'sequence': lambda size: (petriish.Sequence([Noop()] * size), None, size + 1),
+    'deep': _deep,
+    'wide': lambda size: (petriish.Parallelization({i: Noop() for i in range(size)}), None, size + 1),
+    'repetition': _repetition,
+    'alternative': _alternative,
+    'spawn': _spawn,
+    'map': lambda size: (petriish.Map(Noop()), b'x\n' * size, size + 1),
+}
+
+
+class ThreadCounter:
+    """Counts threads started inside the block and the peak of those alive.
+
+    Number of live threads only grows when one starts, so checking it
+    right after every start catches the peak.
+    """
+
+    def __enter__(self):
+        self.started = 0
+        self.peak = threading.active_count()
+        self._start = threading.Thread.start
+        counter = self
+
+        def start(thread):
+            counter._start(thread)
+            counter.started += 1
+            counter.peak = max(counter.peak, threading.active_count())
+
+        threading.Thread.start = start
+        return self
+
+    def __exit__(self, *exc_info):
+        threading.Thread.start = self._start
+
+
+def run_case(case, engine, size, repeat=3):
+    """Run a case in this process, return its measurements.
+
+    Time is the best of `repeat` runs, the others are noise.
+    """
+    pattern, input, nodes = cases[case](size)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    elapsed = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = petriish.run_workflow_pattern(pattern, input, engine=engine)
+        elapsed = min(elapsed or float('inf'), time.perf_counter() - start)
+    with ThreadCounter() as threads:
+        petriish.run_workflow_pattern(pattern, input, engine=engine)
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {
+        'case': case,
+        'engine': engine,
+        'size': size,
+        'nodes': nodes,
+        'success': result.success,
+        'seconds': elapsed,
+        'us_per_node': elapsed / nodes * 1e6,
+        'nodes_per_second': nodes / elapsed if elapsed else None,
+        # kilobytes on Linux
+        'peak_rss_kb': rss_after,
+        'rss_growth_kb': rss_after - rss_before,
+        'peak_threads': threads.peak,
+        'threads_started': threads.started,
+    }
+
+
+def run_isolated(case, engine, size, repeat):
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--run', case, engine, str(size), str(repeat)],
+        stdout=subprocess.PIPE, check=True,
+    ).stdout
+    return json.loads(output)
+
+
+def regressions(results, baseline, tolerance):
+    """Results slower per node than their baseline counterparts by more than `tolerance`"""
+    known = {(r['case'], r['engine'], r['size']): r for r in baseline['results']}
+    found = []
+    for result in results:
+        before = known.get((result['case'], result['engine'], result['size']))
+        if before is not None and result['us_per_node'] > before['us_per_node'] * (1 + tolerance):
+            found.append((result, before))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run petriish benchmark suite.")
+    parser.add_argument('--size', type=int, default=10000, help="nodes in generated trees (spawn runs a fiftieth of that)")
+    parser.add_argument('--case', dest='cases', action='append', choices=sorted(cases), help="run only these cases")
+    parser.add_argument('--engine', dest='engines', action='append', choices=sorted(petriish.engines), help="use only these engines")
+    parser.add_argument('--repeat', type=int, default=3, help="time every case this many times, report the best (default: 3)")
+    parser.add_argument('--output', help="write results to this file instead of standard output")
+    parser.add_argument('--compare', help="results of an earlier run to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="allowed slowdown per node, relative (default: 0.25)")
+    parser.add_argument('--run', nargs=4, metavar=('CASE', 'ENGINE', 'SIZE', 'REPEAT'), help=argparse.SUPPRESS)
+    arguments = parser.parse_args()
+
+    if arguments.run is not None:
+        case, engine, size, repeat = arguments.run
+        json.dump(run_case(case, engine, int(size), int(repeat)), sys.stdout)
+        return 0
+
+    results = []
+    for case in arguments.cases or list(cases):
+        for engine in arguments.engines or sorted(petriish.engines):
+            result = run_isolated(case, engine, arguments.size, arguments.repeat)
+            print('{case:<12} {engine:<10} {us_per_node:10.2f} us/node {peak_rss_kb:8d} kB RSS {peak_threads:6d} threads ({threads_started} started)'.format(
+                **result
+            ), file=sys.stderr)
+            results.append(result)
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'results': results,
+    }
+    if arguments.output is None:
+        json.dump(report, sys.stdout, indent=1)
+        print()
+    else:
+        with open(arguments.output, 'w') as f:
+            json.dump(report, f, indent=1)
+
+    if arguments.compare is not None:
+        with open(arguments.compare) as f:
+            baseline = json.load(f)
+        found = regressions(results, baseline, arguments.tolerance)
+        for result, before in found:
+            print('regression: {} on {}: {:.2f} -> {:.2f} us/node'.format(
+                result['case'], result['engine'], before['us_per_node'], result['us_per_node'],
+            ), file=sys.stderr)
+        return 1 if found else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,8 +1,18 @@
+import asyncio
+import contextlib
+import contextvars
+import functools
+import itertools
 import logging
+import math
 from collections import namedtuple
+import os
+import re
+import sys
 import threading
+import time
 
-from . import types
+from . import cancellation, scheduling, types
 
 
 logger = logging.getLogger(__name__)
@@ -31,10 +41,11 @@ class Result:
 class WorkflowPattern:
     """A type of workflow pattern"""
 
-    def instantiate(self, input):
+    def instantiate(self, input, **kwargs):
         return self.State(
             pattern=self,
             input=input,
+            **kwargs
         )
 
     def execute(self, input):
@@ -44,22 +55,47 @@ class WorkflowPattern:
         """
         raise NotImplementedError()
 
+    async def execute_async(self, input):
+        """Counterpart of `execute` used by the asyncio engine.
+
+        By default `execute` is run in a worker thread, so patterns that
+        don't override this still work under the asyncio engine.
+        """
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(None, context.run, self.execute, input)
+
     def output_type(self, resolver, input_type):
         raise NotImplementedError()
 
+    def estimate(self, analyzer, path):
+        """Return `analysis.Estimate` of executing the pattern.
+
+        Patterns not overriding it are estimated like a single command.
+        """
+        return analyzer.leaf(path, label=type(self).__name__)
+
     class State(threading.Thread):
-        """Specific instance of worfklow pattern"""
+        """Specific instance of worfklow pattern
+
+        It runs in a copy of context it was instantiated in, so settings
+        like concurrency limits are inherited from the parent node.
+        """
 
-        def __init__(self, pattern, input, **kwargs):
+        def __init__(self, pattern, input, on_finish=None, **kwargs):
             self.__pattern = pattern
             self.__input = input
+            self.__on_finish = on_finish
+            self.__context = contextvars.copy_context()
             self.__finished = threading.Event()
             self.__result = None
             super().__init__(**kwargs)
 
         def run(self):
-            self.__result = self.__pattern.execute(self.__input)
+            self.__result = self.__context.run(_execute, self.__pattern, self.__input)
             self.__finished.set()
+            if self.__on_finish is not None:
+                self.__on_finish(self.__result)
 
         @property
         def result(self):
@@ -82,8 +118,16 @@ class WorkflowPattern:
 
 class Sequence(WorkflowPattern, namedtuple('Sequence', ('children'))):
     def execute(self, input):
-        for child_pattern in self.children:
-            result = run_workflow_pattern(child_pattern, input)
+        for i, child_pattern in enumerate(self.children):
+            result = run_workflow_patterns({i: (child_pattern, input)})[i]
+            if not result.success:
+                return result
+            input = result.output
+        return Result(success=True, output=input)
+
+    async def execute_async(self, input):
+        for i, child_pattern in enumerate(self.children):
+            result = await _execute_child_async(i, child_pattern, input)
             if not result.success:
                 return result
             input = result.output
@@ -91,16 +135,43 @@ class Sequence(WorkflowPattern, namedtuple('Sequence', ('children'))):
 
     def output_type(self, resolver, input_type):
         for child in self.children:
-            input_type = child.output_type(resolver, input_type)
+            input_type = resolver.output_type(child, input_type)
         return input_type
 
+    def estimate(self, analyzer, path):
+        return analyzer.sequential([
+            analyzer.estimate(child, path + (i,))
+            for i, child in enumerate(self.children)
+        ])
+
 
-class Parallelization(WorkflowPattern, namedtuple('Parallelization', ('children'))):
+class Parallelization(WorkflowPattern, namedtuple('Parallelization', ('children', 'jobs', 'fail_fast'), defaults=(None, False))):
     def execute(self, input):
-        results = run_workflow_patterns({
+        with scheduling.limit(self.jobs):
+            return self._join(run_workflow_patterns(
+                self._branches(input),
+                until=self._decided if self.fail_fast else None,
+            ))
+
+    async def execute_async(self, input):
+        with scheduling.limit(self.jobs):
+            return self._join(await run_workflow_patterns_async(
+                self._branches(input),
+                until=self._decided if self.fail_fast else None,
+            ))
+
+    @staticmethod
+    def _decided(results):
+        return not all(r.success for r in results.values())
+
+    def _branches(self, input):
+        input = _fan_out(input, self.children.values())
+        return {
             k: (v, input)
             for k, v in self.children.items()
-        })
+        }
+
+    def _join(self, results):
         return Result(
             success=all(r.success for r in results.values()),
             output={k: v.output for k, v in results.items()},
@@ -108,17 +179,47 @@ class Parallelization(WorkflowPattern, namedtuple('Parallelization', ('children'
 
     def output_type(self, resolver, input_type):
         return types.Record(fields={
-            k: child.output_type(resolver, input_type)
+            k: resolver.output_type(child, input_type)
             for k, child in self.children.items()
         })
 
+    def estimate(self, analyzer, path):
+        return analyzer.concurrent([
+            analyzer.estimate(child, path + (k,))
+            for k, child in self.children.items()
+        ], self.jobs)
 
-class Alternative(WorkflowPattern, namedtuple('Alternative', ('children'))):
+
+class Alternative(WorkflowPattern, namedtuple('Alternative', ('children', 'jobs'), defaults=(None,))):
     def execute(self, input):
-        results = run_workflow_patterns({
+        with scheduling.limit(self.jobs):
+            return self._choose(run_workflow_patterns(
+                self._branches(input),
+                until=self._decided,
+            ))
+
+    async def execute_async(self, input):
+        with scheduling.limit(self.jobs):
+            return self._choose(await run_workflow_patterns_async(
+                self._branches(input),
+                until=self._decided,
+            ))
+
+    def _branches(self, input):
+        input = _fan_out(input, self.children)
+        return {
             i: (v, input)
             for i, v in enumerate(self.children)
-        })
+        }
+
+    @staticmethod
+    def _decided(results):
+        # Second success means failure, whatever the rest does. (One
+        # success with all the others failed needs no shortcut - by then
+        # everything has finished anyway.)
+        return sum(1 for r in results.values() if r.success) >= 2
+
+    def _choose(self, results):
         results_ok = [
             result
             for result in results.values()
@@ -131,47 +232,665 @@ class Alternative(WorkflowPattern, namedtuple('Alternative', ('children'))):
 
     def output_type(self, resolver, input_type):
         return resolver.unify_all([
-            child.output_type(resolver, input_type)
+            resolver.output_type(child, input_type)
             for child in self.children
         ])
 
+    def estimate(self, analyzer, path):
+        estimates = [
+            analyzer.estimate(child, path + (i,))
+            for i, child in enumerate(self.children)
+        ]
+        # only one of the children succeeds
+        return analyzer.concurrent(estimates, self.jobs)._replace(
+            output=max((e.output for e in estimates), default=0),
+        )
+
+
+class Repetition(WorkflowPattern, namedtuple('Repetition', ('child', 'exit', 'speculative'), defaults=(False,))):
+    """Loop running `child` and `exit` on the same input until `exit` succeeds.
+
+    With `speculative` true the next iteration starts as soon as `child`
+    succeeds, without waiting for `exit`. If `exit` then succeeds too,
+    the speculative iteration is cancelled. Use it only when `child` has
+    no side effects that matter if it gets killed halfway.
+    """
 
-class Repetition(WorkflowPattern, namedtuple('Repetition', ('child', 'exit'))):
     def execute(self, input):
-        while True:
-            results = run_workflow_patterns({
-                'child': (self.child, input),
-                'exit': (self.exit, input),
-            })
-            child_success = results['child'].success
-            exit_success = results['exit'].success
-            if child_success and exit_success:
-                return Result(success=False)
-            if not child_success and not exit_success:
-                return Result(success=False)
-            if not child_success and exit_success:
-                return results['exit']
+        if self.speculative:
+            return self._execute_speculative(input)
+        for iteration in itertools.count():
+            with _nested_path((iteration,)):
+                results = run_workflow_patterns(self._branches(input))
+            result = self._step(results)
+            if result is not None:
+                return result
             input = results['child'].output
 
+    async def execute_async(self, input):
+        if self.speculative:
+            return await self._execute_speculative_async(input)
+        for iteration in itertools.count():
+            with _nested_path((iteration,)):
+                results = await run_workflow_patterns_async(self._branches(input))
+            result = self._step(results)
+            if result is not None:
+                return result
+            input = results['child'].output
+
+    def _execute_speculative(self, input):
+        current = _Iteration(self, 0, input)
+        for iteration in itertools.count():
+            child = current.result('child')
+            upcoming = None
+            if child.success:
+                upcoming = _Iteration(self, iteration + 1, child.output)
+            results = {'child': child, 'exit': current.result('exit')}
+            current.close()
+            result = self._step(results)
+            if result is not None:
+                if upcoming is not None:
+                    upcoming.cancel()
+                return result
+            current = upcoming
+
+    async def _execute_speculative_async(self, input):
+        def start(iteration, input):
+            with _nested_path((iteration,)):
+                return {
+                    k: asyncio.ensure_future(_execute_child_async(k, pattern, input))
+                    for k, (pattern, input) in self._branches(input).items()
+                }
+
+        current = start(0, input)
+        upcoming = {}
+        try:
+            for iteration in itertools.count():
+                child = await current['child']
+                if child.success:
+                    upcoming = start(iteration + 1, child.output)
+                result = self._step({'child': child, 'exit': await current['exit']})
+                if result is not None:
+                    return result
+                current, upcoming = upcoming, {}
+        finally:
+            pending = [task for task in [*current.values(), *upcoming.values()] if not task.done()]
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.wait(pending)
+
+    def _branches(self, input):
+        return {
+            'child': (self.child, input),
+            'exit': (self.exit, input),
+        }
+
+    def _step(self, results):
+        """Return final result of the repetition or None if it should go on."""
+        child_success = results['child'].success
+        exit_success = results['exit'].success
+        if child_success and exit_success:
+            return Result(success=False)
+        if not child_success and not exit_success:
+            return Result(success=False)
+        if not child_success and exit_success:
+            return results['exit']
+        return None
+
     def output_type(self, resolver, input_type):
         resolver.unify(
-            self.child.output_type(resolver, input_type),
+            resolver.output_type(self.child, input_type),
             input_type,
         )
-        return self.exit.output_type(resolver, input_type)
+        return resolver.output_type(self.exit, input_type)
+
+    def estimate(self, analyzer, path):
+        iterations = []
+        for i in range(math.ceil(analyzer.history.iterations(path) or 1)):
+            child = analyzer.estimate(self.child, path + ((i,), 'child'))
+            exit = analyzer.estimate(self.exit, path + ((i,), 'exit'))
+            iterations.append(analyzer.concurrent([child, exit])._replace(output=child.output))
+        # result of the repetition is what its exit produces
+        iterations[-1] = iterations[-1]._replace(output=exit.output)
+        return analyzer.sequential(iterations)
+
+
+class _Iteration:
+    """Iteration of speculative repetition, running in background threads"""
+
+    def __init__(self, repetition, iteration, input):
+        self.scope = cancellation.CancelScope(parent=cancellation.current())
+        with cancellation.using(self.scope), _nested_path((iteration,)):
+            self.states = {
+                k: _child_context(k).run(pattern.instantiate, input)
+                for k, (pattern, input) in repetition._branches(input).items()
+            }
+        for state in self.states.values():
+            state.start()
+
+    def result(self, key):
+        self.states[key].join()
+        return self.states[key].result
+
+    def close(self):
+        for state in self.states.values():
+            state.join()
+        self.scope.close()
+
+    def cancel(self):
+        self.scope.cancel()
+        self.close()
+
+
+class Map(WorkflowPattern, namedtuple('Map', ('child', 'lines', 'size', 'jobs'), defaults=(None, None, None))):
+    """Runs `child` on every chunk of bytes input, outputs joined in order.
+
+    Chunks are `lines` lines each (one by default) or `size` bytes each,
+    slices of a memoryview over the input - nothing gets copied. At most
+    `jobs` chunks (number of CPUs by default) are processed at once, by
+    as many workers, whatever the number of chunks. Workers are started
+    only while there are chunks left for them. Chunk `i` runs at
+    path `(i,)` below the map. First failed chunk fails the map and the
+    chunks still running get cancelled.
+    """
+
+    def __new__(cls, child, lines=None, size=None, jobs=None):
+        if lines is not None and size is not None:
+            raise ValueError('map splits input by lines or by size, not both')
+        if any(n is not None and n < 1 for n in (lines, size, jobs)):
+            raise ValueError('map lines, size and jobs must be positive')
+        return super().__new__(cls, child, lines, size, jobs)
+
+    def _chunks(self, input):
+        from . import storage
+        view = memoryview(input.view if isinstance(input, storage.SpilledBytes) else input)
+        if self.size is not None:
+            return (view[i:i + self.size] for i in range(0, len(view), self.size))
+        return (view[m.start():m.end()] for m in _lines_pattern(self.lines or 1).finditer(view))
+
+    def _workers(self):
+        return self.jobs or os.cpu_count() or 1
+
+    def execute(self, input):
+        chunks = enumerate(self._chunks(input))
+        ahead = next(chunks, None)  # next chunk to take, pulled to know there is one
+        lock = threading.Lock()
+        outputs = []
+        errors = []
+        workers = []
+
+        def take():
+            nonlocal ahead
+            with lock:
+                if ahead is None:
+                    return None, None
+                i, chunk = ahead
+                ahead = next(chunks, None)
+                outputs.append(None)
+                if ahead is not None and len(workers) < self._workers() - 1 and not scope.cancelled:
+                    # a worker per chunk pulled, until there are enough of them
+                    worker = threading.Thread(target=contextvars.copy_context().run, args=(work,))
+                    worker.start()
+                    workers.append(worker)
+                return i, chunk
+
+        def work():
+            try:
+                while not scope.cancelled:
+                    i, chunk = take()
+                    if i is None:
+                        return
+                    result = _child_context(i).run(_execute, self.child, chunk)
+                    if not result.success:
+                        scope.cancel()
+                    outputs[i] = result.output
+            except BaseException as e:
+                errors.append(e)
+                scope.cancel()
+
+        with cancellation.scope() as scope:
+            try:
+                work()
+            finally:
+                # workers start only from other workers, so all of them
+                # get appended before the last one we join is done
+                for worker in workers:
+                    worker.join()
+        if errors:
+            raise errors[0]
+        if scope.cancelled:
+            return Result(success=False)
+        return Result(success=True, output=self._join(outputs))
+
+    async def execute_async(self, input):
+        chunks = enumerate(self._chunks(input))
+        outputs = []
+
+        async def work():
+            for i, chunk in chunks:
+                outputs.append(None)
+                result = await _execute_child_async(i, self.child, chunk)
+                if not result.success:
+                    return False
+                outputs[i] = result.output
+            return True
+
+        workers = [asyncio.ensure_future(work()) for _ in range(self._workers())]
+        try:
+            for next_finished in asyncio.as_completed(workers):
+                if not await next_finished:
+                    return Result(success=False)
+        finally:
+            pending = [worker for worker in workers if not worker.done()]
+            for worker in pending:
+                worker.cancel()
+            if pending:
+                await asyncio.wait(pending)
+        return Result(success=True, output=self._join(outputs))
+
+    @staticmethod
+    def _join(outputs):
+        from . import storage
+        buffer = storage.OutputBuffer()
+        for output in outputs:
+            if isinstance(output, storage.SpilledBytes):
+                output = output.view
+            elif output is None:
+                continue  # child not capturing anything
+            elif not isinstance(output, (bytes, bytearray, memoryview)):
+                buffer.release()
+                raise TypeError('map child must output bytes, not {!r}'.format(output))
+            buffer.write(output)
+        return buffer.getvalue()
+
+    def output_type(self, resolver, input_type):
+        resolver.unify(input_type, types.Bytes())
+        resolver.unify(resolver.output_type(self.child, types.Bytes()), types.Bytes())
+        return types.Bytes()
+
+
+# Bytes inputs at least that big, read on stdin by several children at
+# once, go to a memory file first
+FAN_OUT_THRESHOLD = 2 ** 20
+
+
+def _fan_out(input, children):
+    """Input to give to all of `children`, running at once.
+
+    Big bytes read by two or more of them are copied to a memory file,
+    once. Commands get read-only descriptors of it as stdin, instead of
+    being fed through a pipe each.
+    """
+    if not isinstance(input, (bytes, bytearray, memoryview)) or len(input) < FAN_OUT_THRESHOLD:
+        return input
+    readers = (child for child in children if _reads_stdin(child))
+    if next(readers, None) is None or next(readers, None) is None:
+        return input
+    from . import storage
+    return storage.SpilledBytes.of(input)
+
+
+def _reads_stdin(pattern):
+    """Whether a command the pattern starts with reads the input from stdin"""
+    from .patterns import posix
+    kind = type(pattern)
+    if kind is Sequence:
+        return bool(pattern.children) and _reads_stdin(pattern.children[0])
+    if kind is Parallelization:
+        return any(_reads_stdin(child) for child in pattern.children.values())
+    if kind is Alternative:
+        return any(_reads_stdin(child) for child in pattern.children)
+    if kind is Repetition:
+        return _reads_stdin(pattern.child) or _reads_stdin(pattern.exit)
+    if kind is posix.SimpleCommand:
+        return pattern.pass_stdin
+    if kind is posix.Pipeline:
+        return pattern.commands[0].pass_stdin
+    return False
+
+
+@functools.lru_cache(maxsize=None)
+def _lines_pattern(lines):
+    """Regex matching up to `lines` lines, the last one may lack newline"""
+    return re.compile(rb'(?:[^\n]*\n){0,%d}(?:[^\n]*\n|[^\n]+\Z)' % (lines - 1))
+
+
+_path = contextvars.ContextVar('petriish_path', default=())
+_interceptors = contextvars.ContextVar('petriish_interceptors', default=())
+
+
+def current_path():
+    """Path from the root to the node being executed, as a tuple of keys.
+
+    Keys are indices for sequence and alternative children, names for
+    parallelization children, and iteration number followed by 'child'
+    or 'exit' for repetition. Iteration number is a one-element tuple (a
+    list, once in JSON), so it can't be mistaken for a name.
+    """
+    return _path.get()
+
+
+def format_path(path):
+    """Path as a string like /0/a/#2/child, with iterations marked by #"""
+    return '/' + '/'.join(
+        '#{}'.format(key[0]) if isinstance(key, (tuple, list)) else str(key)
+        for key in path
+    )
+
+
+@contextlib.contextmanager
+def _nested_path(key):
+    token = _path.set(_path.get() + (key,))
+    try:
+        yield
+    finally:
+        _path.reset(token)
+
+
+def _child_context(key):
+    context = contextvars.copy_context()
+    context.run(_path.set, _path.get() + (key,))
+    return context
+
+
+class Interceptor:
+    """Hook wrapping execution of every node in the tree.
+
+    `proceed(input)` executes the node (through remaining interceptors).
+    Interceptor may also return a result without proceeding at all.
+    """
+
+    def execute(self, pattern, input, proceed):
+        return proceed(input)
+
+    async def execute_async(self, pattern, input, proceed):
+        return await proceed(input)
+
 
+@contextlib.contextmanager
+def intercept(interceptor):
+    """Wrap every node executed inside the block with `interceptor`.
+
+    Interceptors installed earlier are the outer ones.
+    """
+    token = _interceptors.set(_interceptors.get() + (interceptor,))
+    try:
+        yield interceptor
+    finally:
+        _interceptors.reset(token)
+
+
+def _execute(pattern, input, interceptors=None):
+    if interceptors is None:
+        interceptors = _interceptors.get()
+    if not interceptors:
+        return pattern.execute(input)
+    interceptor, *rest = interceptors
+    return interceptor.execute(pattern, input, lambda input: _execute(pattern, input, rest))
 
-def run_workflow_patterns(patterns):
+
+async def _execute_async(pattern, input, interceptors=None):
+    if interceptors is None:
+        interceptors = _interceptors.get()
+    if not interceptors:
+        return await pattern.execute_async(input)
+    interceptor, *rest = interceptors
+    return await interceptor.execute_async(pattern, input, lambda input: _execute_async(pattern, input, rest))
+
+
+async def _execute_child_async(key, pattern, input):
+    with _nested_path(key):
+        return await _execute_async(pattern, input)
+
+
+def run_workflow_patterns(patterns, until=None):
+    """Run patterns concurrently and return dict of their results.
+
+    Last of the patterns is executed directly on the calling thread, only
+    the others get threads of their own. So running a single pattern
+    doesn't create any thread at all.
+
+    `until` is called with dict of results gathered so far each time one
+    of the patterns finishes. Once it returns true the outcome is known
+    and patterns still running get cancelled - they end up failed.
+    """
+    if not patterns:
+        return {}
+    if until is None:
+        return _run_concurrently(patterns)
+
+    with cancellation.scope() as scope:
+        lock = threading.Lock()
+        finished = {}
+        report = _CancellationReport(len(patterns))
+
+        def on_finish(key, result):
+            with lock:
+                finished[key] = result
+                decided = not scope.cancelled and until(finished)
+                if decided:
+                    report.start(len(finished))
+            if decided:
+                scope.cancel()
+
+        results = _run_concurrently(patterns, on_finish)
+    report.finish()
+    return results
+
+
+def _run_concurrently(patterns, on_finish=None):
+    *spawned, (inline_key, (inline_pattern, inline_input)) = patterns.items()
     states = {
-        k: pattern.instantiate(input)
-        for k, (pattern, input) in patterns.items()
+        k: _child_context(k).run(
+            pattern.instantiate,
+            input,
+            on_finish=None if on_finish is None else functools.partial(on_finish, k),
+        )
+        for k, (pattern, input) in spawned
     }
     for state in states.values():
         state.start()
-    for state in states.values():
-        state.join()
-    return {k: state.result for k, state in states.items()}
+    try:
+        inline_result = _child_context(inline_key).run(_execute, inline_pattern, inline_input)
+        if on_finish is not None:
+            on_finish(inline_key, inline_result)
+    finally:
+        for state in states.values():
+            state.join()
+    return {
+        k: inline_result if k == inline_key else states[k].result
+        for k in patterns.keys()
+    }
+
+
+async def run_workflow_patterns_async(patterns, until=None):
+    """Asyncio counterpart of `run_workflow_patterns`"""
+    tasks = [
+        (k, asyncio.ensure_future(_execute_keyed(k, pattern, input)))
+        for k, (pattern, input) in patterns.items()
+    ]
+    results = {}
+    report = _CancellationReport(len(tasks))
+    try:
+        for next_finished in asyncio.as_completed([task for _, task in tasks]):
+            k, result = await next_finished
+            results[k] = result
+            if until is not None and until(results):
+                report.start(len(results))
+                break
+    finally:
+        # Cancel leftovers - either the outcome is known or we are being
+        # cancelled ourselves. Either way wait for them to clean up.
+        pending = [task for _, task in tasks if not task.done()]
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.wait(pending)
+    report.finish()
+    for k, task in tasks:
+        if k not in results:
+            results[k] = Result(success=False) if task.cancelled() else task.result()[1]
+    return {k: results[k] for k in patterns.keys()}
+
+
+class _CancellationReport:
+    """Logs how long it took to cancel patterns after the outcome got known"""
+
+    def __init__(self, total):
+        self.total = total
+        self.finished = None
+        self.started_at = None
+
+    def start(self, finished):
+        self.finished = finished
+        self.started_at = time.monotonic()
+
+    def finish(self):
+        if self.started_at is None or self.finished == self.total:
+            return
+        logger.info(
+            "outcome known after %d of %d patterns, cancelled the rest in %.3f s",
+            self.finished, self.total, time.monotonic() - self.started_at,
+        )
+
+
+async def _execute_keyed(key, pattern, input):
+    return key, await _execute_child_async(key, pattern, input)
+
+
+def _run_threading(workflow_pattern, input):
+    return _execute(workflow_pattern, input)
+
+
+def _run_asyncio(workflow_pattern, input):
+    return _run_event_loop(_execute_async, workflow_pattern, input)
+
+
+def _run_plan(workflow_pattern, input):
+    if _interceptors.get():
+        # Interceptors wrap execution of every node, structural ones
+        # too - only the recursive engine has them as separate calls.
+        logger.debug("interceptors installed, running recursively instead of a compiled plan")
+        return _run_asyncio(workflow_pattern, input)
+    from . import plan
+    return _run_event_loop(plan.compile(workflow_pattern).execute_async, input)
+
+
+class _ChildWatcher(asyncio.AbstractChildWatcher):
+    """Child watcher serving every loop, whichever thread it runs in.
+
+    Before 3.12 subprocesses are reported by a single, process-wide
+    watcher, and the stock ones either work only with the main thread's
+    loop or wait for every subprocess in a separate thread. This one
+    waits on a pidfd in the loop that started the process (in a thread
+    only where there are no pidfds), like the default one in 3.12.
+    """
+
+    def add_child_handler(self, pid, callback, *args):
+        loop = asyncio.get_running_loop()
+        if hasattr(os, 'pidfd_open'):
+            pidfd = os.pidfd_open(pid)
+            loop.add_reader(pidfd, self._reap, loop, pid, callback, args, pidfd)
+        else:
+            threading.Thread(target=self._reap, args=(loop, pid, callback, args), daemon=True).start()
+
+    @staticmethod
+    def _reap(loop, pid, callback, args, pidfd=None):
+        from .forkserver import returncode
+        if pidfd is not None:
+            loop.remove_reader(pidfd)
+            os.close(pidfd)
+        try:
+            _, status = os.waitpid(pid, 0)
+        except ChildProcessError:
+            code = 255  # reaped by someone else
+        else:
+            code = returncode(status)
+        if pidfd is None:
+            try:
+                loop.call_soon_threadsafe(callback, pid, code, *args)
+            except RuntimeError:
+                pass  # loop already closed, nobody waits for it
+        else:
+            callback(pid, code, *args)
+
+    def remove_child_handler(self, pid):
+        return False
+
+    def attach_loop(self, loop):
+        pass
+
+    def is_active(self):
+        return True
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_child_watcher = None
+_child_watcher_lock = threading.Lock()
+
+
+def _run_event_loop(execute, *args):
+    global _child_watcher
+    if sys.version_info < (3, 12):
+        # Installed once - runs in other threads may be using it
+        with _child_watcher_lock:
+            if _child_watcher is None:
+                _child_watcher = _ChildWatcher()
+                asyncio.set_child_watcher(_child_watcher)
+    return asyncio.run(_execute_cancellable(execute, *args))
+
+
+async def _execute_cancellable(execute, *args):
+    """Translate cancellation of the caller's scope into task cancellation"""
+    loop = asyncio.get_running_loop()
+    task = asyncio.current_task()
+
+    def cancel():
+        try:
+            loop.call_soon_threadsafe(task.cancel)
+        except RuntimeError:
+            pass  # loop already closed, nothing to cancel
+
+    with cancellation.on_cancel(cancel):
+        try:
+            return await execute(*args)
+        except asyncio.CancelledError:
+            return Result(success=False)
+
+
+engines = {
+    'threading': _run_threading,
+    'asyncio': _run_asyncio,
+    'plan': _run_plan,
+}
+
+
+def check_types(workflow_pattern, input_type=None):
+    """Type check the tree and return its output type.
+
+    Input is an empty record by default, like the one given by petriish
+    command. Raises `types.TypeResolutionError` if the tree doesn't check.
+    """
+    resolver = types.Resolver()
+    if input_type is None:
+        input_type = types.Record()
+    return resolver.get_best_bind(resolver.output_type(workflow_pattern, input_type))
+
 
+def run_workflow_pattern(workflow_pattern, input, engine='threading', jobs=None):
+    """Run the pattern to completion.
 
-def run_workflow_pattern(workflow_pattern, input):
-    return run_workflow_patterns({None: (workflow_pattern, input)})[None]
+    `jobs` limits number of leaf commands running at once in the whole
+    tree. Structural nodes are not counted.
+    """
+    with scheduling.limit(jobs):
+        return engines[engine](workflow_pattern, input)
@@ -0,0 +1,271 @@
+import collections
+import contextlib
+import contextvars
+import json
+import math
+import os
+import statistics
+
+from . import Alternative, Parallelization, Repetition, Sequence
+from .scheduling import normalize_path
+
+
+# Most recent durations of a command kept by `History.record`
+RECORDED_SAMPLES = 1000
+
+
+def _commands_key(commands):
+    return json.dumps([[os.fsdecode(arg) for arg in command.argv] for command in commands])
+
+
+def _path_key(path):
+    return json.dumps(list(path))
+
+
+class History:
+    """Durations and output sizes observed in earlier runs.
+
+    Commands are looked up by their command lines first, so the history
+    survives restructuring of the tree, and by path in the tree second.
+    Several samples of the same thing are averaged.
+    """
+
+    def __init__(self):
+        self._durations = collections.defaultdict(list)
+        self._outputs = collections.defaultdict(list)
+        self._iterations = collections.defaultdict(list)
+
+    def load_trace(self, path):
+        """Add spans from a trace written by `Tracer.export`"""
+        with open(path) as f:
+            events = json.load(f)['traceEvents']
+        paths = []
+        for event in events:
+            if event['ph'] != 'X':
+                continue
+            args = event['args']
+            keys = [('path', _path_key(args['path']))]
+            if 'commands' in args:
+                keys.append(('commands', json.dumps(args['commands'])))
+            for k in keys:
+                self._durations[k].append(event['dur'] / 1e6)
+                if 'bytes_out' in args:
+                    self._outputs[k].append(args['bytes_out'])
+            paths.append(args['path'])
+        self._add_iterations(paths)
+
+    def load_journal(self, path):
+        """Add node durations recorded in a journal"""
+        paths = []
+        with open(path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if 'duration' in entry:
+                    self._durations[('path', _path_key(entry['path']))].append(entry['duration'])
+                paths.append(entry['path'])
+        self._add_iterations(paths)
+
+    def _add_iterations(self, paths):
+        """Count iterations of every repetition seen in a single run"""
+        iterations = {}
+        for path in paths:
+            for i, key in enumerate(path):
+                if isinstance(key, (tuple, list)):
+                    k = _path_key(path[:i])
+                    iterations[k] = max(iterations.get(k, 0), key[0] + 1)
+        for k, n in iterations.items():
+            self._iterations[k].append(n)
+
+    def _lookup(self, samples, path, commands):
+        for k in ([('commands', _commands_key(commands))] if commands else []) + [('path', _path_key(path))]:
+            if samples.get(k):
+                return statistics.mean(samples[k])
+        return None
+
+    def duration(self, path, commands=()):
+        return self._lookup(self._durations, path, commands)
+
+    def output_size(self, path, commands=()):
+        return self._lookup(self._outputs, path, commands)
+
+    def iterations(self, path):
+        samples = self._iterations.get(_path_key(path))
+        return statistics.mean(samples) if samples else None
+
+    def record(self, commands, duration):
+        """Add duration of the commands run just now"""
+        samples = self._durations[('commands', _commands_key(commands))]
+        samples.append(duration)
+        del samples[:-RECORDED_SAMPLES]
+
+    def percentile(self, commands, percentile, min_samples=5):
+        """Duration not exceeded by `percentile` % of runs of the commands.
+
+        None if fewer than `min_samples` runs are known.
+        """
+        samples = sorted(self._durations.get(('commands', _commands_key(commands)), ()))
+        if not samples or len(samples) < min_samples:
+            return None
+        return samples[max(math.ceil(percentile / 100 * len(samples)) - 1, 0)]
+
+
+_learning = contextvars.ContextVar('petriish_learning', default=None)
+
+
+def current_history():
+    """History hedged commands record their durations to, or None"""
+    return _learning.get()
+
+
+@contextlib.contextmanager
+def learning(history):
+    """Make hedged commands inside the block learn from and record to `history`"""
+    token = _learning.set(history)
+    try:
+        yield history
+    finally:
+        _learning.reset(token)
+
+
+class Estimate(collections.namedtuple('Estimate', (
+    'makespan', 'work', 'critical_path', 'concurrency', 'memory', 'output',
+))):
+    """Expected execution of a (sub)tree, assuming it succeeds.
+
+    `makespan` is the wall time and `work` the total time of commands, in
+    seconds. `critical_path` is a list of `(path, label, duration)` of
+    commands determining the makespan. `concurrency` is the peak number of
+    commands running at once. `memory` is the peak size of captured
+    outputs held at once, including `output` - size of the result.
+    """
+
+    @property
+    def parallelism(self):
+        """Average number of commands running at once"""
+        return self.work / self.makespan if self.makespan else 0.0
+
+
+class Analyzer:
+    """Estimates execution of pattern trees from `History`.
+
+    Commands with no history are assumed to take `default_duration`
+    seconds, their paths are collected in `unknown`.
+    """
+
+    def __init__(self, history=None, default_duration=1.0):
+        self.history = history if history is not None else History()
+        self.default_duration = default_duration
+        self.unknown = []
+
+    def estimate(self, pattern, path=()):
+        return pattern.estimate(self, path)
+
+    def leaf(self, path, commands=(), label=None, captures=True):
+        duration = self.history.duration(path, commands)
+        if duration is None:
+            duration = self.default_duration
+            self.unknown.append(path)
+        output = (self.history.output_size(path, commands) or 0) if captures else 0
+        if label is None:
+            label = ' | '.join(' '.join(os.fsdecode(arg) for arg in command.argv) for command in commands)
+        return Estimate(
+            makespan=duration,
+            work=duration,
+            critical_path=[(path, label, duration)],
+            concurrency=1,
+            memory=output,
+            output=output,
+        )
+
+    def sequential(self, estimates):
+        """Estimates run one after another, each one's output passed to the next"""
+        memory = 0
+        held = 0
+        for estimate in estimates:
+            memory = max(memory, held + estimate.memory)
+            held = estimate.output
+        return Estimate(
+            makespan=sum(e.makespan for e in estimates),
+            work=sum(e.work for e in estimates),
+            critical_path=[step for e in estimates for step in e.critical_path],
+            concurrency=max((e.concurrency for e in estimates), default=0),
+            memory=memory,
+            output=held,
+        )
+
+    def concurrent(self, estimates, jobs=None):
+        """Estimates run at once, at most `jobs` commands at a time"""
+        longest = max(estimates, key=lambda e: e.makespan, default=None)
+        return limited(Estimate(
+            makespan=longest.makespan if longest else 0,
+            work=sum(e.work for e in estimates),
+            critical_path=list(longest.critical_path) if longest else [],
+            concurrency=sum(e.concurrency for e in estimates),
+            memory=sum(e.memory for e in estimates),
+            output=sum(e.output for e in estimates),
+        ), jobs)
+
+
+def limited(estimate, jobs):
+    """Apply limit of `jobs` commands at once to the estimate"""
+    if jobs is None:
+        return estimate
+    return estimate._replace(
+        makespan=max(estimate.makespan, estimate.work / jobs),
+        concurrency=min(estimate.concurrency, jobs),
+    )
+
+
+def analyze(pattern, history=None, default_duration=1.0, jobs=None):
+    """Return `Estimate` of the pattern and paths of commands with no history"""
+    analyzer = Analyzer(history, default_duration)
+    return limited(analyzer.estimate(pattern), jobs), analyzer.unknown
+
+
+class _MemoizingAnalyzer(Analyzer):
+    """Analyzer estimating every path once"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._estimates = {}
+
+    def estimate(self, pattern, path=()):
+        estimate = self._estimates.get(path)
+        if estimate is None:
+            estimate = self._estimates[path] = super().estimate(pattern, path)
+        return estimate
+
+
+def priorities(pattern, history=None, default_duration=1.0):
+    """Critical path priority of every leaf, keyed by `normalize_path` of it.
+
+    It's the expected time from the start of the leaf to the end of the
+    whole tree, on the longest path through it - leaves with more work
+    waiting on them first. Iterations of a repetition get the priority
+    of the first one.
+    """
+    analyzer = _MemoizingAnalyzer(history, default_duration)
+    found = {}
+    stack = [(pattern, (), 0.0)]
+    while stack:
+        pattern, path, tail = stack.pop()
+        if type(pattern) is Sequence:
+            for i in reversed(range(len(pattern.children))):
+                stack.append((pattern.children[i], path + (i,), tail))
+                tail += analyzer.estimate(pattern.children[i], path + (i,)).makespan
+        elif type(pattern) is Parallelization:
+            stack.extend((child, path + (k,), tail) for k, child in pattern.children.items())
+        elif type(pattern) is Alternative:
+            stack.extend((child, path + (i,), tail) for i, child in enumerate(pattern.children))
+        elif type(pattern) is Repetition:
+            iterations = math.ceil(analyzer.history.iterations(path) or 1)
+            makespan = analyzer.estimate(pattern, path).makespan
+            tail += makespan * (iterations - 1) / iterations
+            stack.append((pattern.child, path + ((0,), 'child'), tail))
+            stack.append((pattern.exit, path + ((0,), 'exit'), tail))
+        else:
+            found[normalize_path(path)] = tail + analyzer.estimate(pattern, path).makespan
+    return found
@@ -0,0 +1,301 @@
+import asyncio
+import concurrent.futures
+import contextlib
+import contextvars
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from . import (
+    Alternative, Interceptor, Map, Parallelization, Repetition, Result, Sequence,
+    cancellation, launchers, storage,
+)
+from .patterns import posix  # it imports us, so no names from it here
+
+
+logger = logging.getLogger(__name__)
+
+_current = contextvars.ContextVar('petriish_cache', default=None)
+
+
+def current():
+    """Active result cache or None"""
+    return _current.get()
+
+
+@contextlib.contextmanager
+def caching(cache):
+    """Use `cache` for cacheable commands run inside the block"""
+    token = _current.set(cache)
+    try:
+        yield cache
+    finally:
+        _current.reset(token)
+
+
+def digest(data):
+    """Hex sha256 of bytes-like value or `SpilledBytes`"""
+    if isinstance(data, storage.SpilledBytes):
+        data = data.view
+    return hashlib.sha256(data).hexdigest()
+
+
+def _file_digest(path):
+    try:
+        with open(path, 'rb') as f:
+            h = hashlib.sha256()
+            for chunk in iter(lambda: f.read(2 ** 20), b''):
+                h.update(chunk)
+            return h.hexdigest()
+    except FileNotFoundError:
+        return None
+
+
+def key(command, input):
+    """Cache key of running `command` with `input`.
+
+    It covers the command line, stdin content (if the command reads it)
+    and dependencies declared in `command.cacheable` - values of
+    environment variables and contents of files.
+    """
+    dependencies = command.cacheable if isinstance(command.cacheable, dict) else {}
+    invocation = launchers.current_invocation()
+    environ = os.environ if invocation.env is None else invocation.env
+    description = {
+        'argv': [os.fsdecode(arg) for arg in command.argv],
+        'stdin': digest(input) if command.pass_stdin and input is not None else None,
+        'capture_stdout': bool(command.capture_stdout),
+        'env': {
+            name: environ.get(name)
+            for name in dependencies.get('env', [])
+        },
+        'files': {
+            path: _file_digest(os.path.join(invocation.cwd or '', path))
+            for path in dependencies.get('files', [])
+        },
+    }
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+
+class ResultCache:
+    """On-disk store of successful command results, keyed by `key`.
+
+    Each entry is a small JSON file with exit status plus a file with
+    captured stdout. When total size exceeds `max_size` least recently
+    used entries are evicted.
+    """
+
+    def __init__(self, directory, max_size=2 ** 30):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = {}  # key -> [size, last use]
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            if name.endswith('.json'):
+                k = name[:-len('.json')]
+                try:
+                    self._entries[k] = [self._entry_size(k), os.stat(self._meta_path(k)).st_mtime]
+                except FileNotFoundError:
+                    pass
+
+    def _meta_path(self, k):
+        return os.path.join(self.directory, k + '.json')
+
+    def _output_path(self, k):
+        return os.path.join(self.directory, k + '.out')
+
+    def _entry_size(self, k):
+        size = os.stat(self._meta_path(k)).st_size
+        with contextlib.suppress(FileNotFoundError):
+            size += os.stat(self._output_path(k)).st_size
+        return size
+
+    @property
+    def size(self):
+        with self._lock:
+            return sum(size for size, _ in self._entries.values())
+
+    def get(self, k):
+        """Return cached `Result` or None"""
+        try:
+            with open(self._meta_path(k)) as f:
+                meta = json.load(f)
+            output = None
+            if meta['output']:
+                output = storage.load(self._output_path(k))
+            os.utime(self._meta_path(k))
+        except (FileNotFoundError, ValueError, KeyError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+            if k in self._entries:
+                self._entries[k][1] = time.time()
+        return Result(success=(meta['returncode'] == 0), output=output)
+
+    def put(self, k, result):
+        if not result.success:
+            return
+        output = result.output
+        if output is not None:
+            storage.store(self._output_path(k), output)
+        storage.store(self._meta_path(k), json.dumps({
+            'returncode': 0,
+            'output': output is not None,
+        }).encode())
+        with self._lock:
+            self._entries[k] = [self._entry_size(k), os.stat(self._meta_path(k)).st_mtime]
+        self._evict()
+
+    def _evict(self):
+        with self._lock:
+            total = sum(size for size, _ in self._entries.values())
+            if total <= self.max_size:
+                return
+            evicted = []
+            for k, (size, _) in sorted(self._entries.items(), key=lambda item: item[1][1]):
+                if total <= self.max_size:
+                    break
+                total -= size
+                evicted.append(k)
+                del self._entries[k]
+        for k in evicted:
+            logger.debug("evicting cache entry %s", k)
+            for path in (self._meta_path(k), self._output_path(k)):
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(path)
+
+
+def _pure(pattern):
+    """Whether the pattern gives the same result for the same input.
+
+    That's what cacheable commands declare, unless they depend on files -
+    those may change during a run.
+    """
+    if isinstance(pattern, posix.SimpleCommand):
+        return pattern.cacheable is True or (
+            isinstance(pattern.cacheable, dict) and not pattern.cacheable.get('files')
+        )
+    if isinstance(pattern, posix.Pipeline):
+        return all(_pure(command) for command in pattern.commands)
+    if isinstance(pattern, Parallelization):
+        return all(_pure(child) for child in pattern.children.values())
+    if isinstance(pattern, (Sequence, Alternative)):
+        return all(_pure(child) for child in pattern.children)
+    if isinstance(pattern, Repetition):
+        return _pure(pattern.child) and _pure(pattern.exit)
+    if isinstance(pattern, Map):
+        return _pure(pattern.child)
+    return False
+
+
+def _input_key(value):
+    """Hashable key of the input value, None if it can't be keyed"""
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return ('value', value)
+    if isinstance(value, (bytes, bytearray, memoryview, storage.SpilledBytes)):
+        return ('bytes', digest(value))
+    if isinstance(value, dict):
+        items = []
+        for k, v in value.items():
+            v_key = _input_key(v)
+            if v_key is None:
+                return None
+            items.append((k, v_key))
+        return ('record', frozenset(items))
+    return None
+
+
+class Memoizer(Interceptor):
+    """Runs every pure subtree at most once per input, within one run.
+
+    Identical subtrees are recognized as the same object, which is what
+    `serialization.deserialize` makes of them. A subtree asked for while
+    it runs with the same input elsewhere waits for that run. Only
+    successful results are reused, and they are all kept in memory until
+    the memoizer is dropped.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self._lock = threading.Lock()
+        self._pure = {}  # id -> (pattern, pure?)
+        self._results = {}  # (id, input key) -> future of Result, None if it failed
+
+    def _key(self, pattern, input):
+        known = self._pure.get(id(pattern))
+        if known is None or known[0] is not pattern:
+            known = (pattern, _pure(pattern))
+            with self._lock:
+                self._pure[id(pattern)] = known
+        if not known[1]:
+            return None
+        input_key = _input_key(input)
+        if input_key is None:
+            return None
+        return (id(pattern), input_key)
+
+    def _claim(self, key):
+        """Return `(future, True)` if the caller is to run it, `(future, False)` to wait"""
+        with self._lock:
+            future = self._results.get(key)
+            if future is not None:
+                self.hits += 1
+                return future, False
+            future = self._results[key] = concurrent.futures.Future()
+            return future, True
+
+    def _settle(self, key, future, result):
+        if result is None or not result.success:
+            # waiters run it themselves
+            with self._lock:
+                del self._results[key]
+            result = None
+        future.set_result(result)
+
+    def execute(self, pattern, input, proceed):
+        key = self._key(pattern, input)
+        if key is None:
+            return proceed(input)
+        while True:
+            future, owner = self._claim(key)
+            if owner:
+                result = None
+                try:
+                    result = proceed(input)
+                finally:
+                    self._settle(key, future, result)
+                return result
+            done = threading.Event()
+            future.add_done_callback(lambda _: done.set())
+            with cancellation.on_cancel(done.set):
+                done.wait()
+            if not future.done():
+                return Result(success=False)
+            result = future.result()
+            if result is not None:
+                return result
+
+    async def execute_async(self, pattern, input, proceed):
+        key = self._key(pattern, input)
+        if key is None:
+            return await proceed(input)
+        while True:
+            future, owner = self._claim(key)
+            if owner:
+                result = None
+                try:
+                    result = await proceed(input)
+                finally:
+                    self._settle(key, future, result)
+                return result
+            result = await asyncio.shield(asyncio.wrap_future(future))
+            if result is not None:
+                return result
@@ -0,0 +1,113 @@
+import contextlib
+import contextvars
+import threading
+
+
+class Cancelled(Exception):
+    """Raised from blocking waits interrupted by cancellation"""
+
+
+class CancelScope:
+    """Cancellation flag shared by a subtree of running patterns.
+
+    Scopes nest - cancelling a scope cancels all scopes created inside it.
+    Interested parties register callbacks that are called (once, from the
+    cancelling thread) upon cancellation.
+    """
+
+    def __init__(self, parent=None):
+        self._lock = threading.Lock()
+        self._cancelled = False
+        self._callbacks = {}
+        self._parent = parent
+        self._parent_handle = None
+        if parent is not None:
+            self._parent_handle = parent.add_callback(self.cancel)
+
+    @property
+    def cancelled(self):
+        return self._cancelled
+
+    def cancel(self):
+        with self._lock:
+            if self._cancelled:
+                return
+            self._cancelled = True
+            callbacks, self._callbacks = self._callbacks, {}
+        for callback in callbacks.values():
+            callback()
+
+    def add_callback(self, callback):
+        """Register callback and return handle for `remove_callback`.
+
+        If the scope is already cancelled callback is called right away.
+        """
+        handle = object()
+        with self._lock:
+            if not self._cancelled:
+                self._callbacks[handle] = callback
+                return handle
+        callback()
+        return handle
+
+    def remove_callback(self, handle):
+        with self._lock:
+            self._callbacks.pop(handle, None)
+
+    def close(self):
+        """Detach from parent scope. Closed scope can still be cancelled directly."""
+        if self._parent is not None:
+            self._parent.remove_callback(self._parent_handle)
+
+
+_current = contextvars.ContextVar('petriish_cancel_scope', default=None)
+
+
+def current():
+    """Innermost active cancel scope or None"""
+    return _current.get()
+
+
+def cancelled():
+    scope = current()
+    return scope is not None and scope.cancelled
+
+
+@contextlib.contextmanager
+def scope():
+    """Run the block inside a new cancel scope, nested in the current one"""
+    new_scope = CancelScope(parent=current())
+    token = _current.set(new_scope)
+    try:
+        yield new_scope
+    finally:
+        _current.reset(token)
+        new_scope.close()
+
+
+@contextlib.contextmanager
+def using(cancel_scope):
+    """Make `cancel_scope` the current one inside the block.
+
+    Unlike `scope` it leaves the scope open, for work started in the
+    block that outlives it. Close the scope once that work is done.
+    """
+    token = _current.set(cancel_scope)
+    try:
+        yield cancel_scope
+    finally:
+        _current.reset(token)
+
+
+@contextlib.contextmanager
+def on_cancel(callback):
+    """Call `callback` if the current scope gets cancelled during the block"""
+    active_scope = current()
+    if active_scope is None:
+        yield
+        return
+    handle = active_scope.add_callback(callback)
+    try:
+        yield
+    finally:
+        active_scope.remove_callback(handle)
@@ -0,0 +1,217 @@
+"""Long-running petriish accepting workflows over a Unix socket.
+
+A client connects, passes descriptors of its stdout and stderr (as
+SCM_RIGHTS, along a single byte) and sends a request in the framing of
+`distributed` - a JSON header followed by raw bytes values:
+
+    {'op': 'run', 'workflow': {'description': blob index} or {'pattern': serialized},
+     'input': encoded value, 'cwd': ..., 'env': {...}, 'engine': ..., 'output': bool}
+
+Commands of the run get the client's working directory, environment and
+output descriptors. The daemon replies with status messages - 'accepted',
+'running', and 'finished' with `success` (and `output` if asked for), or
+'error' - before or after 'running', if the run itself crashed. Closing
+the connection cancels the run.
+
+Runs go on at once, each in a copy of the context the daemon was created
+in - so they share its concurrency limit, resource pool and caches.
+"""
+import array
+import collections
+import contextvars
+import logging
+import os
+import socket
+import socketserver
+import threading
+
+from . import Result, cancellation, distributed, engines, launchers, loading, run_workflow_pattern, serialization
+
+
+logger = logging.getLogger(__name__)
+
+# Loaded workflows kept, by digest of their description
+WORKFLOWS_KEPT = 256
+
+MAX_FDS = 2
+
+
+def send_fds(sock, fds):
+    sock.sendmsg([b'\0'], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))])
+
+
+def receive_fds(sock):
+    """Return descriptors sent by `send_fds`"""
+    fds = array.array('i')
+    data, ancillary, _, _ = sock.recvmsg(
+        1, socket.CMSG_SPACE(MAX_FDS * fds.itemsize),
+        # they mustn't leak into commands other than those of the run
+        getattr(socket, 'MSG_CMSG_CLOEXEC', 0),
+    )
+    for level, kind, payload in ancillary:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(payload[:len(payload) - len(payload) % fds.itemsize])
+    if not data:
+        raise ConnectionError('connection closed before request')
+    return list(fds)
+
+
+class Daemon:
+    """Runs workflows submitted to the Unix socket at `address`.
+
+    Descriptions are loaded with `loading.load`, through `plan_cache` if
+    given, and the last `WORKFLOWS_KEPT` of them are kept loaded - so
+    submitting the same workflow again skips parsing altogether.
+    """
+
+    def __init__(self, address, engine='threading', plan_cache=None):
+        self.address = address
+        self.engine = engine
+        self.plan_cache = plan_cache
+        self.context = contextvars.copy_context()
+        self._lock = threading.Lock()
+        self._workflows = collections.OrderedDict()
+        # anyone able to connect runs commands as us
+        self.server = distributed._unix_server(_Server, address, _Handler)
+        self.server.daemon = self
+
+    def serve_forever(self):
+        logger.info("daemon listening on %s", self.address)
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            os.unlink(self.address)
+
+    def shutdown(self):
+        """Stop `serve_forever`, call it from another thread"""
+        self.server.shutdown()
+
+    def load(self, description):
+        key = loading.digest(description)
+        with self._lock:
+            workflow = self._workflows.get(key)
+            if workflow is not None:
+                self._workflows.move_to_end(key)
+                return workflow
+        workflow = loading.load(description, cache=self.plan_cache)
+        with self._lock:
+            self._workflows[key] = workflow
+            while len(self._workflows) > WORKFLOWS_KEPT:
+                self._workflows.popitem(last=False)
+        return workflow
+
+
+class _Server(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        daemon = self.server.daemon
+        # before anything gets read through the buffered rfile
+        fds = receive_fds(self.connection)
+        try:
+            daemon.context.copy().run(self._handle, daemon, fds)
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+    def _status(self, status, **kwargs):
+        blobs = []
+        if 'output' in kwargs:
+            kwargs['output'] = distributed._encode(kwargs['output'], blobs)
+        distributed._send(self.wfile, dict(kwargs, status=status), blobs)
+
+    def _handle(self, daemon, fds):
+        header, blobs = distributed._receive(self.rfile)
+        if header is None:
+            return
+        self._status('accepted')
+        try:
+            if header['op'] != 'run':
+                raise ValueError('unknown operation {!r}'.format(header['op']))
+            workflow = header['workflow']
+            if 'pattern' in workflow:
+                pattern = serialization.deserialize(workflow['pattern'])
+            else:
+                pattern = daemon.load(bytes(blobs[workflow['description']]))
+            input = distributed._decode(header.get('input'), blobs, _fetch)
+            engine = header.get('engine') or daemon.engine
+            if engine not in engines:
+                raise ValueError('unknown engine {!r}'.format(engine))
+        except Exception as e:
+            logger.error("can't run submitted workflow: %s", e)
+            self._status('error', error='{}: {}'.format(type(e).__name__, e))
+            return
+        self._status('running')
+        stdout, stderr = (fds + [None, None])[:2]
+        invocation = launchers.Invocation(header.get('cwd'), header.get('env'), stdout, stderr)
+        with cancellation.scope() as scope, launchers.invoked(invocation):
+            # Client closes the connection to cancel the run
+            threading.Thread(target=self._watch, args=(scope,), daemon=True).start()
+            try:
+                result = run_workflow_pattern(pattern, input, engine=engine)
+            except Exception as e:
+                logger.exception("submitted workflow crashed")
+                self._status('error', error='{}: {}'.format(type(e).__name__, e))
+                return
+        if header.get('output'):
+            self._status('finished', success=result.success, output=result.output)
+        else:
+            self._status('finished', success=result.success)
+
+    def _watch(self, scope):
+        try:
+            if self.connection.recv(1):
+                return
+        except OSError:
+            pass
+        scope.cancel()
+
+
+def submit(address, workflow, input={}, engine=None, stdout=None, stderr=None, on_status=None):
+    """Run workflow on the daemon at `address`, return its `Result`.
+
+    `workflow` is a YAML description (bytes) or a pattern. Commands write
+    output they don't capture to `stdout` and `stderr` descriptors (ours
+    by default) and run in our working directory and environment.
+    `on_status` is called with every status message.
+    """
+    blobs = []
+    if isinstance(workflow, (bytes, bytearray)):
+        blobs.append(workflow)
+        workflow = {'description': 0}
+    else:
+        workflow = {'pattern': serialization.serialize(workflow)}
+    request = {
+        'op': 'run',
+        'workflow': workflow,
+        'input': distributed._encode(input, blobs),
+        'cwd': os.getcwd(),
+        'env': dict(os.environ),
+        'engine': engine,
+        'output': True,
+    }
+    with socket.socket(socket.AF_UNIX) as sock:
+        sock.connect(address)
+        send_fds(sock, [1 if stdout is None else stdout, 2 if stderr is None else stderr])
+        with sock.makefile('rwb') as f:
+            distributed._send(f, request, blobs)
+            while True:
+                reply, blobs = distributed._receive(f)
+                if reply is None:
+                    raise ConnectionError('daemon closed the connection')
+                if on_status is not None:
+                    on_status(reply)
+                if reply['status'] == 'error':
+                    raise RuntimeError(reply['error'])
+                if reply['status'] == 'finished':
+                    return Result(
+                        success=reply['success'],
+                        output=distributed._decode(reply.get('output'), blobs, _fetch),
+                    )
+
+
+def _fetch(address, worker, id, size):
+    return distributed.fetch(address, id)
@@ -0,0 +1,486 @@
+import asyncio
+import collections
+import contextvars
+import hashlib
+import hmac
+import json
+import logging
+import os
+import socket
+import socketserver
+import struct
+import threading
+import uuid
+
+from . import (
+    Alternative, Interceptor, Parallelization, Repetition, Result, Sequence,
+    cancellation, run_workflow_pattern, serialization, storage,
+)
+from .patterns.posix import Pipeline, SimpleCommand
+
+
+logger = logging.getLogger(__name__)
+
+# Bytes outputs at least that big stay on the worker that produced them.
+KEEP_THRESHOLD = 2 ** 16
+
+CHUNK_SIZE = 2 ** 16
+
+# Biggest message a peer may send before it's authenticated
+AUTHENTICATION_MESSAGE_LIMIT = 2 ** 10
+
+# Patterns that only route values between their children, so they run
+# on the coordinator without looking at remote values.
+_CONTAINERS = (Sequence, Parallelization, Alternative, Repetition)
+
+
+class RemoteBytes:
+    """Bytes value kept by a worker, known by its `id` there"""
+
+    def __init__(self, address, worker, id, size):
+        self.address = address
+        self.worker = worker
+        self.id = id
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def __repr__(self):
+        return 'RemoteBytes({}, <{} bytes>)'.format(self.address, self.size)
+
+
+def read_secret(path):
+    """Read secret shared by workers and coordinators from a file only its owner can access"""
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_mode & 0o077:
+            raise ValueError('secret file {} is accessible by others, make it 0600'.format(path))
+        secret = f.read().strip()
+    if not secret:
+        raise ValueError('secret file {} is empty'.format(path))
+    return secret
+
+
+def _answer(secret, challenge):
+    return hmac.new(secret, bytes.fromhex(challenge), hashlib.sha256).hexdigest()
+
+
+def _connect(address, secret=None):
+    """Connect to 'host:port', or to a Unix socket if address contains a slash.
+
+    Worker challenges us first if it has a secret, we answer with HMAC of
+    the challenge.
+    """
+    if '/' in address:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    else:
+        host, port = address.rsplit(':', 1)
+        sock = None
+    try:
+        if sock is None:
+            sock = socket.create_connection((host, int(port)))
+        else:
+            sock.connect(address)
+        with sock.makefile('rwb') as f:
+            header, _ = _receive(f, AUTHENTICATION_MESSAGE_LIMIT)
+            if header is None:
+                raise ConnectionError('worker {} closed the connection'.format(address))
+            if header['challenge'] is not None:
+                if secret is None:
+                    raise ConnectionError('worker {} requires a secret'.format(address))
+                _send(f, {'response': _answer(secret, header['challenge'])})
+    except BaseException:
+        if sock is not None:
+            sock.close()
+        raise
+    return sock
+
+
+def _unix_server(server_class, address, handler):
+    """Server listening on Unix socket at `address` that only we can connect to"""
+    temp_address = '{}.{}'.format(address, os.getpid())
+    server = server_class(temp_address, handler, bind_and_activate=False)
+    try:
+        server.server_bind()
+        # nobody can connect before listen, the mode is right by then
+        os.chmod(temp_address, 0o600)
+        server.server_activate()
+        # appears at `address` ready to accept connections
+        os.rename(temp_address, address)
+    except BaseException:
+        server.server_close()
+        if os.path.exists(temp_address):
+            os.unlink(temp_address)
+        raise
+    return server
+
+
+def _send(f, header, blobs=()):
+    """Write a message - JSON header followed by raw bytes values"""
+    data = json.dumps(dict(header, blobs=[len(blob) for blob in blobs])).encode()
+    f.write(struct.pack('!I', len(data)))
+    f.write(data)
+    for blob in blobs:
+        f.write(blob.view if isinstance(blob, storage.SpilledBytes) else blob)
+    f.flush()
+
+
+def _read_exactly(f, size):
+    data = f.read(size)
+    if len(data) < size:
+        raise ConnectionError('connection closed mid-message')
+    return data
+
+
+def _receive(f, limit=None):
+    """Read a message, return `(header, blobs)` or `(None, [])` at EOF.
+
+    Message over `limit` bytes raises `ConnectionError`.
+    """
+    prefix = f.read(4)
+    if not prefix:
+        return None, []
+    if len(prefix) < 4:
+        raise ConnectionError('connection closed mid-message')
+    size = struct.unpack('!I', prefix)[0]
+    if limit is not None and size > limit:
+        raise ConnectionError('message is over {} bytes'.format(limit))
+    header = json.loads(_read_exactly(f, size))
+    if limit is not None and size + sum(header['blobs']) > limit:
+        raise ConnectionError('message is over {} bytes'.format(limit))
+    blobs = []
+    for size in header['blobs']:
+        buffer = storage.OutputBuffer()
+        while size > 0:
+            chunk = _read_exactly(f, min(size, CHUNK_SIZE))
+            buffer.write(chunk)
+            size -= len(chunk)
+        blobs.append(buffer.getvalue())
+    return header, blobs
+
+
+def _encode(value, blobs):
+    if value is None:
+        return None
+    if isinstance(value, (str, int, float, bool)):
+        return {'json': value}
+    if isinstance(value, RemoteBytes):
+        return {'remote': [value.address, value.worker, value.id, value.size]}
+    if isinstance(value, (bytes, bytearray, memoryview, storage.SpilledBytes)):
+        blobs.append(value)
+        return {'blob': len(blobs) - 1}
+    if isinstance(value, dict):
+        return {'record': [[k, _encode(v, blobs)] for k, v in value.items()]}
+    raise TypeError('can\'t send {!r}'.format(value))
+
+
+def _decode(encoded, blobs, remote):
+    """Decode value, `remote(address, worker, id, size)` resolves references"""
+    if encoded is None:
+        return None
+    if 'json' in encoded:
+        return encoded['json']
+    if 'remote' in encoded:
+        return remote(*encoded['remote'])
+    if 'blob' in encoded:
+        return blobs[encoded['blob']]
+    return {
+        k: _decode(v, blobs, remote)
+        for k, v in encoded['record']
+    }
+
+
+def fetch(address, id, secret=None):
+    """Get value kept by the worker at `address`"""
+    with _connect(address, secret) as sock, sock.makefile('rwb') as f:
+        _send(f, {'op': 'fetch', 'id': id})
+        header, blobs = _receive(f)
+    if header is None or 'error' in header:
+        raise LookupError('worker {} doesn\'t have {}'.format(address, id))
+    return blobs[0]
+
+
+class Worker:
+    """Executes subtrees shipped by coordinators.
+
+    Every connection gets a thread, running in a copy of the context the
+    worker was created in - so limits and other settings apply to all of
+    them together. Big bytes outputs are kept until released.
+
+    Anyone able to connect runs commands as us. Unix socket is created
+    accessible only by us. With `secret` peers have to prove they know it
+    (HMAC of a random challenge) - it's required on TCP. The connection
+    isn't encrypted, use trusted networks or tunnels.
+    """
+
+    def __init__(self, address, secret=None):
+        self.address = address
+        self.secret = secret
+        self.id = uuid.uuid4().hex
+        self.context = contextvars.copy_context()
+        self._lock = threading.Lock()
+        self._values = {}
+        if '/' in address:
+            self.server = _unix_server(_UnixServer, address, _Handler)
+        else:
+            if secret is None:
+                raise ValueError('worker listening on TCP requires a secret')
+            host, port = address.rsplit(':', 1)
+            self.server = _TCPServer((host, int(port)), _Handler)
+        self.server.worker = self
+
+    def serve_forever(self):
+        logger.info("worker %s listening on %s", self.id, self.address)
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            if '/' in self.address:
+                os.unlink(self.address)
+
+    def shutdown(self):
+        """Stop `serve_forever`, call it from another thread"""
+        self.server.shutdown()
+
+    def keep(self, value):
+        id = uuid.uuid4().hex
+        with self._lock:
+            self._values[id] = value
+        return id
+
+    def get(self, id):
+        with self._lock:
+            return self._values[id]
+
+    def release(self, ids):
+        with self._lock:
+            for id in ids:
+                self._values.pop(id, None)
+
+    def resolve(self, address, worker, id, size):
+        if worker == self.id:
+            return self.get(id)
+        return fetch(address, id, self.secret)
+
+
+class _UnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+class _TCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        worker = self.server.worker
+        if self._authenticate(worker.secret):
+            worker.context.copy().run(self._handle, worker)
+
+    def _authenticate(self, secret):
+        challenge = os.urandom(32).hex() if secret is not None else None
+        _send(self.wfile, {'challenge': challenge})
+        if challenge is None:
+            return True
+        try:
+            header, _ = _receive(self.rfile, AUTHENTICATION_MESSAGE_LIMIT)
+            if header is not None and hmac.compare_digest(str(header['response']), _answer(secret, challenge)):
+                return True
+        except (ConnectionError, ValueError, KeyError, TypeError):
+            pass
+        logger.warning("rejected connection from %s: authentication failed", self.client_address or 'Unix socket')
+        _send(self.wfile, {'error': 'authentication failed'})
+        return False
+
+    def _handle(self, worker):
+        header, blobs = _receive(self.rfile)
+        if header is None:
+            return
+        op = header['op']
+        if op == 'run':
+            self._run(worker, header, blobs)
+        elif op == 'fetch':
+            try:
+                value = worker.get(header['id'])
+            except KeyError:
+                _send(self.wfile, {'error': 'unknown value'})
+            else:
+                _send(self.wfile, {}, [value])
+        elif op == 'release':
+            worker.release(header['ids'])
+            _send(self.wfile, {})
+
+    def _run(self, worker, header, blobs):
+        pattern = serialization.deserialize(header['pattern'])
+        input = _decode(header['input'], blobs, worker.resolve)
+        with cancellation.scope() as scope:
+            # Coordinator closes the connection to cancel the run
+            threading.Thread(target=self._watch, args=(scope,), daemon=True).start()
+            result = run_workflow_pattern(pattern, input)
+        blobs = []
+        output = self._keep_big(worker, result.output, header['keep'])
+        _send(self.wfile, {'success': result.success, 'output': _encode(output, blobs)}, blobs)
+
+    def _watch(self, scope):
+        try:
+            if self.connection.recv(1):
+                return
+        except OSError:
+            pass
+        scope.cancel()
+
+    def _keep_big(self, worker, value, keep):
+        if isinstance(value, dict):
+            return {k: self._keep_big(worker, v, keep) for k, v in value.items()}
+        if isinstance(value, (bytes, bytearray, storage.SpilledBytes)) and len(value) >= keep:
+            # address is filled in by the coordinator, it may know us by other name
+            return RemoteBytes(None, worker.id, worker.keep(value), len(value))
+        return value
+
+
+def _sequential(pattern):
+    """Whether there's no concurrency inside the pattern"""
+    if type(pattern) is Sequence:
+        return bool(pattern.children) and all(_sequential(child) for child in pattern.children)
+    return type(pattern) in (SimpleCommand, Pipeline)
+
+
+class Distributor(Interceptor):
+    """Runs subtrees on workers instead of locally.
+
+    Shipped are maximal subtrees with no concurrency inside - commands,
+    pipelines and sequences of them - everything above runs on the
+    coordinator, which only routes values between them. Bytes outputs of
+    at least `keep` bytes stay on their worker, represented by
+    `RemoteBytes`, and subtrees are sent where most of their input
+    already is. Ties go to the worker running the least subtrees.
+
+    Remote values get released on `close`. Use `materialize` on values
+    needed locally. `secret` is the one workers were started with.
+    """
+
+    def __init__(self, workers, keep=KEEP_THRESHOLD, secret=None):
+        if not workers:
+            raise ValueError('no workers')
+        self.workers = list(workers)
+        self.keep = keep
+        self.secret = secret
+        self._lock = threading.Lock()
+        self._running = collections.Counter()
+        self._remote = collections.defaultdict(set)
+        self._serialized = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            remote, self._remote = self._remote, collections.defaultdict(set)
+        for address, ids in remote.items():
+            try:
+                with _connect(address, self.secret) as sock, sock.makefile('rwb') as f:
+                    _send(f, {'op': 'release', 'ids': sorted(ids)})
+                    _receive(f)
+            except OSError as e:
+                logger.warning("can't release values kept by %s: %s", address, e)
+
+    def execute(self, pattern, input, proceed):
+        serialized = self._serialize(pattern)
+        if serialized is None:
+            if not isinstance(pattern, _CONTAINERS):
+                input = self.materialize(input)
+            return proceed(input)
+        return self._ship(serialized, input)
+
+    async def execute_async(self, pattern, input, proceed):
+        loop = asyncio.get_running_loop()
+        serialized = self._serialize(pattern)
+        if serialized is None:
+            if not isinstance(pattern, _CONTAINERS):
+                input = await loop.run_in_executor(None, self.materialize, input)
+            return await proceed(input)
+        scope = cancellation.CancelScope(parent=cancellation.current())
+        with cancellation.using(scope):
+            context = contextvars.copy_context()
+        try:
+            return await loop.run_in_executor(None, context.run, self._ship, serialized, input)
+        except asyncio.CancelledError:
+            scope.cancel()
+            raise
+        finally:
+            scope.close()
+
+    def _serialize(self, pattern):
+        """Serialized pattern, or None if it isn't to be shipped"""
+        known = self._serialized.get(id(pattern))
+        if known is not None and known[0] is pattern:
+            return known[1]
+        serialized = None
+        if _sequential(pattern):
+            try:
+                serialized = serialization.serialize(pattern)
+                json.dumps(serialized)
+            except (TypeError, ValueError):
+                serialized = None
+        with self._lock:
+            self._serialized[id(pattern)] = (pattern, serialized)
+        return serialized
+
+    def _choose(self, input):
+        local_bytes = collections.Counter()
+        for value in _remote_values(input):
+            local_bytes[value.address] += value.size
+        with self._lock:
+            address = min(self.workers, key=lambda address: (-local_bytes[address], self._running[address]))
+            self._running[address] += 1
+        return address
+
+    def _ship(self, serialized, input):
+        address = self._choose(input)
+        try:
+            blobs = []
+            request = {'op': 'run', 'pattern': serialized, 'input': _encode(input, blobs), 'keep': self.keep}
+            with _connect(address, self.secret) as sock, sock.makefile('rwb') as f:
+                with cancellation.on_cancel(lambda: sock.shutdown(socket.SHUT_RDWR)):
+                    _send(f, request, blobs)
+                    reply, blobs = _receive(f)
+            if reply is not None and 'error' in reply:
+                raise ConnectionError(reply['error'])
+        except OSError as e:
+            reply = None
+            if not cancellation.cancelled():
+                logger.error("running %s on %s failed: %s", serialized['type'], address, e)
+        finally:
+            with self._lock:
+                self._running[address] -= 1
+        if reply is None:
+            return Result(success=False)
+        return Result(
+            success=reply['success'],
+            output=_decode(reply['output'], blobs, lambda _, *ref: self._remote_value(address, *ref)),
+        )
+
+    def _remote_value(self, address, worker, id, size):
+        with self._lock:
+            self._remote[address].add(id)
+        return RemoteBytes(address, worker, id, size)
+
+    def materialize(self, value):
+        """Replace `RemoteBytes` in the value with the actual bytes"""
+        if isinstance(value, RemoteBytes):
+            return fetch(value.address, value.id, self.secret)
+        if isinstance(value, dict):
+            return {k: self.materialize(v) for k, v in value.items()}
+        return value
+
+
+def _remote_values(value):
+    if isinstance(value, RemoteBytes):
+        yield value
+    elif isinstance(value, dict):
+        for v in value.values():
+            yield from _remote_values(v)
@@ -0,0 +1,151 @@
+"""Helper process spawning commands on behalf of petriish.
+
+Forking a small process is much cheaper than forking a big, threaded
+one. So petriish starts this script in a fresh interpreter and asks it
+to spawn commands. It must not import petriish, to stay small.
+
+Protocol runs over a SOCK_SEQPACKET socket, one pickled tuple per
+message, descriptors passed along as SCM_RIGHTS:
+
+ * `('spawn', request id, argv, env, cwd, targets)` with descriptors to
+   install as `targets` (like `[0, 1]`) in the child,
+ * `('started', request id, pid, errno)` - errno is set if exec failed,
+ * `('exited', pid, returncode, rusage)`.
+"""
+import array
+import os
+import pickle
+import queue
+import select
+import signal
+import socket
+import subprocess
+import sys
+import threading
+
+MAX_MESSAGE = 2 ** 20
+MAX_FDS = 8
+
+
+def send(sock, message, fds=()):
+    ancillary = []
+    if fds:
+        ancillary.append((socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds)))
+    sock.sendmsg([pickle.dumps(message)], ancillary)
+
+
+def receive(sock):
+    """Return `(message, fds)`, message is None at EOF"""
+    fds = array.array('i')
+    data, ancillary, _, _ = sock.recvmsg(
+        MAX_MESSAGE,
+        socket.CMSG_SPACE(MAX_FDS * fds.itemsize),
+        # received descriptors mustn't leak into spawned commands
+        getattr(socket, 'MSG_CMSG_CLOEXEC', 0),
+    )
+    for level, kind, payload in ancillary:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(payload[:len(payload) - len(payload) % fds.itemsize])
+    if not data:
+        return None, list(fds)
+    return pickle.loads(data), list(fds)
+
+
+def returncode(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def spawn(argv, env, cwd, fds, targets):
+    """Start a command in its own session, return its pid.
+
+    It's reaped by `reap`, not by Popen.
+    """
+    stdio = dict(zip(targets, fds))
+    process = subprocess.Popen(
+        argv, env=env, cwd=cwd,
+        stdin=stdio.get(0), stdout=stdio.get(1), stderr=stdio.get(2),
+        start_new_session=True,
+    )
+    # Popen won't try to wait for it
+    process.returncode = 0
+    return process.pid
+
+
+class Server:
+    """Spawns commands in a few worker threads, as exec takes a while.
+
+    A command may exit (and get reaped) before its worker reports it
+    started - such exits are held back until then.
+    """
+
+    def __init__(self, sock, workers=4):
+        self.sock = sock
+        self.lock = threading.Lock()
+        self.started = set()
+        self.exits = {}
+        self.requests = queue.Queue()
+        for _ in range(workers):
+            threading.Thread(target=self.work, daemon=True).start()
+
+    def send(self, message, fds=()):
+        with self.lock:
+            send(self.sock, message, fds)
+
+    def work(self):
+        while True:
+            (_, request_id, argv, env, cwd, targets), fds = self.requests.get()
+            try:
+                pid, error = spawn(argv, env, cwd, fds, targets), None
+            except OSError as e:
+                pid, error = None, e.errno
+            finally:
+                for fd in fds:
+                    os.close(fd)
+            with self.lock:
+                send(self.sock, ('started', request_id, pid, error))
+                if pid is not None:
+                    self.started.add(pid)
+                    exit = self.exits.pop(pid, None)
+                    if exit is not None:
+                        self.started.discard(pid)
+                        send(self.sock, exit)
+
+    def reap(self):
+        while True:
+            try:
+                pid, status, rusage = os.wait4(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            exit = ('exited', pid, returncode(status), rusage)
+            with self.lock:
+                if pid in self.started:
+                    self.started.discard(pid)
+                    send(self.sock, exit)
+                else:
+                    self.exits[pid] = exit
+
+    def serve(self):
+        wakeup_read, wakeup_write = os.pipe()
+        os.set_blocking(wakeup_write, False)
+        signal.set_wakeup_fd(wakeup_write)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        while True:
+            readable, _, _ = select.select([self.sock, wakeup_read], [], [])
+            if wakeup_read in readable:
+                os.read(wakeup_read, 4096)
+                self.reap()
+            if self.sock in readable:
+                message, fds = receive(self.sock)
+                if message is None:
+                    return
+                self.requests.put((message, fds))
+
+
+if __name__ == '__main__':
+    fd = int(sys.argv[1])
+    os.set_inheritable(fd, False)
+    Server(socket.socket(fileno=fd)).serve()
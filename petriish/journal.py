@@ -0,0 +1,251 @@
+import base64
+import collections
+import collections.abc
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from . import Interceptor, Result, WorkflowPattern, cache, current_path, storage
+
+
+logger = logging.getLogger(__name__)
+
+# Bytes values shorter than that are stored inline in journal lines.
+INLINE_LIMIT = 4096
+
+
+class Unsupported(Exception):
+    """Value can't be stored in the journal"""
+
+
+def _is_bytes(value):
+    return isinstance(value, (bytes, bytearray, memoryview, storage.SpilledBytes))
+
+
+def _is_scalar(value):
+    return isinstance(value, (str, int, float, bool))
+
+
+class Journal(Interceptor):
+    """Append-only record of finished nodes, allowing to resume a run.
+
+    Every finished node appends a JSON line with its path in the tree,
+    its type, a fingerprint of its input, its result and duration. Bytes outputs,
+    unless small, go to content-addressed blob files in `<path>.blobs/`.
+    Lines are passed to the OS right away, and fsynced in batches - at
+    most once per `sync_interval` seconds and on close.
+
+    With `resume` true, successful results already in the journal are
+    replayed: a node with the same path, structure and input isn't
+    executed again. Truncated last line (left by a crash) is ignored.
+    """
+
+    def __init__(self, path, resume=False, sync_interval=1.0):
+        self.path = path
+        self.blobs = path + '.blobs'
+        self.sync_interval = sync_interval
+        self.replayed = 0
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._fingerprints = collections.OrderedDict()
+        self._pattern_digests = {}
+        complete = True
+        if resume and os.path.exists(path):
+            complete = self._load()
+        os.makedirs(self.blobs, exist_ok=True)
+        self._file = open(path, 'a' if resume else 'w')
+        if not complete:
+            self._file.write('\n')
+        self._synced_at = time.monotonic()
+
+    def _load(self):
+        """Read successful entries, return False if the last line is incomplete"""
+        line = '\n'
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    logger.warning("skipping damaged journal line %r", line)
+                    continue
+                if entry['success']:
+                    self._entries[json.dumps(entry['path'])] = entry
+        return line.endswith('\n')
+
+    def close(self):
+        with self._lock:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def execute(self, pattern, input, proceed):
+        path = current_path()
+        fingerprint = self.fingerprint(input)
+        result = self._replay(path, pattern, fingerprint)
+        if result is None:
+            start = time.perf_counter()
+            result = proceed(input)
+            self._record(path, pattern, fingerprint, result, time.perf_counter() - start)
+        return result
+
+    async def execute_async(self, pattern, input, proceed):
+        path = current_path()
+        fingerprint = self.fingerprint(input)
+        result = self._replay(path, pattern, fingerprint)
+        if result is None:
+            start = time.perf_counter()
+            result = await proceed(input)
+            self._record(path, pattern, fingerprint, result, time.perf_counter() - start)
+        return result
+
+    def fingerprint(self, value):
+        """Digest identifying the value, None if it's of unsupported type"""
+        if value is None:
+            return 'none'
+        if _is_scalar(value):
+            return 'json:' + json.dumps(value)
+        if _is_bytes(value):
+            # The same big input is usually seen by a whole chain of nodes
+            # - remember recent digests instead of hashing it again.
+            with self._lock:
+                known = self._fingerprints.get(id(value))
+            if known is not None and known[0] is value:
+                return known[1]
+            fingerprint = 'bytes:' + cache.digest(value)
+            with self._lock:
+                self._fingerprints[id(value)] = (value, fingerprint)
+                while len(self._fingerprints) > 64:
+                    self._fingerprints.popitem(last=False)
+            return fingerprint
+        if isinstance(value, dict):
+            if not all(_is_scalar(k) for k in value.keys()):
+                return None
+            fields = sorted(
+                (json.dumps(k), self.fingerprint(v))
+                for k, v in value.items()
+            )
+            if any(f is None for _, f in fields):
+                return None
+            return 'record:' + hashlib.sha256(json.dumps(fields).encode()).hexdigest()
+        return None
+
+    def pattern_digest(self, pattern):
+        """Digest of the pattern structure, the same across runs"""
+        known = self._pattern_digests.get(id(pattern))
+        if known is not None and known[0] is pattern:
+            return known[1]
+        if hasattr(pattern, '_asdict'):
+            fields = pattern._asdict()
+        else:
+            fields = vars(pattern)
+        description = json.dumps(
+            [type(pattern).__name__, self._structure(fields)],
+            sort_keys=True,
+            default=repr,
+        )
+        digest = hashlib.sha256(description.encode()).hexdigest()
+        with self._lock:
+            self._pattern_digests[id(pattern)] = (pattern, digest)
+        return digest
+
+    def _structure(self, value):
+        if isinstance(value, WorkflowPattern):
+            return {'pattern': self.pattern_digest(value)}
+        if isinstance(value, collections.abc.Sequence) and not isinstance(value, (str, bytes)):
+            return [self._structure(v) for v in value]
+        if isinstance(value, dict):
+            return [[k, self._structure(v)] for k, v in value.items()]
+        return value
+
+    def _replay(self, path, pattern, fingerprint):
+        if fingerprint is None:
+            return None
+        entry = self._entries.get(json.dumps(path))
+        if (
+            entry is None or
+            entry['pattern'] != self.pattern_digest(pattern) or
+            entry['input'] != fingerprint
+        ):
+            return None
+        try:
+            output = self._decode(entry['output'])
+        except FileNotFoundError:
+            logger.warning("output of %s missing from journal blobs, executing it again", path)
+            return None
+        logger.info("replaying %s %s from journal", type(pattern).__name__, list(path))
+        with self._lock:
+            self.replayed += 1
+        return Result(success=True, output=output)
+
+    def _record(self, path, pattern, fingerprint, result, duration):
+        if fingerprint is None:
+            return
+        try:
+            output = self._encode(result.output)
+        except Unsupported:
+            logger.debug("output of %s can't be journaled", path)
+            return
+        self._append({
+            'path': list(path),
+            'type': type(pattern).__name__,
+            'pattern': self.pattern_digest(pattern),
+            'input': fingerprint,
+            'success': result.success,
+            'duration': duration,
+            'output': output,
+        })
+
+    def _append(self, entry):
+        line = json.dumps(entry) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            now = time.monotonic()
+            if now - self._synced_at >= self.sync_interval:
+                os.fsync(self._file.fileno())
+                self._synced_at = now
+
+    def _encode(self, value):
+        if value is None:
+            return None
+        if _is_scalar(value):
+            return {'json': value}
+        if _is_bytes(value):
+            if len(value) < INLINE_LIMIT:
+                return {'inline': base64.b64encode(bytes(value)).decode()}
+            digest = cache.digest(value)
+            blob_path = os.path.join(self.blobs, digest)
+            if not os.path.exists(blob_path):
+                storage.store(blob_path, value)
+            return {'blob': digest}
+        if isinstance(value, dict):
+            if not all(_is_scalar(k) for k in value.keys()):
+                raise Unsupported()
+            return {'record': [
+                [k, self._encode(v)]
+                for k, v in value.items()
+            ]}
+        raise Unsupported()
+
+    def _decode(self, encoded):
+        if encoded is None:
+            return None
+        if 'json' in encoded:
+            return encoded['json']
+        if 'inline' in encoded:
+            return base64.b64decode(encoded['inline'])
+        if 'blob' in encoded:
+            return storage.load(os.path.join(self.blobs, encoded['blob']))
+        return {
+            k: self._decode(v)
+            for k, v in encoded['record']
+        }
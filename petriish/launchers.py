@@ -0,0 +1,308 @@
+import contextlib
+import contextvars
+import errno
+import itertools
+import logging
+import os
+import socket
+import subprocess
+import sys
+import threading
+from collections import namedtuple
+
+from . import forkserver
+
+
+logger = logging.getLogger(__name__)
+
+
+class Child:
+    """Spawned command. `stdin` and `stdout` are pipe files or None.
+
+    `returncode` and `rusage` (resource usage, if known) are set once
+    the process is reaped by `wait`.
+    """
+
+    def __init__(self, pid, stdin=None, stdout=None):
+        self.pid = pid
+        self.stdin = stdin
+        self.stdout = stdout
+        self.returncode = None
+        self.rusage = None
+
+    def wait(self):
+        if self.returncode is None:
+            _, status, self.rusage = os.wait4(self.pid, 0)
+            self.returncode = forkserver.returncode(status)
+        return self.returncode
+
+
+class _PopenChild(Child):
+    def __init__(self, popen):
+        super().__init__(popen.pid, popen.stdin, popen.stdout)
+        self._popen = popen
+
+    def wait(self):
+        returncode = super().wait()
+        # Popen must know the process is gone, it would try to reap it otherwise
+        self._popen.returncode = returncode
+        return returncode
+
+
+def _pipes(stdin, stdout, stderr=None):
+    """Resolve Popen-like `stdin` and `stdout` arguments (None, descriptor or PIPE).
+
+    Return descriptors for the child, as `{target: fd}`, parent's ends
+    of created pipes as files and descriptors to close after spawning.
+    `stderr` may only be None or a descriptor.
+    """
+    fds = {} if stderr is None else {2: stderr}
+    files = []
+    to_close = []
+    for target, spec, mode in [(0, stdin, 'wb'), (1, stdout, 'rb')]:
+        if spec is None:
+            files.append(None)
+        elif spec == subprocess.PIPE:
+            read, write = os.pipe()
+            child_end, parent_end = (read, write) if target == 0 else (write, read)
+            fds[target] = child_end
+            to_close.append(child_end)
+            files.append(open(parent_end, mode))
+        else:
+            fds[target] = spec
+            files.append(None)
+    return fds, files, to_close
+
+
+class Launcher:
+    """Way of spawning commands.
+
+    Every command gets its own session (and so process group), `stdin`
+    and `stdout` are like in `subprocess.Popen`. `stderr` (a descriptor),
+    `cwd` and `env` are inherited from petriish if None.
+    """
+
+    def spawn(self, argv, stdin=None, stdout=None, stderr=None, cwd=None, env=None):
+        """Return `Child`"""
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class SubprocessLauncher(Launcher):
+    """`subprocess.Popen` from the calling thread"""
+
+    def spawn(self, argv, stdin=None, stdout=None, stderr=None, cwd=None, env=None):
+        return _PopenChild(subprocess.Popen(
+            argv, stdin=stdin, stdout=stdout, stderr=stderr, cwd=cwd, env=env,
+            start_new_session=True,
+        ))
+
+
+class PosixSpawnLauncher(Launcher):
+    """`os.posix_spawnp` - doesn't copy page tables of the parent, unlike fork.
+
+    Falls back to `SubprocessLauncher` where there's no `os.posix_spawnp`
+    (before Python 3.8).
+    """
+
+    def spawn(self, argv, stdin=None, stdout=None, stderr=None, cwd=None, env=None):
+        if not hasattr(os, 'posix_spawnp') or cwd is not None and cwd != os.getcwd():
+            # posix_spawn can't change the directory
+            return SubprocessLauncher().spawn(argv, stdin, stdout, stderr, cwd, env)
+        fds, (stdin_file, stdout_file), to_close = _pipes(stdin, stdout, stderr)
+        try:
+            pid = os.posix_spawnp(
+                argv[0], argv, os.environ if env is None else env,
+                file_actions=[(os.POSIX_SPAWN_DUP2, fd, target) for target, fd in fds.items()],
+                setsid=True,
+            )
+        except BaseException:
+            for f in (stdin_file, stdout_file):
+                if f is not None:
+                    f.close()
+            raise
+        finally:
+            for fd in to_close:
+                os.close(fd)
+        return Child(pid, stdin_file, stdout_file)
+
+
+class _ServedChild(Child):
+    """Child of the fork server, reaped by it"""
+
+    def __init__(self, pid):
+        super().__init__(pid)
+        self._exited = threading.Event()
+
+    def exited(self, returncode, rusage):
+        self.rusage = rusage
+        self.returncode = returncode
+        self._exited.set()
+
+    def wait(self):
+        self._exited.wait()
+        return self.returncode
+
+
+class ForkServerLauncher(Launcher):
+    """Commands are forked by a small helper process (see `petriish.forkserver`).
+
+    The helper is started right away. Environment and working directory
+    are sent with every command, so they follow changes made later.
+    """
+
+    def __init__(self):
+        self._socket, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        with theirs:
+            self._server = subprocess.Popen(
+                # isolated, so that petriish modules don't shadow standard ones
+                [sys.executable, '-I', '-S', forkserver.__file__, str(theirs.fileno())],
+                pass_fds=[theirs.fileno()],
+                # keep terminal's signals away, petriish handles them
+                start_new_session=True,
+            )
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+        self._requests = {}  # request id -> [event, reply]
+        self._children = {}  # pid -> _ServedChild
+        self._gone = False
+        self._reader = threading.Thread(target=self._read, daemon=True)
+        self._reader.start()
+
+    def spawn(self, argv, stdin=None, stdout=None, stderr=None, cwd=None, env=None):
+        fds, (stdin_file, stdout_file), to_close = _pipes(stdin, stdout, stderr)
+        if env is None:
+            env = os.environb
+        else:
+            env = {os.fsencode(k): os.fsencode(v) for k, v in env.items()}
+        request = [threading.Event(), None]
+        request_id = None
+        try:
+            with self._lock:
+                if self._gone:
+                    raise BrokenPipeError(errno.EPIPE, 'fork server is gone')
+                request_id = next(self._ids)
+                self._requests[request_id] = request
+                forkserver.send(
+                    self._socket,
+                    ('spawn', request_id, [os.fsencode(arg) for arg in argv], dict(env), cwd or os.getcwd(), list(fds)),
+                    list(fds.values()),
+                )
+        except BaseException:
+            self._requests.pop(request_id, None)
+            for f in (stdin_file, stdout_file):
+                if f is not None:
+                    f.close()
+            raise
+        finally:
+            for fd in to_close:
+                os.close(fd)
+        request[0].wait()
+        child, error = request[1]
+        if child is None:
+            for f in (stdin_file, stdout_file):
+                if f is not None:
+                    f.close()
+            raise OSError(error, os.strerror(error), argv[0])
+        child.stdin = stdin_file
+        child.stdout = stdout_file
+        return child
+
+    def _read(self):
+        while True:
+            try:
+                message, _ = forkserver.receive(self._socket)
+            except OSError:
+                message = None
+            if message is None:
+                break
+            if message[0] == 'started':
+                _, request_id, pid, error = message
+                child = None
+                with self._lock:
+                    if error is None:
+                        child = self._children[pid] = _ServedChild(pid)
+                    request = self._requests.pop(request_id)
+                request[1] = (child, error)
+                request[0].set()
+            else:
+                _, pid, returncode, rusage = message
+                with self._lock:
+                    child = self._children.pop(pid, None)
+                if child is not None:
+                    child.exited(returncode, rusage)
+        # Server is gone, fail whatever waits for it
+        with self._lock:
+            self._gone = True
+            requests, self._requests = self._requests, {}
+            children, self._children = self._children, {}
+        if requests or children:
+            logger.error("fork server exited, %d commands lost", len(requests) + len(children))
+        for request in requests.values():
+            request[1] = (None, errno.EPIPE)
+            request[0].set()
+        for child in children.values():
+            child.exited(255, None)
+
+    def close(self):
+        self._socket.shutdown(socket.SHUT_RDWR)
+        self._server.wait()
+        self._reader.join()
+        self._socket.close()
+
+
+launchers = {
+    'subprocess': SubprocessLauncher,
+    'posix_spawn': PosixSpawnLauncher,
+    'forkserver': ForkServerLauncher,
+}
+
+_default = SubprocessLauncher()
+_current = contextvars.ContextVar('petriish_launcher', default=_default)
+
+
+def current():
+    return _current.get()
+
+
+@contextlib.contextmanager
+def launching(launcher):
+    """Spawn commands run inside the block (by the threading engine) with `launcher`"""
+    token = _current.set(launcher)
+    try:
+        yield launcher
+    finally:
+        _current.reset(token)
+
+
+class Invocation(namedtuple('Invocation', ('cwd', 'env', 'stdout', 'stderr'), defaults=(None, None, None, None))):
+    """Surroundings of commands of a run, as if it was started from elsewhere.
+
+    Working directory, environment (dict of str) and descriptors that
+    output not captured by petriish goes to. None means petriish's own.
+    """
+
+
+_invocation = contextvars.ContextVar('petriish_invocation', default=Invocation())
+
+
+def current_invocation():
+    return _invocation.get()
+
+
+@contextlib.contextmanager
+def invoked(invocation):
+    """Run commands inside the block in surroundings of `invocation`"""
+    token = _invocation.set(invocation)
+    try:
+        yield invocation
+    finally:
+        _invocation.reset(token)
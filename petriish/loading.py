@@ -0,0 +1,259 @@
+"""Loading workflow descriptions from YAML.
+
+YAML is parsed by libyaml when PyYAML has it. Deserialized and type
+checked workflows may be kept in a `PlanCache`, keyed on hash of the
+description. And a top-level sequence may be deserialized lazily, so
+that its first children run while the rest is still being built.
+"""
+import collections.abc
+import functools
+import hashlib
+import itertools
+import logging
+import os
+import pickle
+import tempfile
+import threading
+
+import yaml
+
+from . import Sequence, check_types, serialization, types
+
+
+logger = logging.getLogger(__name__)
+
+Loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# Bump when pickled patterns stop being compatible
+CACHE_FORMAT = 4
+
+
+@functools.lru_cache(maxsize=None)
+def _code_digest():
+    """Digest of petriish source - patterns pickled by other code may not work with ours"""
+    package = os.path.dirname(os.path.abspath(__file__))
+    code = hashlib.sha256()
+    for directory, subdirectories, files in os.walk(package):
+        subdirectories.sort()
+        for name in sorted(files):
+            if name.endswith('.py'):
+                path = os.path.join(directory, name)
+                code.update(os.path.relpath(path, package).encode() + b'\0')
+                with open(path, 'rb') as f:
+                    code.update(f.read())
+    return code.hexdigest()
+
+
+def digest(data):
+    return hashlib.sha256(b'%d:%s:' % (CACHE_FORMAT, _code_digest().encode()) + data).hexdigest()
+
+
+class PlanCache:
+    """Directory of pickled workflows, keyed on `digest` of the description.
+
+    Every entry holds the workflow and the error from type checking it,
+    if any. Entries are pickles - keep the directory private. Keys cover
+    petriish code too, entries written by other versions are never used.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.pickle')
+
+    def get(self, key):
+        """Return `(workflow, type error)` or None"""
+        try:
+            with open(self._path(key), 'rb') as f:
+                entry = pickle.load(f)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except Exception as e:
+            logger.warning("dropping broken plan cache entry %s: %s", key, e)
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry
+
+    def put(self, key, workflow, type_error):
+        fd, temp_path = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump((workflow, type_error), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, self._path(key))
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+
+def _check(workflow):
+    try:
+        check_types(workflow)
+    except types.TypeResolutionError as e:
+        return str(e) or 'type error'
+    return None
+
+
+def _report(type_error):
+    if type_error is not None:
+        # commands ignore input they don't read, so it's not fatal
+        logger.warning("workflow doesn't type check: %s", type_error)
+
+
+def load(data, cache=None, lazy=False):
+    """Return workflow described by YAML `data` (bytes).
+
+    With `lazy` a top-level sequence gets children of type `LazyList`,
+    parsed and filled in by a background thread - whoever runs them
+    waits only for the child at hand. For that `type` must come before
+    `children` in the file. Type checking (and storing to `cache`)
+    happens once all of them are there.
+    """
+    key = None
+    if cache is not None:
+        key = digest(data)
+        entry = cache.get(key)
+        if entry is not None:
+            workflow, type_error = entry
+            _report(type_error)
+            return workflow
+
+    workflow = _load_lazily(data, cache, key) if lazy else None
+    if workflow is None:
+        workflow = serialization.deserialize(yaml.load(data, Loader=Loader))
+        _finish(workflow, cache, key)
+    return workflow
+
+
+def _finish(workflow, cache, key):
+    type_error = _check(workflow)
+    _report(type_error)
+    if cache is not None:
+        try:
+            cache.put(key, workflow, type_error)
+        except (OSError, pickle.PicklingError) as e:
+            logger.warning("can't store workflow in plan cache: %s", e)
+
+
+class _StreamingLoader(Loader, yaml.composer.Composer):
+    """Loader composing nodes one by one, straight from parser events"""
+
+    def __init__(self, stream):
+        Loader.__init__(self, stream)
+        yaml.composer.Composer.__init__(self)
+
+    def next_value(self):
+        return self.construct_object(self.compose_node(None, None), deep=True)
+
+
+def _load_lazily(data, cache, key):
+    """Start loading a plain top-level sequence, return None for anything else"""
+    loader = _StreamingLoader(data)
+    try:
+        fields = _sequence_header(loader)
+    except Exception:
+        fields = None
+    if fields != {'type': 'sequence'}:
+        loader.dispose()
+        return None
+
+    children = LazyList()
+
+    def build():
+        shared = {}
+        try:
+            while not loader.check_event(yaml.SequenceEndEvent):
+                children.append(serialization.deserialize(loader.next_value(), shared))
+            loader.get_event()
+            if not loader.check_event(yaml.MappingEndEvent):
+                raise ValueError('no fields may follow children of a lazily loaded sequence')
+        except Exception as e:
+            logger.error("can't load the workflow: %s", e)
+            children.close(e)
+            return
+        finally:
+            loader.dispose()
+        children.close()
+        _finish(Sequence(children=list(children)), cache, key)
+
+    threading.Thread(target=build, name='petriish-loader', daemon=True).start()
+    return Sequence(children=children)
+
+
+def _sequence_header(loader):
+    """Read top-level fields preceding children, stop at the first child"""
+    loader.get_event()  # stream start
+    loader.get_event()  # document start
+    if not loader.check_event(yaml.MappingStartEvent):
+        return None
+    loader.get_event()
+    fields = {}
+    while not loader.check_event(yaml.MappingEndEvent):
+        name = loader.next_value()
+        if name == 'children':
+            if not loader.check_event(yaml.SequenceStartEvent):
+                return None
+            loader.get_event()
+            return fields
+        fields[name] = loader.next_value()
+    return None
+
+
+class LazyList(collections.abc.Sequence):
+    """List appended to by another thread, until it's closed.
+
+    Reading an item waits until it's there, length is known once the
+    list is closed. If filling the list fails, readers of missing items
+    get the error.
+    """
+
+    def __init__(self):
+        self._items = []
+        self._closed = False
+        self._error = None
+        self._condition = threading.Condition()
+
+    def append(self, item):
+        with self._condition:
+            self._items.append(item)
+            self._condition.notify_all()
+
+    def close(self, error=None):
+        with self._condition:
+            self._closed = True
+            self._error = error
+            self._condition.notify_all()
+
+    def _wait(self, count=None):
+        """Wait for `count` items, or for all of them"""
+        with self._condition:
+            while not self._closed and (count is None or len(self._items) < count):
+                self._condition.wait()
+            if self._error is not None and (count is None or len(self._items) < count):
+                raise RuntimeError('workflow failed to load') from self._error
+
+    def __len__(self):
+        self._wait()
+        return len(self._items)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice) or index < 0:
+            self._wait()
+        else:
+            self._wait(index + 1)
+        return self._items[index]
+
+    def __iter__(self):
+        for i in itertools.count():
+            try:
+                yield self[i]
+            except IndexError:
+                return
+
+    def __repr__(self):
+        return 'LazyList({} loaded{})'.format(len(self._items), '' if self._closed else ' so far')
@@ -1,33 +1,568 @@
+import asyncio
+import contextlib
+import contextvars
 import logging
+import os
+import queue
+import signal
 import subprocess
+import threading
+import time
 
-from petriish import WorkflowPattern, Result
+from petriish import WorkflowPattern, Result, analysis, cache, cancellation, launchers, scheduling, storage, tracing
 from petriish.types import Bytes, Record
 
 
 logger = logging.getLogger(__name__)
 
+# Seconds between SIGTERM and SIGKILL when a running command is cancelled.
+TERMINATION_GRACE_PERIOD = 5
+
+CHUNK_SIZE = 2 ** 16
+
+
+def _signal_group(process, sig):
+    # Process group id is the pid of its leader. Until the leader is reaped
+    # (returncode set) the id can't be reused, so it's safe to signal.
+    if process.returncode is None:
+        try:
+            os.killpg(process.pid, sig)
+        except ProcessLookupError:
+            pass
+
+
+def _terminate(process):
+    """Ask process group to terminate, kill it if it's still there after grace period."""
+    _signal_group(process, signal.SIGTERM)
+    killer = threading.Timer(TERMINATION_GRACE_PERIOD, _signal_group, (process, signal.SIGKILL))
+    killer.daemon = True
+    killer.start()
+
+
+async def _terminate_async(process):
+    _signal_group(process, signal.SIGTERM)
+    try:
+        await asyncio.wait_for(process.wait(), TERMINATION_GRACE_PERIOD)
+    except asyncio.TimeoutError:
+        _signal_group(process, signal.SIGKILL)
+        await process.wait()
+
+
+def _close(fd):
+    # PIPE and friends are negative, only real descriptors get closed
+    if isinstance(fd, int) and fd >= 0:
+        os.close(fd)
+
+
+def _pipeline_stdio(commands, input):
+    """Yield Popen stdio arguments for each of commands, chaining them with pipes.
+
+    Parent's copies of pipe ends are closed as soon as the caller asks for
+    the next command, so spawn the current one before that. Output that
+    isn't captured, working directory and environment come from the
+    current `launchers.Invocation`.
+    """
+    invocation = launchers.current_invocation()
+    if not commands[0].pass_stdin or input is None:
+        stdin = None
+    elif isinstance(input, storage.SpilledBytes):
+        stdin = input.open()
+        if stdin is None:
+            stdin = subprocess.PIPE  # can't be reopened, fed by `_communicate`
+    else:
+        stdin = subprocess.PIPE
+    for i, command in enumerate(commands):
+        if i < len(commands) - 1:
+            next_stdin, stdout = os.pipe()
+        else:
+            next_stdin, stdout = None, subprocess.PIPE if command.capture_stdout else invocation.stdout
+        try:
+            yield command, {
+                'stdin': stdin,
+                'stdout': stdout,
+                'stderr': invocation.stderr,
+                'cwd': invocation.cwd,
+                'env': invocation.env,
+                # own process group, so the whole process tree can be killed
+                'start_new_session': True,
+            }
+        except GeneratorExit:
+            _close(next_stdin)
+            raise
+        finally:
+            _close(stdin)
+            if stdout is not invocation.stdout:
+                _close(stdout)
+        stdin = next_stdin
+
+
+def _spawn(commands, input):
+    launcher = launchers.current()
+    processes = []
+    try:
+        with contextlib.closing(_pipeline_stdio(commands, input)) as stdio:
+            for command, kwargs in stdio:
+                logger.info("starting %s", command.command)
+                processes.append(launcher.spawn(
+                    command.argv,
+                    **{k: kwargs[k] for k in ('stdin', 'stdout', 'stderr', 'cwd', 'env')}
+                ))
+    except BaseException:
+        for process in processes:
+            _signal_group(process, signal.SIGKILL)
+            process.wait()
+        raise
+    return processes
+
+
+async def _spawn_async(commands, input):
+    processes = []
+    try:
+        with contextlib.closing(_pipeline_stdio(commands, input)) as stdio:
+            for command, kwargs in stdio:
+                logger.info("starting %s", command.command)
+                processes.append(await asyncio.create_subprocess_exec(*command.argv, **kwargs))
+    except BaseException:
+        for process in processes:
+            _signal_group(process, signal.SIGKILL)
+            await process.wait()
+        raise
+    return processes
+
+
+def _feed(pipe, data):
+    if isinstance(data, storage.SpilledBytes):
+        data = data.view
+    try:
+        pipe.write(data)
+        pipe.close()
+    except BrokenPipeError:
+        pass  # reader is gone, it's up to it to decide if that's a failure
+
+
+def _communicate(processes, input, limit=None, stopped=None):
+    """Feed input to the first process, return stdout collected from the last one
+    and resource usage of all of them.
+
+    If stdout gets over `limit` bytes, the processes are terminated and
+    `storage.OutputLimitExceeded` raised. Once `stopped` (an event) is
+    set, stdout is read without waiting for the output budget, and
+    dropped. Wake the budget after setting it.
+    """
+    first, last = processes[0], processes[-1]
+    feeder = None
+    if first.stdin is not None:
+        if last.stdout is None:
+            _feed(first.stdin, input)
+        else:
+            feeder = threading.Thread(target=_feed, args=(first.stdin, input))
+            feeder.start()
+    stdout = None
+    try:
+        if last.stdout is not None:
+            buffer = storage.OutputBuffer(limit)
+            try:
+                with last.stdout:
+                    while True:
+                        buffer.wait(stopped and stopped.is_set)
+                        chunk = last.stdout.read1(CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        if stopped is not None and stopped.is_set():
+                            # processes are being terminated, the output isn't used
+                            continue
+                        buffer.write(chunk)
+            except storage.OutputLimitExceeded:
+                for process in processes:
+                    _terminate(process)
+                raise
+            stdout = buffer.getvalue()
+    finally:
+        if feeder is not None:
+            feeder.join()
+        for process in processes:
+            process.wait()
+    return stdout, [process.rusage for process in processes]
+
+
+async def _communicate_async(processes, input, limit=None):
+    first, last = processes[0], processes[-1]
+
+    async def feed():
+        if first.stdin is None:
+            return
+        try:
+            first.stdin.write(input.view if isinstance(input, storage.SpilledBytes) else input)
+            await first.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        first.stdin.close()
+
+    async def collect():
+        if last.stdout is None:
+            return None
+        buffer = storage.OutputBuffer(limit)
+        try:
+            while True:
+                await buffer.wait_async()
+                chunk = await last.stdout.read(CHUNK_SIZE)
+                if not chunk:
+                    return buffer.getvalue()
+                buffer.write(chunk)
+        except storage.OutputLimitExceeded:
+            # processes aren't done until their stdout gets to EOF
+            await asyncio.gather(_discard(last.stdout), *(_terminate_async(process) for process in processes))
+            raise
+        finally:
+            buffer.release()
+
+    _, stdout, *_ = await asyncio.gather(
+        feed(),
+        collect(),
+        *(process.wait() for process in processes)
+    )
+    return stdout
+
+
+async def _discard(stream):
+    while await stream.read(CHUNK_SIZE):
+        pass
+
+
+def _requirements(commands):
+    """Resources needed by the commands running together"""
+    total = {}
+    for command in commands:
+        for name, amount in (command.resources or {}).items():
+            total[name] = total.get(name, 0) + amount
+    return total
+
+
+def _apply_requirements(commands, processes):
+    pool = scheduling.current_resources()
+    if pool is None or not pool.enforce:
+        return
+    for command, process in zip(commands, processes):
+        if command.resources:
+            pool.apply(process.pid, command.resources)
+
+
+def _output_limit(commands):
+    return commands[-1].max_output_bytes if commands[-1].capture_stdout else None
+
+
+def _timeout(commands):
+    timeouts = [command.timeout for command in commands if command.timeout is not None]
+    return min(timeouts) if timeouts else None
+
+
+@contextlib.contextmanager
+def _timer(timeout, callback):
+    """Call `callback` from another thread if the block takes over `timeout` seconds"""
+    if timeout is None:
+        yield
+        return
+    timer = threading.Timer(timeout, callback)
+    timer.daemon = True
+    timer.start()
+    try:
+        yield
+    finally:
+        timer.cancel()
+
+
+def _annotate(commands, processes, input, stdout, rusages=()):
+    details = {
+        'commands': [[os.fsdecode(arg) for arg in command.argv] for command in commands],
+        'exit_codes': [process.returncode for process in processes],
+        'bytes_in': len(input) if commands[0].pass_stdin and input is not None else 0,
+        'bytes_out': len(stdout) if stdout is not None else 0,
+    }
+    rusages = [rusage for rusage in rusages if rusage is not None]
+    if rusages:
+        details.update({
+            'user_time': sum(rusage.ru_utime for rusage in rusages),
+            'system_time': sum(rusage.ru_stime for rusage in rusages),
+            # kilobytes on Linux
+            'max_rss': max(rusage.ru_maxrss for rusage in rusages),
+        })
+    tracing.annotate(**details)
+
+
+def _result(commands, processes, stdout):
+    for command, process in zip(commands, processes):
+        logger.info("command %s exited with code %d", command.command, process.returncode)
+    return Result(
+        success=(
+            all(process.returncode == 0 for process in processes) and
+            not cancellation.cancelled()
+        ),
+        output=stdout,
+    )
+
+
+def run_commands(commands, input):
+    """Run commands concurrently, each one's stdout piped into next one's stdin.
+
+    First command gets `input` on stdin (if it passes stdin at all) and
+    the result holds stdout captured from the last one. It's a success
+    only if every command succeeds. The whole pipeline takes one slot.
+    """
+    try:
+        with scheduling.slot(_requirements(commands)):
+            if cancellation.cancelled():
+                raise cancellation.Cancelled()
+            processes = _spawn(commands, input)
+            _apply_requirements(commands, processes)
+
+            stopped = threading.Event()
+            budget = storage.current_output_budget()
+
+            def terminate():
+                stopped.set()
+                for process in processes:
+                    _terminate(process)
+                # reader may be paused by the budget
+                budget.wake()
+
+            expired = threading.Event()
+
+            def expire():
+                expired.set()
+                terminate()
+
+            with cancellation.on_cancel(terminate), _timer(_timeout(commands), expire):
+                stdout, rusages = _communicate(processes, input, _output_limit(commands), stopped)
+    except cancellation.Cancelled:
+        logger.info("commands %s cancelled before start", [c.command for c in commands])
+        return Result(success=False)
+    except storage.OutputLimitExceeded as e:
+        logger.error("commands %s terminated: %s", [c.command for c in commands], e)
+        return Result(success=False)
+    if tracing.tracing():
+        _annotate(commands, processes, input, stdout, rusages)
+    if expired.is_set():
+        logger.error("commands %s timed out after %s s", [c.command for c in commands], _timeout(commands))
+        return Result(success=False)
+    return _result(commands, processes, stdout)
+
+
+async def run_commands_async(commands, input):
+    async with scheduling.slot_async(_requirements(commands)):
+        processes = await _spawn_async(commands, input)
+        _apply_requirements(commands, processes)
+        timeout = _timeout(commands)
+        try:
+            communicating = _communicate_async(processes, input, _output_limit(commands))
+            if timeout is None:
+                stdout = await communicating
+            else:
+                stdout = await asyncio.wait_for(communicating, timeout)
+        except asyncio.TimeoutError:
+            last = processes[-1]
+            await asyncio.gather(
+                *([_discard(last.stdout)] if last.stdout is not None else []),
+                *(_terminate_async(process) for process in processes)
+            )
+            logger.error("commands %s timed out after %s s", [c.command for c in commands], timeout)
+            return Result(success=False)
+        except asyncio.CancelledError:
+            await asyncio.gather(*(_terminate_async(process) for process in processes))
+            logger.info("commands %s cancelled, exited with codes %s", [c.command for c in commands], [
+                process.returncode for process in processes
+            ])
+            raise
+        except storage.OutputLimitExceeded as e:
+            logger.error("commands %s terminated: %s", [c.command for c in commands], e)
+            return Result(success=False)
+    if tracing.tracing():
+        # child watcher reaps the processes, so no resource usage here
+        _annotate(commands, processes, input, stdout)
+    return _result(commands, processes, stdout)
+
+
+def _timed(commands, input):
+    """Run the commands, record how long they took if they succeed"""
+    start = time.monotonic()
+    result = run_commands(commands, input)
+    _record(commands, result, time.monotonic() - start)
+    return result
+
+
+async def _timed_async(commands, input):
+    start = time.monotonic()
+    result = await run_commands_async(commands, input)
+    _record(commands, result, time.monotonic() - start)
+    return result
+
+
+def _record(commands, result, duration):
+    history = analysis.current_history()
+    if history is not None and result.success and not cancellation.cancelled():
+        history.record(commands, duration)
+
+
+def run_hedged(commands, input, after):
+    """Run the commands, and once more if they are still running after `after` seconds.
+
+    Whichever run finishes first gives the result (or the exception it
+    raised), the other one gets cancelled. With `after` None there's
+    just the one run.
+    """
+    if after is None:
+        return _timed(commands, input)
+    finished = queue.Queue()
+    runs = []
+
+    def run(scope):
+        try:
+            result = _timed(commands, input)
+        except BaseException as e:
+            result = e
+        finished.put((scope, result))
+
+    def start():
+        scope = cancellation.CancelScope(parent=cancellation.current())
+        with cancellation.using(scope):
+            context = contextvars.copy_context()
+        thread = threading.Thread(target=context.run, args=(run, scope))
+        runs.append((scope, thread))
+        thread.start()
+
+    start()
+    try:
+        winner, result = finished.get(timeout=after)
+    except queue.Empty:
+        logger.info("commands %s still running after %.3f s, starting another run", [c.command for c in commands], after)
+        start()
+        winner, result = finished.get()
+    for scope, thread in runs:
+        if scope is not winner:
+            scope.cancel()
+    for scope, thread in runs:
+        thread.join()
+        scope.close()
+    if isinstance(result, BaseException):
+        raise result
+    return result
+
+
+async def run_hedged_async(commands, input, after):
+    """Asyncio counterpart of `run_hedged`"""
+    if after is None:
+        return await _timed_async(commands, input)
+    runs = [asyncio.ensure_future(_timed_async(commands, input))]
+    try:
+        done, _ = await asyncio.wait(runs, timeout=after)
+        if not done:
+            logger.info("commands %s still running after %.3f s, starting another run", [c.command for c in commands], after)
+            runs.append(asyncio.ensure_future(_timed_async(commands, input)))
+            done, _ = await asyncio.wait(runs, return_when=asyncio.FIRST_COMPLETED)
+        return next(run for run in runs if run in done).result()
+    finally:
+        pending = [run for run in runs if not run.done()]
+        for run in pending:
+            run.cancel()
+        if pending:
+            await asyncio.wait(pending)
+
 
 class SimpleCommand(WorkflowPattern):
-    def __init__(self, command, pass_stdin=False, capture_stdout=False, **kwargs):
+    """Leaf running a single command.
+
+    `cacheable` allows reusing results of earlier runs from the active
+    result cache. Besides `True` it can be a dict declaring what else
+    the result depends on: `{'env': [variable names], 'files': [paths]}`.
+
+    Command capturing more than `max_output_bytes` of stdout is
+    terminated and fails.
+
+    `resources` declares what the command needs, like `{'cpu': 8,
+    'mem': 20 * 2 ** 30}`. It waits for them in the active
+    `scheduling.ResourcePool`.
+
+    Command running over `timeout` seconds is terminated and fails.
+    `hedge` makes a command still running after that many seconds run
+    once more, side by side - the first run to finish wins, the other
+    one is terminated. Instead of seconds it may be `{'percentile': 95}`,
+    the threshold learned from durations in `analysis.current_history()`,
+    optionally with `'after'` seconds to use until there's enough of
+    them. Hedge only commands that are safe to run twice. Commands
+    streamed in a `Pipeline` aren't hedged.
+    """
+
+    def __init__(self, command, pass_stdin=False, capture_stdout=False, cacheable=False, max_output_bytes=None, resources=None, timeout=None, hedge=None, **kwargs):
         self.command = command
         self.pass_stdin = pass_stdin
         self.capture_stdout = capture_stdout
+        self.cacheable = cacheable
+        self.max_output_bytes = max_output_bytes
+        self.resources = resources
+        self.timeout = timeout
+        self.hedge = hedge
         super().__init__(**kwargs)
 
     def execute(self, input):
-        kwargs = {}
-        if self.pass_stdin:
-            kwargs['input'] = input
-        if self.capture_stdout:
-            kwargs['stdout'] = subprocess.PIPE
-        logger.info("starting %s", self.command)
-        process = subprocess.run(self.command, **kwargs)
-        logger.info("command %s exited with code %d", self.command, process.returncode)
-        return Result(
-            success=(process.returncode == 0),
-            output=process.stdout,
-        )
+        result_cache = cache.current() if self.cacheable else None
+        if result_cache is None:
+            return self._run(input)
+        key = cache.key(self, input)
+        result = self._cached(result_cache, key)
+        if result is None:
+            result = self._run(input)
+            result_cache.put(key, result)
+        return result
+
+    async def execute_async(self, input):
+        result_cache = cache.current() if self.cacheable else None
+        if result_cache is None:
+            return await self._run_async(input)
+        # hashing inputs and file I/O would block the event loop
+        loop = asyncio.get_running_loop()
+        key = await loop.run_in_executor(None, cache.key, self, input)
+        result = await loop.run_in_executor(None, self._cached, result_cache, key)
+        if result is None:
+            result = await self._run_async(input)
+            await loop.run_in_executor(None, result_cache.put, key, result)
+        return result
+
+    def _run(self, input):
+        if self.hedge is None:
+            return run_commands([self], input)
+        return run_hedged([self], input, self._hedge_after())
+
+    async def _run_async(self, input):
+        if self.hedge is None:
+            return await run_commands_async([self], input)
+        return await run_hedged_async([self], input, self._hedge_after())
+
+    def _hedge_after(self):
+        """Seconds before running the command once more, None if not known yet"""
+        if not isinstance(self.hedge, dict):
+            return self.hedge
+        history = analysis.current_history()
+        learned = None
+        if 'percentile' in self.hedge and history is not None:
+            learned = history.percentile([self], self.hedge['percentile'])
+        return learned if learned is not None else self.hedge.get('after')
+
+    def estimate(self, analyzer, path):
+        return analyzer.leaf(path, [self], captures=self.capture_stdout)
+
+    def _cached(self, result_cache, key):
+        result = result_cache.get(key)
+        if result is None:
+            logger.info("cache miss for %s", self.command)
+        else:
+            logger.info("cache hit for %s", self.command)
+        return result
+
+    @property
+    def argv(self):
+        """Command as a list, the way `subprocess` interprets it."""
+        if isinstance(self.command, (str, bytes)):
+            return [self.command]
+        return list(self.command)
 
     def output_type(self, resolver, input_type):
         if self.pass_stdin:
@@ -44,12 +579,82 @@ class SimpleCommand(WorkflowPattern):
             isinstance(other, self.__class__) and
             self.command == other.command and
             self.pass_stdin == other.pass_stdin and
-            self.capture_stdout == other.capture_stdout
+            self.capture_stdout == other.capture_stdout and
+            self.cacheable == other.cacheable and
+            self.max_output_bytes == other.max_output_bytes and
+            self.resources == other.resources and
+            self.timeout == other.timeout and
+            self.hedge == other.hedge
         )
 
     def __hash__(self):
+        # command may be a list and cacheable a dict
         return hash((
-            self.command,
+            tuple(self.argv),
             self.pass_stdin,
             self.capture_stdout,
+            bool(self.cacheable),
+            self.max_output_bytes,
+            self.timeout,
         ))
+
+
+class Pipeline(WorkflowPattern):
+    """Commands connected with OS pipes, like a shell pipeline.
+
+    It's equivalent to a sequence of the commands, except they all run
+    at once and the data between them is never buffered in petriish.
+    """
+
+    def __init__(self, commands, **kwargs):
+        for upstream, downstream in zip(commands, commands[1:]):
+            if not upstream.capture_stdout or not downstream.pass_stdin:
+                raise ValueError('{} doesn\'t stream into {}'.format(
+                    upstream.command, downstream.command,
+                ))
+        self.commands = commands
+        super().__init__(**kwargs)
+
+    def execute(self, input):
+        return run_commands(self.commands, input)
+
+    async def execute_async(self, input):
+        return await run_commands_async(self.commands, input)
+
+    def estimate(self, analyzer, path):
+        return analyzer.leaf(path, self.commands, captures=self.commands[-1].capture_stdout)
+
+    def output_type(self, resolver, input_type):
+        for command in self.commands:
+            input_type = resolver.output_type(command, input_type)
+        return input_type
+
+    def __eq__(self, other):
+        return isinstance(other, self.__class__) and self.commands == other.commands
+
+    def __hash__(self):
+        return hash(tuple(self.commands))
+
+
+def join_pipelines(patterns):
+    """Replace runs of commands streaming one into another with `Pipeline`s"""
+    joined = []
+    run = []
+
+    def flush():
+        if len(run) > 1:
+            joined.append(Pipeline(list(run)))
+        else:
+            joined.extend(run)
+        run.clear()
+
+    for pattern in patterns:
+        if not isinstance(pattern, SimpleCommand):
+            flush()
+            joined.append(pattern)
+            continue
+        if run and not (run[-1].capture_stdout and pattern.pass_stdin):
+            flush()
+        run.append(pattern)
+    flush()
+    return joined
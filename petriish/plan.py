@@ -0,0 +1,420 @@
+"""Compiled execution of pattern trees.
+
+`compile` flattens a tree into a table of nodes, in depth-first order,
+so that a subtree is a contiguous range of the table. `Plan` drives it
+as a state machine on an asyncio event loop: structural nodes are just
+records with counters, only leaves get tasks. Moving a value from one
+node to the next costs the same no matter how big the tree is, and
+every node takes a fixed amount of memory, however many times a
+repetition around it iterates.
+
+Leaves are commands, pipelines and any other pattern the plan doesn't
+know the structure of (speculative repetitions included) - those are
+executed as under the asyncio engine.
+
+A top-level sequence still being loaded (see `loading.load`) isn't
+flattened as a whole, its children are compiled one by one as they come.
+"""
+import asyncio
+import collections
+import contextvars
+import functools
+import itertools
+
+from . import (
+    Alternative, Parallelization, Repetition, Result, Sequence,
+    _CancellationReport, _execute_async, _fan_out, _nested_path, _path, current_path, scheduling,
+)
+
+
+LEAF, SEQUENCE, PARALLELIZATION, ALTERNATIVE, REPETITION = range(5)
+
+
+class _Node:
+    __slots__ = (
+        # structure
+        'kind', 'pattern', 'parent', 'key', 'first', 'count', 'end', 'jobs', 'fail_fast',
+        # current activation - one at a time, as repetition iterations
+        # don't overlap (unless speculative, and those are leaves)
+        'run', 'parent_run', 'result', 'pending', 'index', 'successes', 'limiter',
+        'path', 'limiters',
+    )
+
+    def __init__(self, kind, pattern, parent, key):
+        self.kind = kind
+        self.pattern = pattern
+        self.parent = parent
+        self.key = key
+        self.first = 0
+        self.count = 0
+        self.end = 0
+        self.jobs = None
+        self.fail_fast = False
+        self.run = 0
+        self.parent_run = 0
+        self.result = None
+        self.pending = 0
+        self.index = 0
+        self.successes = 0
+        self.limiter = None
+        self.path = ()
+        self.limiters = ()
+
+
+def _structure(pattern):
+    """Return kind of the node and its `(key, child)` pairs"""
+    kind = type(pattern)
+    if kind is Sequence:
+        return SEQUENCE, list(enumerate(pattern.children))
+    if kind is Parallelization:
+        return PARALLELIZATION, list(pattern.children.items())
+    if kind is Alternative:
+        return ALTERNATIVE, list(enumerate(pattern.children))
+    if kind is Repetition and not pattern.speculative:
+        return REPETITION, [('child', pattern.child), ('exit', pattern.exit)]
+    return LEAF, []
+
+
+def compile(pattern):
+    """Flatten the pattern tree into a `Plan`"""
+    if type(pattern) is Sequence and not isinstance(pattern.children, (list, tuple)):
+        return _LazySequence(pattern.children)
+    plan = Plan()
+    nodes, links = plan.nodes, plan.links
+    stack = [(pattern, -1, None, None)]
+    while stack:
+        pattern, parent, key, link = stack.pop()
+        if link is not None:
+            links[link] = len(nodes)
+        kind, children = _structure(pattern)
+        node = _Node(kind, None if kind == SEQUENCE else pattern, parent, key)
+        nodes.append(node)
+        if not children:
+            continue
+        if kind in (PARALLELIZATION, ALTERNATIVE):
+            node.jobs = pattern.jobs
+            node.fail_fast = kind is PARALLELIZATION and pattern.fail_fast
+        n = len(nodes) - 1
+        first = node.first = len(links)
+        node.count = len(children)
+        links.extend([None] * len(children))
+        # reversed, so that children come out of the stack in order
+        stack.extend(
+            (child, n, child_key, first + i)
+            for i, (child_key, child) in reversed(list(enumerate(children)))
+        )
+    for n in reversed(range(len(nodes))):
+        node = nodes[n]
+        node.end = nodes[links[node.first + node.count - 1]].end if node.count else n + 1
+    return plan
+
+
+class Plan:
+    """Pattern tree compiled by `compile`.
+
+    `nodes[0]` is the root, children of a node are `links[first:first + count]`
+    and its subtree spans `nodes[n:end]`. A plan runs one execution at a time.
+    """
+
+    def __init__(self):
+        self.nodes = []
+        self.links = []
+        self._busy = False
+
+    def __len__(self):
+        return len(self.nodes)
+
+    async def execute_async(self, input):
+        if self._busy:
+            raise RuntimeError('plan is already running')
+        self._busy = True
+        try:
+            return await _Execution(self).run(input)
+        finally:
+            self._busy = False
+
+
+class _LazySequence:
+    """Sequence whose children get compiled as they are loaded"""
+
+    def __init__(self, children):
+        self.children = children
+
+    async def execute_async(self, input):
+        for i, child in enumerate(self.children):
+            with _nested_path(i):
+                result = await compile(child).execute_async(input)
+            if not result.success:
+                return result
+            input = result.output
+        return Result(success=True, output=input)
+
+
+def _enter(path, limiters):
+    _path.set(path)
+    scheduling._limiters.set(limiters)
+
+
+_NOTHING = object()
+
+
+class _Resumed(collections.abc.Coroutine):
+    """Rest of a coroutine whose first step already ran, outside of a task.
+
+    Steps are run in `context`, just like the first one. Cancellation
+    that comes before the task gets to run still reaches the coroutine,
+    so it can clean up.
+    """
+
+    def __init__(self, context, coroutine, yielded):
+        self._context = context
+        self._coroutine = coroutine
+        self._yielded = yielded
+
+    def send(self, value):
+        if self._yielded is not _NOTHING:
+            yielded, self._yielded = self._yielded, _NOTHING
+            return yielded
+        return self._context.run(self._coroutine.send, value)
+
+    def throw(self, *exc_info):
+        self._yielded = _NOTHING
+        return self._context.run(self._coroutine.throw, *exc_info)
+
+    def close(self):
+        self._context.run(self._coroutine.close)
+
+    def __await__(self):
+        raise TypeError('run it as a task')
+
+
+class _Execution:
+    """Single run of a plan.
+
+    Everything happens on the event loop thread. Transitions go through
+    a queue instead of recursion, so deep trees don't overflow the stack.
+    Every activation of a node gets a run number - events of activations
+    that are over (finished or cancelled) are recognized by it and dropped.
+    """
+
+    def __init__(self, plan):
+        self.nodes = plan.nodes
+        self.links = plan.links
+        self.path = current_path()
+        self.limiters = scheduling._limiters.get()
+        self.events = collections.deque()
+        self.runs = itertools.count(1)
+        self.running = {}  # leaf task -> node
+        self.finished = None
+
+    async def run(self, input):
+        self.finished = asyncio.get_running_loop().create_future()
+        self.events.append((self._activate, 0, input, 0))
+        self._process()
+        try:
+            return await self.finished
+        finally:
+            # only cancelled leaves may be left, or everything if we are
+            # being cancelled ourselves - wait for them to clean up
+            pending = list(self.running)
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.wait(pending)
+
+    def _process(self):
+        events = self.events
+        while events:
+            handler, n, value, run = events.popleft()
+            handler(n, value, run)
+
+    def _start(self, parent, i, input):
+        n = self.links[parent.first + i]
+        self.events.append((self._activate, n, input, parent.run))
+
+    def _finish(self, n, result):
+        node = self.nodes[n]
+        node.result = result
+        node.run = 0
+        self.events.append((self._deliver, n, result, node.parent_run))
+
+    def _activate(self, n, input, parent_run):
+        node = self.nodes[n]
+        if node.parent >= 0 and self.nodes[node.parent].run != parent_run:
+            return
+        node.run = next(self.runs)
+        node.parent_run = parent_run
+        node.result = None
+        self._enter(node)
+        kind = node.kind
+        if kind == LEAF:
+            self._run_leaf(n, node, input)
+        elif kind == SEQUENCE:
+            node.index = 0
+            if node.count:
+                self._start(node, 0, input)
+            else:
+                self._finish(n, Result(success=True, output=input))
+        elif kind == REPETITION:
+            node.index = 0
+            self._iterate(node, input)
+        else:
+            node.pending = node.count
+            node.successes = 0
+            node.limiter = None if node.jobs is None else scheduling.Limiter(node.jobs)
+            for i in range(node.count):
+                self.nodes[self.links[node.first + i]].result = None
+            children = node.pattern.children
+            input = _fan_out(input, children.values() if kind == PARALLELIZATION else children)
+            for i in range(node.count):
+                self._start(node, i, input)
+            if not node.count:
+                self._finish(n, self._join(node) if kind == PARALLELIZATION else Result(success=False))
+
+    def _iterate(self, node, input):
+        node.pending = 2
+        self._start(node, 0, input)
+        self._start(node, 1, input)
+
+    def _run_leaf(self, n, node, input):
+        """Run the leaf up to its first suspension right away.
+
+        Leaves that finish without ever waiting - in-process ones - don't
+        need a task. Only the others get one, to drive the rest.
+        """
+        context = contextvars.copy_context()
+        context.run(_enter, node.path, node.limiters)
+        coroutine = _execute_async(node.pattern, input)
+        try:
+            yielded = context.run(coroutine.send, None)
+        except StopIteration as e:
+            self._finish(n, e.value)
+            return
+        except Exception as e:
+            self._fail(e)
+            return
+        task = asyncio.ensure_future(_Resumed(context, coroutine, yielded))
+        self.running[task] = n
+        task.add_done_callback(functools.partial(self._leaf_done, n, node.run))
+
+    def _fail(self, exception):
+        if not self.finished.done():
+            self.finished.set_exception(exception)
+
+    def _leaf_done(self, n, run, task):
+        del self.running[task]
+        if task.cancelled():
+            result = Result(success=False)
+        elif task.exception() is not None:
+            self._fail(task.exception())
+            return
+        else:
+            result = task.result()
+        if self.nodes[n].run != run or self.finished.done():
+            return
+        self._finish(n, result)
+        self._process()
+
+    def _deliver(self, n, result, parent_run):
+        node = self.nodes[n]
+        if node.parent < 0:
+            if not self.finished.done():
+                self.finished.set_result(result)
+            return
+        p = node.parent
+        parent = self.nodes[p]
+        if parent.run != parent_run:
+            return
+        kind = parent.kind
+        if kind == SEQUENCE:
+            parent.index += 1
+            if not result.success:
+                self._finish(p, result)
+            elif parent.index == parent.count:
+                self._finish(p, Result(success=True, output=result.output))
+            else:
+                self._start(parent, parent.index, result.output)
+        elif kind == PARALLELIZATION:
+            parent.pending -= 1
+            if parent.pending and parent.fail_fast and not result.success:
+                self._cancel(p, parent.count - parent.pending)
+            if not parent.pending or parent.run == 0:
+                self._finish(p, self._join(parent))
+        elif kind == ALTERNATIVE:
+            parent.pending -= 1
+            if result.success:
+                parent.successes += 1
+            if parent.successes >= 2:
+                # outcome is known, see Alternative._decided
+                if parent.pending:
+                    self._cancel(p, parent.count - parent.pending)
+                self._finish(p, Result(success=False))
+            elif not parent.pending:
+                self._finish(p, self._choose(parent))
+        else:
+            parent.pending -= 1
+            if parent.pending:
+                return
+            child, exit = (self.nodes[self.links[parent.first + i]].result for i in (0, 1))
+            final = parent.pattern._step({'child': child, 'exit': exit})
+            if final is not None:
+                self._finish(p, final)
+            else:
+                parent.index += 1
+                self._iterate(parent, child.output)
+
+    def _children(self, node):
+        for i in range(node.count):
+            yield self.nodes[self.links[node.first + i]]
+
+    def _join(self, node):
+        children = list(self._children(node))
+        return Result(
+            success=all(child.result is not None and child.result.success for child in children),
+            output={child.key: child.result.output if child.result is not None else None for child in children},
+        )
+
+    def _choose(self, node):
+        results_ok = [child.result for child in self._children(node) if child.result.success]
+        if len(results_ok) == 1:
+            return results_ok[0]
+        return Result(success=False)
+
+    def _cancel(self, p, finished):
+        """End activations in the subtree of `p`, `p` included.
+
+        `finished` children of `p` are done, the outcome is known anyway.
+        """
+        node = self.nodes[p]
+        for n in range(p, node.end):
+            self.nodes[n].run = 0
+        tasks = [task for task, n in self.running.items() if p < n < node.end]
+        report = _CancellationReport(node.count)
+        report.start(finished)
+        if not tasks:
+            report.finish()
+            return
+        left = [len(tasks)]
+
+        def done(task):
+            left[0] -= 1
+            if not left[0]:
+                report.finish()
+
+        for task in tasks:
+            task.cancel()
+            task.add_done_callback(done)
+
+    def _enter(self, node):
+        """Set path and limiters of the activation, from those of its parent's"""
+        if node.parent < 0:
+            node.path, node.limiters = self.path, self.limiters
+            return
+        parent = self.nodes[node.parent]
+        if parent.kind == REPETITION:
+            node.path = parent.path + ((parent.index,), node.key)
+        else:
+            node.path = parent.path + (node.key,)
+        node.limiters = parent.limiters
+        if parent.limiter is not None:
+            node.limiters += (parent.limiter,)
@@ -0,0 +1,322 @@
+import asyncio
+import collections
+import contextlib
+import contextvars
+import itertools
+import logging
+import os
+import resource
+import threading
+
+from . import cancellation
+
+
+logger = logging.getLogger(__name__)
+
+
+class Limiter:
+    """Counting semaphore usable both from threads and from asyncio tasks.
+
+    Waiters are woken in FIFO order and a released slot is handed over
+    directly to the first of them.
+    """
+
+    def __init__(self, size):
+        if size < 1:
+            raise ValueError('limit must be positive, got {}'.format(size))
+        self.size = size
+        self._lock = threading.Lock()
+        self._free = size
+        self._waiters = collections.deque()
+
+    def acquire(self):
+        """Wait for a slot. Raises `Cancelled` if cancelled in the meantime."""
+        with self._lock:
+            if self._free > 0:
+                self._free -= 1
+                return
+            event = threading.Event()
+            self._waiters.append(event.set)
+        with cancellation.on_cancel(event.set):
+            event.wait()
+        with self._lock:
+            if event.set in self._waiters:
+                # woken by cancellation, not by a release
+                self._waiters.remove(event.set)
+                raise cancellation.Cancelled()
+
+    async def acquire_async(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._free > 0:
+                self._free -= 1
+                return
+            future = loop.create_future()
+            self._waiters.append(
+                lambda: loop.call_soon_threadsafe(self._wake, future),
+            )
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # slot was handed over, but the task got cancelled before it resumed
+                self.release()
+            raise
+
+    def _wake(self, future):
+        if future.cancelled():
+            # waiter is gone, pass the slot on
+            self.release()
+        else:
+            future.set_result(None)
+
+    def release(self):
+        with self._lock:
+            if self._waiters:
+                wake = self._waiters.popleft()
+            else:
+                self._free += 1
+                return
+        wake()
+
+
+_limiters = contextvars.ContextVar('petriish_limiters', default=())
+
+
+@contextlib.contextmanager
+def limit(jobs):
+    """Limit number of leaves running at once inside the block.
+
+    Limits nest - a leaf has to get a slot from every enclosing limit.
+    `None` means no additional limit.
+    """
+    if jobs is None:
+        yield
+        return
+    token = _limiters.set(_limiters.get() + (Limiter(jobs),))
+    try:
+        yield
+    finally:
+        _limiters.reset(token)
+
+
+def host_capacity():
+    """CPUs and physical memory of this machine"""
+    return {
+        'cpu': os.cpu_count() or 1,
+        'mem': os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE'),
+    }
+
+
+def normalize_path(path):
+    """Path without iteration numbers of repetitions"""
+    return tuple(key for key in path if not isinstance(key, (tuple, list)))
+
+
+class ResourcePool:
+    """Capacity of named resources (like `cpu` and `mem`) shared by leaves.
+
+    A leaf runs once all its requirements fit into what's free. Waiting
+    leaves are admitted highest `priorities` first (keyed by path, see
+    `normalize_path`). What's free is reserved for the first one that
+    doesn't fit yet - others, newcomers included, may only go ahead of
+    it if they fit beside the reservation. So a stream of small leaves
+    can't starve a big one. Requirements over the capacity are capped
+    to it and resources not in the capacity aren't limited.
+
+    With `enforce` memory requirements are applied to the processes as
+    their address space limit, where the platform allows it.
+    """
+
+    def __init__(self, capacity, priorities=None, enforce=False):
+        self.capacity = dict(capacity)
+        self.priorities = priorities or {}
+        self.enforce = enforce
+        self._lock = threading.Lock()
+        self._free = dict(capacity)
+        self._waiters = []  # [priority, order, requirements, wake]
+        self._order = itertools.count()
+
+    def _demand(self, requirements):
+        return {
+            name: min(amount, self.capacity[name])
+            for name, amount in requirements.items()
+            if name in self.capacity
+        }
+
+    def _fits(self, demand, reserved=None):
+        reserved = reserved or {}
+        return all(self._free[name] - reserved.get(name, 0) >= amount for name, amount in demand.items())
+
+    def _take(self, demand):
+        for name, amount in demand.items():
+            self._free[name] -= amount
+
+    def _wait(self, demand, wake):
+        from . import current_path  # defined after this module gets imported
+        priority = self.priorities.get(normalize_path(current_path()), 0)
+        waiter = [-priority, next(self._order), demand, wake]
+        self._waiters.append(waiter)
+        self._waiters.sort(key=lambda w: w[:2])
+        return waiter
+
+    def _admit(self):
+        """Take resources for waiters that may go now, return their wake callbacks"""
+        admitted = []
+        reserved = None
+        for waiter in list(self._waiters):
+            if self._fits(waiter[2], reserved):
+                self._take(waiter[2])
+                self._waiters.remove(waiter)
+                admitted.append(waiter[3])
+            elif reserved is None:
+                reserved = waiter[2]
+        return admitted
+
+    def _enqueue(self, demand, wake):
+        """Add waiter and admit whoever may go, it too possibly"""
+        with self._lock:
+            waiter = self._wait(demand, wake)
+            admitted = self._admit()
+        for wake in admitted:
+            wake()
+        return waiter
+
+    def _withdraw(self, waiter):
+        """Remove waiter that gives up, return False if it was admitted already"""
+        with self._lock:
+            if waiter not in self._waiters:
+                return False
+            self._waiters.remove(waiter)
+            # its reservation is gone, others may fit now
+            admitted = self._admit()
+        for wake in admitted:
+            wake()
+        return True
+
+    def acquire(self, requirements):
+        """Wait for the requirements to fit. Raises `Cancelled` if cancelled in the meantime."""
+        demand = self._demand(requirements)
+        with self._lock:
+            if not self._waiters and self._fits(demand):
+                self._take(demand)
+                return
+        event = threading.Event()
+        waiter = self._enqueue(demand, event.set)
+        with cancellation.on_cancel(event.set):
+            event.wait()
+        if self._withdraw(waiter):
+            raise cancellation.Cancelled()
+
+    async def acquire_async(self, requirements):
+        loop = asyncio.get_running_loop()
+        demand = self._demand(requirements)
+        with self._lock:
+            if not self._waiters and self._fits(demand):
+                self._take(demand)
+                return
+        future = loop.create_future()
+        waiter = self._enqueue(demand, lambda: loop.call_soon_threadsafe(self._wake, future, demand))
+        try:
+            await future
+        except asyncio.CancelledError:
+            self._withdraw(waiter)
+            if future.done() and not future.cancelled():
+                # admitted, but the task got cancelled before it resumed
+                self._release(demand)
+            raise
+
+    def _wake(self, future, demand):
+        if future.cancelled():
+            # waiter is gone, pass the resources on
+            self._release(demand)
+        else:
+            future.set_result(None)
+
+    def release(self, requirements):
+        self._release(self._demand(requirements))
+
+    def _release(self, demand):
+        with self._lock:
+            for name, amount in demand.items():
+                self._free[name] += amount
+            admitted = self._admit()
+        for wake in admitted:
+            wake()
+
+    def apply(self, pid, requirements):
+        """Enforce memory requirement on a started process"""
+        memory = requirements.get('mem')
+        if not self.enforce or memory is None or not hasattr(resource, 'prlimit'):
+            return
+        try:
+            resource.prlimit(pid, resource.RLIMIT_AS, (memory, memory))
+        except ProcessLookupError:
+            pass  # already gone
+        except (OSError, ValueError) as e:
+            logger.warning("can't limit memory of %d: %s", pid, e)
+
+
+_resources = contextvars.ContextVar('petriish_resources', default=None)
+
+
+def current_resources():
+    """Active `ResourcePool` or None"""
+    return _resources.get()
+
+
+@contextlib.contextmanager
+def resources(pool):
+    """Admit leaves declaring requirements inside the block through `pool`"""
+    token = _resources.set(pool)
+    try:
+        yield pool
+    finally:
+        _resources.reset(token)
+
+
+@contextlib.contextmanager
+def slot(requirements=None):
+    """Hold a slot in every active limit. Used by leaf patterns only.
+
+    Slots are taken innermost limit first, so whoever holds the outermost
+    one holds them all and is actually running. That way nested limits
+    cannot deadlock. `requirements` are taken from the resource pool
+    last, for the same reason.
+    """
+    acquired = []
+    pool = current_resources() if requirements else None
+    try:
+        for limiter in reversed(_limiters.get()):
+            limiter.acquire()
+            acquired.append(limiter)
+        if pool is not None:
+            pool.acquire(requirements)
+        try:
+            yield
+        finally:
+            if pool is not None:
+                pool.release(requirements)
+    finally:
+        for limiter in reversed(acquired):
+            limiter.release()
+
+
+@contextlib.asynccontextmanager
+async def slot_async(requirements=None):
+    acquired = []
+    pool = current_resources() if requirements else None
+    try:
+        for limiter in reversed(_limiters.get()):
+            await limiter.acquire_async()
+            acquired.append(limiter)
+        if pool is not None:
+            await pool.acquire_async(requirements)
+        try:
+            yield
+        finally:
+            if pool is not None:
+                pool.release(requirements)
+    finally:
+        for limiter in reversed(acquired):
+            limiter.release()
@@ -1,21 +1,70 @@
-from . import Sequence, Alternative, Parallelization, Repetition
-from .patterns.posix import SimpleCommand
+import builtins
+import contextvars
+
+from . import Sequence, Alternative, Map, Parallelization, Repetition, WorkflowPattern
+from .storage import parse_size
+from .patterns.posix import Pipeline, SimpleCommand, join_pipelines
 from .utils import without_key
 
 
-def deserialize(obj):
-    return deserializers[obj['type']](without_key(obj, 'type'))
+_shared = contextvars.ContextVar('petriish_shared_patterns', default=None)
+
+
+def deserialize(obj, shared=None):
+    """Construct pattern tree described by `obj`.
+
+    Identical subtrees become one shared object (hash-consing). Calls
+    given the same `shared` dict share subtrees between them too.
+    """
+    if _shared.get() is not None:
+        return _share(deserializers[obj['type']](without_key(obj, 'type')))
+    token = _shared.set({} if shared is None else shared)
+    try:
+        return _share(deserializers[obj['type']](without_key(obj, 'type')))
+    finally:
+        _shared.reset(token)
+
+
+def _identity(value):
+    """Hashable stand-in for a field of a pattern, its children are shared already"""
+    if isinstance(value, WorkflowPattern):
+        return builtins.id(value)  # `id` here is the field deserializer
+    if isinstance(value, list):
+        return tuple(_identity(v) for v in value)
+    if isinstance(value, dict):
+        return tuple((k, _identity(v)) for k, v in value.items())
+    return value
 
 
-def list_deserializer(constructor):
+def _share(pattern):
+    """Return the shared pattern equal to `pattern`"""
+    fields = pattern if isinstance(pattern, tuple) else vars(pattern).values()
+    key = (type(pattern),) + tuple(_identity(field) for field in fields)
+    return _shared.get().setdefault(key, pattern)
+
+
+def list_deserializer(constructor, mapping={}):
     def f(obj):
-        return constructor(children=[
-            deserialize(sub_obj)
-            for sub_obj in obj['children']
-        ])
+        return constructor(
+            children=[
+                deserialize(sub_obj)
+                for sub_obj in obj['children']
+            ],
+            **{
+                k: mapping[k](v)
+                for k, v in without_key(obj, 'children').items()
+            }
+        )
     return f
 
 
+def sequence_deserializer(obj):
+    sequence = list_deserializer(Sequence)(without_key(obj, 'stream'))
+    if obj.get('stream', False):
+        return Sequence(children=[_share(child) for child in join_pipelines(sequence.children)])
+    return sequence
+
+
 def kwargs_deserializer(constructor, mapping):
     def f(obj):
         return constructor(**{
@@ -32,23 +81,130 @@ def deserialize_dict_values(d):
     }
 
 
+def deserialize_list(objs):
+    return [deserialize(obj) for obj in objs]
+
+
 def id(a):
     return a
 
 
+def resources(requirements):
+    """Requirements like `{'cpu': 2, 'mem': '4G'}`, memory in bytes"""
+    return {
+        name: parse_size(amount) if name == 'mem' else amount
+        for name, amount in requirements.items()
+    }
+
+
 deserializers = {
-    'sequence': list_deserializer(Sequence),
-    'alternative': list_deserializer(Alternative),
+    'sequence': sequence_deserializer,
+    'alternative': list_deserializer(Alternative, {
+        'jobs': id,
+    }),
     'parallelization': kwargs_deserializer(Parallelization, {
         'children': deserialize_dict_values,
+        'jobs': id,
+        'fail_fast': id,
     }),
     'repetition': kwargs_deserializer(Repetition, {
         'child': deserialize,
         'exit': deserialize,
+        'speculative': id,
+    }),
+    'map': kwargs_deserializer(Map, {
+        'child': deserialize,
+        'lines': id,
+        'size': parse_size,
+        'jobs': id,
     }),
     'command': kwargs_deserializer(SimpleCommand, {
         'command': id,
         'pass_stdin': id,
         'capture_stdout': id,
+        'cacheable': id,
+        'max_output_bytes': parse_size,
+        'resources': resources,
+        'timeout': id,
+        'hedge': id,
+    }),
+    'pipeline': kwargs_deserializer(Pipeline, {
+        'commands': deserialize_list,
+    }),
+}
+
+
+def serialize(pattern):
+    """Inverse of `deserialize`. Raises `TypeError` for unknown patterns."""
+    try:
+        serializer = serializers[type(pattern)]
+    except KeyError:
+        raise TypeError('can\'t serialize {!r}'.format(pattern)) from None
+    return serializer(pattern)
+
+
+def fields_serializer(type_name, mapping, defaults={}):
+    """Serialize attributes in `mapping`, omitting those equal to their `defaults`"""
+    def f(pattern):
+        obj = {'type': type_name}
+        for k, serialize_field in mapping.items():
+            value = getattr(pattern, k)
+            if k in defaults and value == defaults[k]:
+                continue
+            obj[k] = serialize_field(value)
+        return obj
+    return f
+
+
+def serialize_list(patterns):
+    return [serialize(pattern) for pattern in patterns]
+
+
+def serialize_dict_values(d):
+    return {
+        k: serialize(v)
+        for k, v in d.items()
+    }
+
+
+serializers = {
+    Sequence: fields_serializer('sequence', {
+        'children': serialize_list,
+    }),
+    Alternative: fields_serializer('alternative', {
+        'children': serialize_list,
+        'jobs': id,
+    }, {'jobs': None}),
+    Parallelization: fields_serializer('parallelization', {
+        'children': serialize_dict_values,
+        'jobs': id,
+        'fail_fast': id,
+    }, {'jobs': None, 'fail_fast': False}),
+    Repetition: fields_serializer('repetition', {
+        'child': serialize,
+        'exit': serialize,
+        'speculative': id,
+    }, {'speculative': False}),
+    Map: fields_serializer('map', {
+        'child': serialize,
+        'lines': id,
+        'size': id,
+        'jobs': id,
+    }, {'lines': None, 'size': None, 'jobs': None}),
+    SimpleCommand: fields_serializer('command', {
+        'command': id,
+        'pass_stdin': id,
+        'capture_stdout': id,
+        'cacheable': id,
+        'max_output_bytes': id,
+        'resources': id,
+        'timeout': id,
+        'hedge': id,
+    }, {
+        'pass_stdin': False, 'capture_stdout': False, 'cacheable': False,
+        'max_output_bytes': None, 'resources': None, 'timeout': None, 'hedge': None,
+    }),
+    Pipeline: fields_serializer('pipeline', {
+        'commands': serialize_list,
     }),
 }
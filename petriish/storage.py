@@ -0,0 +1,293 @@
+import asyncio
+import contextlib
+import contextvars
+import mmap
+import os
+import re
+import tempfile
+import threading
+
+from . import tracing
+
+
+_spill_threshold = contextvars.ContextVar('petriish_spill_threshold', default=None)
+
+_size_suffixes = {'': 1, 'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30, 'T': 2 ** 40}
+
+
+def parse_size(size):
+    """Parse size like 4096, '512K' or '4G' into number of bytes"""
+    if isinstance(size, int):
+        return size
+    match = re.fullmatch(r'\s*(\d+)\s*([KMGT]?)i?B?\s*', str(size), re.IGNORECASE)
+    if match is None:
+        raise ValueError('invalid size {!r}'.format(size))
+    return int(match.group(1)) * _size_suffixes[match.group(2).upper()]
+
+
+def current_spill_threshold():
+    return _spill_threshold.get()
+
+
+@contextlib.contextmanager
+def spill_threshold(size):
+    """Spill captured outputs larger than `size` bytes to temp files inside the block.
+
+    `None` keeps everything in memory.
+    """
+    token = _spill_threshold.set(size)
+    try:
+        yield
+    finally:
+        _spill_threshold.reset(token)
+
+
+class SpilledBytes:
+    """Bytes value kept in an (unlinked) temp file and mapped into memory.
+
+    Compares equal to `bytes` with the same content. Commands reading it
+    on stdin get a descriptor of the file where the platform allows
+    reopening it (Linux), so the data doesn't go through petriish at all.
+    Elsewhere it's fed to them through a pipe.
+    """
+
+    def __init__(self, file):
+        self._file = file
+        self._view = None
+
+    @classmethod
+    def of(cls, data):
+        """Copy bytes-like `data` to a memory file (a temp file where there are none)"""
+        if hasattr(os, 'memfd_create'):
+            f = open(os.memfd_create('petriish'), 'w+b')
+        else:
+            f = tempfile.TemporaryFile()
+        f.write(data)
+        f.flush()
+        return cls(f)
+
+    def fileno(self):
+        return self._file.fileno()
+
+    def open(self):
+        """Return new read-only descriptor of the data, with its own offset.
+
+        None where the file can't be reopened, as it's only there in
+        /proc. Feed `view` to readers through a pipe then.
+        """
+        try:
+            return os.open('/proc/self/fd/{}'.format(self.fileno()), os.O_RDONLY)
+        except FileNotFoundError:
+            return None
+
+    @property
+    def view(self):
+        """Read-only memoryview of the data"""
+        if self._view is None:
+            self._view = memoryview(mmap.mmap(self.fileno(), 0, access=mmap.ACCESS_READ))
+        return self._view
+
+    def __len__(self):
+        return os.fstat(self.fileno()).st_size
+
+    def __bytes__(self):
+        return self.view.tobytes()
+
+    def __eq__(self, other):
+        if isinstance(other, SpilledBytes):
+            other = other.view
+        if not isinstance(other, (bytes, bytearray, memoryview)):
+            return NotImplemented
+        return self.view == other
+
+    def __hash__(self):
+        return hash(bytes(self))
+
+    def __repr__(self):
+        return 'SpilledBytes(<{} bytes>)'.format(len(self))
+
+
+def load(path):
+    """Read a file as `bytes`, or as `SpilledBytes` if it's over the spill threshold.
+
+    Spilled value keeps the file open, so it stays valid even when the
+    file gets unlinked. Only use it for files that aren't modified in place.
+    """
+    f = open(path, 'rb')
+    threshold = current_spill_threshold()
+    if threshold is not None and os.fstat(f.fileno()).st_size > threshold:
+        return SpilledBytes(f)
+    with f:
+        return f.read()
+
+
+def store(path, data):
+    """Write bytes-like value or `SpilledBytes` to a file, atomically.
+
+    Data goes to a temp file renamed over `path`, so readers never see a
+    partially written file.
+    """
+    if isinstance(data, SpilledBytes):
+        data = data.view
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp')
+    try:
+        with open(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class OutputLimitExceeded(Exception):
+    """Captured output got over the limit of its node"""
+
+
+class OutputBudget:
+    """Memory shared by outputs being captured, in bytes.
+
+    Buffers report what they hold in memory. While that's over `size`
+    their readers pause, leaving data in the pipes - so the commands
+    block writing. The oldest buffer never pauses, so there's always
+    one making progress and eventually releasing its share. `None` size
+    doesn't limit anything, just counts.
+    """
+
+    def __init__(self, size=None):
+        self.size = size
+        self.used = 0
+        self._condition = threading.Condition()
+        self._buffers = {}  # buffer -> bytes, oldest first
+        self._waiters = set()  # callbacks waking paused asyncio readers
+
+    def _may_read(self, buffer):
+        return self.size is None or self.used < self.size or next(iter(self._buffers), buffer) is buffer
+
+    def charge(self, buffer, size):
+        with self._condition:
+            self._buffers[buffer] = self._buffers.get(buffer, 0) + size
+            self.used += size
+            used = self.used
+        tracing.sample('buffered output', used)
+
+    def release(self, buffer):
+        with self._condition:
+            size = self._buffers.pop(buffer, None)
+            if size is None:
+                return
+            self.used -= size
+            used = self.used
+            self._condition.notify_all()
+            waiters = list(self._waiters)
+        for wake in waiters:
+            wake()
+        tracing.sample('buffered output', used)
+
+    def wake(self):
+        """Make paused readers check again whether they are `interrupted`"""
+        with self._condition:
+            self._condition.notify_all()
+
+    def wait(self, buffer, interrupted=None):
+        """Block while `buffer` mustn't read more, unless `interrupted()` gets true.
+
+        Call `wake` once it does.
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: (interrupted is not None and interrupted()) or self._may_read(buffer))
+
+    async def wait_async(self, buffer):
+        loop = asyncio.get_running_loop()
+        while True:
+            woken = loop.create_future()
+
+            def wake():
+                loop.call_soon_threadsafe(lambda: woken.done() or woken.set_result(None))
+
+            with self._condition:
+                if self._may_read(buffer):
+                    return
+                self._waiters.add(wake)
+            try:
+                await woken
+            finally:
+                with self._condition:
+                    self._waiters.discard(wake)
+
+
+_output_budget = contextvars.ContextVar('petriish_output_budget', default=OutputBudget())
+
+
+def current_output_budget():
+    return _output_budget.get()
+
+
+@contextlib.contextmanager
+def output_budget(size):
+    """Pause capturing outputs once they take over `size` bytes of memory together.
+
+    `None` lifts the limit.
+    """
+    token = _output_budget.set(OutputBudget(size))
+    try:
+        yield _output_budget.get()
+    finally:
+        _output_budget.reset(token)
+
+
+class OutputBuffer:
+    """Collects output in memory, moving it to a temp file once it's too large.
+
+    Data held in memory counts towards the current `OutputBudget` until
+    `getvalue` (or `release`). Writing more than `limit` bytes in total
+    raises `OutputLimitExceeded`.
+    """
+
+    def __init__(self, limit=None):
+        self.threshold = current_spill_threshold()
+        self.limit = limit
+        self.budget = current_output_budget()
+        self._chunks = []
+        self._size = 0
+        self._file = None
+
+    def write(self, chunk):
+        self._size += len(chunk)
+        if self.limit is not None and self._size > self.limit:
+            self.release()
+            raise OutputLimitExceeded('output is over {} bytes'.format(self.limit))
+        if self._file is not None:
+            self._file.write(chunk)
+            return
+        self._chunks.append(chunk)
+        self.budget.charge(self, len(chunk))
+        if self.threshold is not None and self._size > self.threshold:
+            self._file = tempfile.TemporaryFile()
+            self._file.writelines(self._chunks)
+            self._chunks = None
+            self.budget.release(self)
+
+    def _unlimited(self):
+        # spilled data isn't in memory
+        return self._file is not None or self.budget.size is None
+
+    def wait(self, interrupted=None):
+        """Block while the budget doesn't allow reading more, see `OutputBudget.wait`"""
+        if not self._unlimited():
+            self.budget.wait(self, interrupted)
+
+    async def wait_async(self):
+        if not self._unlimited():
+            await self.budget.wait_async(self)
+
+    def release(self):
+        """Stop counting held data towards the budget"""
+        self.budget.release(self)
+
+    def getvalue(self):
+        """Return collected data - `bytes` or `SpilledBytes`"""
+        self.release()
+        if self._file is None:
+            return b''.join(self._chunks)
+        self._file.flush()
+        return SpilledBytes(self._file)
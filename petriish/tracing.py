@@ -0,0 +1,128 @@
+import asyncio
+import contextvars
+import json
+import os
+import threading
+import time
+
+from . import Interceptor, current_path, format_path
+
+
+_span = contextvars.ContextVar('petriish_span', default=None)
+
+
+def annotate(**details):
+    """Attach details to the span of the node being executed, if it's traced"""
+    span = _span.get()
+    if span is not None:
+        span.details.update(details)
+
+
+def sample(name, value):
+    """Record current value of a counter, like bytes in memory, if traced"""
+    span = _span.get()
+    if span is not None:
+        span.samples.append((name, time.perf_counter(), value))
+
+
+def tracing():
+    """Whether the node being executed is traced"""
+    return _span.get() is not None
+
+
+class Span:
+    """Execution of a single node"""
+
+    def __init__(self, pattern, path, lane):
+        self.type = type(pattern).__name__
+        self.path = path
+        self.pid = os.getpid()
+        self.lane = lane
+        self.start = time.perf_counter()
+        self.end = None
+        self.success = None
+        self.details = {}
+        self.samples = []
+
+    @property
+    def name(self):
+        return '{} {}'.format(self.type, format_path(self.path))
+
+
+class Tracer(Interceptor):
+    """Records a `Span` for every executed node.
+
+    Spans of a thread (or, in asyncio engine, of a task) form a proper
+    nesting, so they are laid out on lanes named after them. Leaf
+    patterns add details like exit codes, bytes in and out, and
+    resource usage of their processes.
+    """
+
+    def __init__(self):
+        self.spans = []
+        self.origin = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def execute(self, pattern, input, proceed):
+        span = Span(pattern, current_path(), ('thread', threading.get_ident()))
+        token = _span.set(span)
+        try:
+            result = proceed(input)
+        finally:
+            _span.reset(token)
+            self._finish(span)
+        span.success = result.success
+        return result
+
+    async def execute_async(self, pattern, input, proceed):
+        span = Span(pattern, current_path(), ('task', id(asyncio.current_task())))
+        token = _span.set(span)
+        try:
+            result = await proceed(input)
+        finally:
+            _span.reset(token)
+            self._finish(span)
+        span.success = result.success
+        return result
+
+    def _finish(self, span):
+        span.end = time.perf_counter()
+        with self._lock:
+            self.spans.append(span)
+
+    def chrome_trace(self):
+        """Spans in Chrome trace event format (chrome://tracing, Perfetto)"""
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span.start)
+        lanes = {}
+        events = []
+        for span in spans:
+            if span.lane not in lanes:
+                lanes[span.lane] = len(lanes) + 1
+                events.append({
+                    'name': 'thread_name', 'ph': 'M',
+                    'pid': span.pid, 'tid': lanes[span.lane],
+                    'args': {'name': '{} {}'.format(*span.lane)},
+                })
+            events.append({
+                'name': span.name,
+                'cat': span.type,
+                'ph': 'X',
+                'ts': (span.start - self.origin) * 1e6,
+                'dur': (span.end - span.start) * 1e6,
+                'pid': span.pid,
+                'tid': lanes[span.lane],
+                'args': dict(span.details, path=list(span.path), success=span.success),
+            })
+            events.extend({
+                'name': name,
+                'ph': 'C',
+                'ts': (at - self.origin) * 1e6,
+                'pid': span.pid,
+                'args': {'bytes': value},
+            } for name, at, value in span.samples)
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def export(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f)
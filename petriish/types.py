@@ -1,52 +1,100 @@
+import weakref
+
+
 class TypeResolutionError(Exception):
     pass
 
 
 class Resolver:
+    """Unification of types.
+
+    Polymorphic types form a union-find forest (with path compression
+    and union by rank), a root may be bound to a concrete type. Output
+    types of patterns are memoized per input type.
+    """
+
     @classmethod
     def is_polymorphic(cls, t):
         return isinstance(t, PolymorphicType)
 
     def __init__(self):
-        self._binds = {}  # dict polymorphic -> its best bind
+        self._parents = {}  # polymorphic -> polymorphic it was merged into
+        self._ranks = {}  # root polymorphic -> rank
+        self._binds = {}  # root polymorphic -> concrete type
+        self._output_types = {}  # (pattern id, input type) -> (pattern, output type)
+
+    def output_type(self, pattern, input_type):
+        """Output type of the pattern, computed once per input type"""
+        key = (id(pattern), input_type)
+        known = self._output_types.get(key)
+        if known is not None and known[0] is pattern:
+            return known[1]
+        output_type = pattern.output_type(self, input_type)
+        self._output_types[key] = (pattern, output_type)
+        return output_type
+
+    def _find(self, t):
+        root = t
+        while root in self._parents:
+            root = self._parents[root]
+        while t is not root:
+            self._parents[t], t = root, self._parents[t]
+        return root
 
     def unify(self, a, b):
-        if self.is_polymorphic(a):
+        a_polymorphic = isinstance(a, PolymorphicType)
+        b_polymorphic = isinstance(b, PolymorphicType)
+        if a_polymorphic:
+            a = self._find(a)
+        if b_polymorphic:
+            b = self._find(b)
+        if a is b:
+            return self._binds.get(a, a) if a_polymorphic else a
+
+        if a_polymorphic:
+            if b_polymorphic:
+                return self._union(a, b)
             return self._bind(a, b)
 
-        if self.is_polymorphic(b):
+        if b_polymorphic:
             return self._bind(b, a)
 
         return a.unify_with(self, b)
 
-    def _bind(self, polymorphic_type, value_type):
-        assert self.is_polymorphic(polymorphic_type)
-
-        if self.is_polymorphic(value_type):
-            if polymorphic_type == value_type:
-                return polymorphic_type
-
-            # always bind larger one to smaller one
-            if id(polymorphic_type) < id(value_type):
-                polymorphic_type, value_type = value_type, polymorphic_type
-
-        if polymorphic_type in self._binds:
-            self._binds[polymorphic_type] = self.unify(self._binds[polymorphic_type], value_type)
+    def unify_all(self, types):
+        """Unify all the types together. No types at all unify to anything."""
+        unified = PolymorphicType()
+        for t in types:
+            unified = self.unify(unified, t)
+        return unified
+
+    def _union(self, a, b):
+        if self._ranks.get(a, 0) < self._ranks.get(b, 0):
+            a, b = b, a
+        elif self._ranks.get(a, 0) == self._ranks.get(b, 0):
+            self._ranks[a] = self._ranks.get(a, 0) + 1
+        self._parents[b] = a
+        self._ranks.pop(b, None)
+        if b in self._binds:
+            return self._bind(a, self._binds.pop(b))
+        return self._binds.get(a, a)
+
+    def _bind(self, root, value_type):
+        if root in self._binds:
+            self._binds[root] = self.unify(self._binds[root], value_type)
         else:
-            if polymorphic_type in value_type.polymorphic_set:
+            if any(self._find(t) is root for t in value_type.polymorphic_set):
                 raise TypeResolutionError('couldnt make recursive bind {} = {}'.format(
-                    polymorphic_type, value_type,
+                    root, value_type,
                 ))
-            self._binds[polymorphic_type] = value_type
-
-        return self._binds[polymorphic_type]
+            self._binds[root] = value_type
+        return self._binds[root]
 
     def get_best_bind(self, t):
-        if t in self._binds:
-            self._binds[t] = self.get_best_bind(self._binds[t])
-            return self._binds[t]
-        else:
+        if not self.is_polymorphic(t):
             return t
+        root = self._find(t)
+        return self._binds.get(root, root)
 
 
 class Type:
@@ -65,20 +113,43 @@ class PolymorphicType(Type):
 
     @property
     def polymorphic_set(self):
-        return set([self])
+        return frozenset([self])
 
 
 class Record(Type):
+    """Record type. Instances are interned - equal records are the same object."""
+
+    _instances = weakref.WeakValueDictionary()
+
+    def __new__(cls, fields={}):
+        if not fields and '_empty' in cls.__dict__:
+            return cls._empty
+        key = (cls, frozenset(fields.items()))
+        record = cls._instances.get(key)
+        if record is None:
+            record = super().__new__(cls)
+            record.fields = dict(fields)
+            record._polymorphic_set = None
+            cls._instances[key] = record
+            if not fields:
+                # by far the most common one, kept for good
+                cls._empty = record
+        return record
+
     def __init__(self, fields={}):
-        self.fields = fields
+        pass  # initialized once, by __new__
 
     def unify_with(self, resolver, other):
         if not isinstance(other, self.__class__):
             raise TypeResolutionError('cannot unify {} with {}'.format(
                 self, other,
             ))
+        if self is other and not self.polymorphic_set:
+            return self
         if self.fields.keys() != other.fields.keys():
-            raise TypeResolutionError()
+            raise TypeResolutionError('cannot unify {} with {}'.format(
+                self, other,
+            ))
         return Record({
             k: resolver.unify(v, other.fields[k])
             for k, v in self.fields.items()
@@ -86,36 +157,45 @@ class Record(Type):
 
     @property
     def polymorphic_set(self):
-        s = set()
-        for v in self.fields.values():
-            s.update(v.polymorphic_set)
-        return s
+        if self._polymorphic_set is None:
+            self._polymorphic_set = frozenset().union(*(
+                v.polymorphic_set for v in self.fields.values()
+            ))
+        return self._polymorphic_set
 
     def __eq__(self, other):
-        return isinstance(other, self.__class__) and self.fields == other.fields
+        return self is other or (isinstance(other, self.__class__) and self.fields == other.fields)
 
-    def __hash__(self):
-        return hash(tuple(self.fields.items()))
+    # equal records are the same object
+    __hash__ = Type.__hash__
 
     def __repr__(self):
         return 'Record({})'.format(repr(self.fields))
 
 
 class Bytes(Type):
+    """Bytes type, there's just one instance"""
+
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+        return cls._instance
+
     def unify_with(self, resolver, other):
         if not isinstance(other, self.__class__):
-            raise TypeError('cannot unify {} with {}'.format(self, other))
+            raise TypeResolutionError('cannot unify {} with {}'.format(self, other))
         return self
 
     @property
     def polymorphic_set(self):
-        return set()
+        return frozenset()
 
     def __eq__(self, other):
         return isinstance(other, self.__class__)
 
-    def __hash__(self):
-        return hash(self.__class__)
+    __hash__ = Type.__hash__
 
     def __repr__(self):
         return 'Bytes()'
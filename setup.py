@@ -16,6 +16,7 @@ setup(
     py_modules=['petriish'],
     scripts=[
         'bin/petriish',
+        'bin/petriish-submit',
     ],
     install_requires=[
         'pyyaml',
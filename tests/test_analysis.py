@@ -0,0 +1,131 @@
+import json
+import os
+import tempfile
+from unittest import TestCase
+
+import petriish
+from petriish.analysis import History, analyze, priorities
+from petriish.patterns.posix import SimpleCommand
+from petriish.tracing import Tracer
+
+
+def command(name, capture_stdout=False):
+    return SimpleCommand([name], capture_stdout=capture_stdout)
+
+
+class AnalysisTestCase(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def journal(self, entries):
+        path = os.path.join(self.directory, 'journal')
+        with open(path, 'w') as f:
+            for entry_path, duration in entries:
+                f.write(json.dumps({'path': entry_path, 'duration': duration}) + '\n')
+        history = History()
+        history.load_journal(path)
+        return history
+
+    def test_defaults(self):
+        pattern = petriish.Sequence([
+            petriish.Parallelization({'a': command('a'), 'b': command('b')}),
+            command('c'),
+        ])
+        estimate, unknown = analyze(pattern, default_duration=2.0)
+        self.assertEqual(estimate.makespan, 4.0)
+        self.assertEqual(estimate.work, 6.0)
+        self.assertEqual(estimate.concurrency, 2)
+        self.assertEqual(estimate.parallelism, 1.5)
+        self.assertEqual(sorted(unknown), [(0, 'a'), (0, 'b'), (1,)])
+
+    def test_critical_path(self):
+        pattern = petriish.Sequence([
+            petriish.Parallelization({'a': command('a'), 'b': command('b')}),
+            petriish.Alternative([command('c'), command('d')]),
+        ])
+        history = self.journal([
+            [[0, 'a'], 3.0], [[0, 'b'], 1.0],
+            [[1, 0], 1.0], [[1, 1], 2.0],
+        ])
+        estimate, unknown = analyze(pattern, history)
+        self.assertEqual(unknown, [])
+        self.assertEqual(estimate.makespan, 5.0)
+        self.assertEqual(estimate.work, 7.0)
+        self.assertEqual(estimate.critical_path, [((0, 'a'), 'a', 3.0), ((1, 1), 'd', 2.0)])
+
+    def test_priorities(self):
+        pattern = petriish.Sequence([
+            petriish.Parallelization({'a': command('a'), 'b': petriish.Sequence([command('b'), command('c')])}),
+            petriish.Repetition(command('d'), command('e')),
+        ])
+        history = self.journal([
+            [[0, 'a'], 3.0], [[0, 'b', 0], 1.0], [[0, 'b', 1], 1.0],
+            [[1, [0], 'child'], 2.0], [[1, [1], 'child'], 2.0], [[1, [0], 'exit'], 1.0], [[1, [1], 'exit'], 1.0],
+        ])
+        self.assertEqual(priorities(pattern, history), {
+            (0, 'a'): 7.0,
+            (0, 'b', 0): 6.0,
+            (0, 'b', 1): 5.0,
+            (1, 'child'): 4.0,
+            (1, 'exit'): 3.0,
+        })
+
+    def test_jobs(self):
+        pattern = petriish.Parallelization({k: command(k) for k in 'abcd'}, jobs=2)
+        estimate, _ = analyze(pattern)
+        self.assertEqual(estimate.makespan, 2.0)
+        self.assertEqual(estimate.concurrency, 2)
+        estimate, _ = analyze(pattern, jobs=1)
+        self.assertEqual(estimate.makespan, 4.0)
+        self.assertEqual(estimate.concurrency, 1)
+
+    def test_repetition(self):
+        pattern = petriish.Repetition(child=command('child'), exit=command('exit'))
+        history = self.journal([
+            [[[0], 'child'], 1.0], [[[0], 'exit'], 0.5],
+            [[[1], 'child'], 3.0], [[[1], 'exit'], 0.5],
+            [[[2], 'child'], 1.0], [[[2], 'exit'], 2.0],
+        ])
+        estimate, _ = analyze(pattern, history)
+        self.assertEqual(estimate.makespan, 6.0)
+        self.assertEqual(estimate.concurrency, 2)
+
+    def test_children_named_like_repetition(self):
+        history = self.journal([[[0, 'child'], 1.0], [[1, 'exit'], 1.0]])
+        self.assertIsNone(history.iterations([]))
+
+    def test_trace_history(self):
+        pattern = petriish.Sequence([
+            SimpleCommand(['sh', '-c', 'sleep 0.1; printf %01000d 0'], capture_stdout=True),
+            SimpleCommand(['cat'], pass_stdin=True, capture_stdout=True),
+        ])
+        tracer = Tracer()
+        with petriish.intercept(tracer):
+            petriish.run_workflow_pattern(pattern, {})
+        path = os.path.join(self.directory, 'trace.json')
+        tracer.export(path)
+        history = History()
+        history.load_trace(path)
+
+        # commands are recognized by their command lines, wherever they are
+        moved = petriish.Parallelization({'x': pattern})
+        estimate, unknown = analyze(moved, history)
+        self.assertEqual(unknown, [])
+        self.assertGreaterEqual(estimate.makespan, 0.1)
+        self.assertLess(estimate.makespan, 1.0)
+        # output of the first step is held while the second produces a copy
+        self.assertEqual(estimate.memory, 2000)
+        self.assertEqual(estimate.output, 1000)
+
+    def test_percentile(self):
+        history = History()
+        sleep = command('sleep')
+        for duration in [5, 1, 4, 2, 3]:
+            self.assertIsNone(history.percentile([sleep], 50))
+            history.record([sleep], duration)
+        self.assertEqual(history.percentile([sleep], 50), 3)
+        self.assertEqual(history.percentile([sleep], 100), 5)
+        self.assertEqual(history.percentile([sleep], 0), 1)
+        self.assertIsNone(history.percentile([command('true')], 50))
@@ -0,0 +1,185 @@
+import contextlib
+import os
+import tempfile
+from unittest import TestCase, mock
+
+import petriish
+from petriish import cache, storage
+from petriish.patterns.posix import SimpleCommand
+from petriish.serialization import deserialize
+
+
+class ResultCacheTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.cache = cache.ResultCache(os.path.join(self.directory.name, 'cache'))
+        self.counter = os.path.join(self.directory.name, 'counter')
+
+    def counting_command(self, **kwargs):
+        """Command that leaves trace of every run in the counter file"""
+        return SimpleCommand(
+            ['sh', '-c', 'echo x >> {}; echo out'.format(self.counter)],
+            capture_stdout=True,
+            **kwargs
+        )
+
+    def runs(self):
+        with open(self.counter) as f:
+            return len(f.readlines())
+
+    def run_pattern(self, pattern, input={}, engine='threading'):
+        with cache.caching(self.cache):
+            return petriish.run_workflow_pattern(pattern, input, engine=engine)
+
+    def test_hit(self):
+        pattern = self.counting_command(cacheable=True)
+        for engine in petriish.engines:
+            with self.subTest(engine=engine):
+                result = self.run_pattern(pattern, engine=engine)
+                self.assertTrue(result.success)
+                self.assertEqual(result.output, b'out\n')
+        self.assertEqual(self.runs(), 1)
+        self.assertEqual((self.cache.hits, self.cache.misses), (len(petriish.engines) - 1, 1))
+
+    def test_not_cacheable(self):
+        pattern = self.counting_command()
+        self.run_pattern(pattern)
+        self.run_pattern(pattern)
+        self.assertEqual(self.runs(), 2)
+
+    def test_failure_not_cached(self):
+        pattern = SimpleCommand(['sh', '-c', 'echo x >> {}; false'.format(self.counter)], cacheable=True)
+        self.assertFalse(self.run_pattern(pattern).success)
+        self.assertFalse(self.run_pattern(pattern).success)
+        self.assertEqual(self.runs(), 2)
+
+    def test_keyed_on_input(self):
+        pattern = SimpleCommand(['tr', 'a', 'b'], pass_stdin=True, capture_stdout=True, cacheable=True)
+        self.assertEqual(self.run_pattern(pattern, b'aa').output, b'bb')
+        self.assertEqual(self.run_pattern(pattern, b'ab').output, b'bb')
+        self.assertEqual(self.run_pattern(pattern, b'aa').output, b'bb')
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 2))
+
+    def test_declared_dependencies(self):
+        dependency = os.path.join(self.directory.name, 'dependency')
+        pattern = self.counting_command(cacheable={'env': ['PETRIISH_TEST'], 'files': [dependency]})
+        with mock.patch.dict(os.environ, {'PETRIISH_TEST': 'a'}):
+            self.run_pattern(pattern)
+            self.run_pattern(pattern)
+        self.assertEqual(self.runs(), 1)
+        with mock.patch.dict(os.environ, {'PETRIISH_TEST': 'b'}):
+            self.run_pattern(pattern)
+            with open(dependency, 'w') as f:
+                f.write('changed')
+            self.run_pattern(pattern)
+        self.assertEqual(self.runs(), 3)
+
+    def test_eviction(self):
+        small = cache.ResultCache(self.cache.directory, max_size=100)
+        for i in range(5):
+            with cache.caching(small):
+                petriish.run_workflow_pattern(SimpleCommand(['seq', '20', str(20 + i)], capture_stdout=True, cacheable=True), {})
+        self.assertLessEqual(small.size, 100)
+        self.assertEqual(len(os.listdir(self.cache.directory)), 4)
+        self.assertEqual(cache.ResultCache(self.cache.directory).size, small.size)
+        # most recent entry survived
+        with cache.caching(small):
+            petriish.run_workflow_pattern(SimpleCommand(['seq', '20', '24'], capture_stdout=True, cacheable=True), {})
+        self.assertEqual(small.hits, 1)
+
+    def test_spilled_hit(self):
+        pattern = SimpleCommand(['seq', '1000'], capture_stdout=True, cacheable=True)
+        first = self.run_pattern(pattern).output
+        with storage.spill_threshold(100):
+            second = self.run_pattern(pattern).output
+        self.assertIsInstance(second, storage.SpilledBytes)
+        self.assertEqual(second, first)
+
+    def test_deserialize(self):
+        self.assertEqual(
+            deserialize({'type': 'command', 'command': ['true'], 'cacheable': {'env': ['HOME']}}),
+            SimpleCommand(['true'], cacheable={'env': ['HOME']}),
+        )
+
+    def test_hashable_declared_dependencies(self):
+        declared = {'env': ['HOME'], 'files': ['x']}
+        self.assertEqual(
+            hash(SimpleCommand(['true'], cacheable=declared)),
+            hash(SimpleCommand(['true'], cacheable=dict(declared))),
+        )
+
+
+class MemoizerTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.counter = os.path.join(self.directory.name, 'counter')
+
+    def counting_command(self, **kwargs):
+        return {
+            'type': 'command',
+            'command': ['sh', '-c', 'echo x >> {}; sleep 0.1; cat'.format(self.counter)],
+            'pass_stdin': True, 'capture_stdout': True,
+            **kwargs
+        }
+
+    def reset(self):
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.counter)
+
+    def runs(self):
+        try:
+            with open(self.counter) as f:
+                return len(f.readlines())
+        except FileNotFoundError:
+            return 0
+
+    def run_memoized(self, pattern, input, engine):
+        memoizer = cache.Memoizer()
+        with petriish.intercept(memoizer):
+            return petriish.run_workflow_pattern(pattern, input, engine=engine), memoizer
+
+    def test_identical_subtrees_run_once(self):
+        branch = {'type': 'sequence', 'children': [self.counting_command(cacheable=True)] * 2}
+        pattern = deserialize({'type': 'parallelization', 'children': {str(i): branch for i in range(3)}})
+        for engine in petriish.engines:
+            with self.subTest(engine=engine):
+                self.reset()
+                result, memoizer = self.run_memoized(pattern, b'in', engine)
+                self.assertTrue(result.success)
+                self.assertEqual(result.output, {str(i): b'in' for i in range(3)})
+                # the sequence once, its second command being a hit too
+                self.assertEqual(self.runs(), 1)
+                self.assertEqual(memoizer.hits, 3)
+
+    def test_keyed_on_input(self):
+        command = self.counting_command(cacheable=True)
+        pattern = deserialize({'type': 'parallelization', 'children': {
+            'a': command,
+            'b': {'type': 'sequence', 'children': [
+                {'type': 'command', 'command': ['echo', 'other'], 'pass_stdin': True, 'capture_stdout': True, 'cacheable': True},
+                command,
+            ]},
+        }})
+        result, _ = self.run_memoized(pattern, b'in', 'threading')
+        self.assertEqual(result.output, {'a': b'in', 'b': b'other\n'})
+        self.assertEqual(self.runs(), 2)
+
+    def test_impure_subtrees_always_run(self):
+        for command in [
+            self.counting_command(),
+            self.counting_command(cacheable={'files': ['/etc/hostname']}),
+        ]:
+            with self.subTest(command=command):
+                self.reset()
+                pattern = deserialize({'type': 'sequence', 'children': [command] * 2})
+                self.assertTrue(self.run_memoized(pattern, b'in', 'asyncio')[0].success)
+                self.assertEqual(self.runs(), 2)
+
+    def test_failure_not_memoized(self):
+        command = {'type': 'command', 'command': ['sh', '-c', 'echo x >> {}; false'.format(self.counter)], 'cacheable': True}
+        pattern = deserialize({'type': 'parallelization', 'children': {'a': command, 'b': command}})
+        result, memoizer = self.run_memoized(pattern, {}, 'threading')
+        self.assertFalse(result.success)
+        self.assertEqual(self.runs(), 2)
@@ -0,0 +1,182 @@
+import os
+import tempfile
+import threading
+import time
+from unittest import TestCase, mock
+
+import petriish
+from petriish import cancellation, scheduling
+from petriish.patterns import posix
+from petriish.patterns.posix import SimpleCommand
+
+
+class CancelScopeTestCase(TestCase):
+    def test_nested(self):
+        calls = []
+        with cancellation.scope() as outer:
+            with cancellation.scope() as inner:
+                with cancellation.on_cancel(lambda: calls.append('inner')):
+                    self.assertFalse(cancellation.cancelled())
+                    outer.cancel()
+                    self.assertTrue(inner.cancelled)
+                    self.assertTrue(cancellation.cancelled())
+        self.assertEqual(calls, ['inner'])
+        self.assertIsNone(cancellation.current())
+
+    def test_callback_after_cancel(self):
+        calls = []
+        scope = cancellation.CancelScope()
+        scope.cancel()
+        scope.add_callback(lambda: calls.append('late'))
+        self.assertEqual(calls, ['late'])
+
+    def test_closed_scope_detaches(self):
+        outer = cancellation.CancelScope()
+        inner = cancellation.CancelScope(parent=outer)
+        inner.close()
+        outer.cancel()
+        self.assertFalse(inner.cancelled)
+
+    def test_limiter_wait(self):
+        limiter = scheduling.Limiter(1)
+        limiter.acquire()
+        with cancellation.scope() as scope:
+            threading.Timer(0.05, scope.cancel).start()
+            with self.assertRaises(cancellation.Cancelled):
+                limiter.acquire()
+        limiter.release()
+        limiter.acquire()
+
+
+class ShortCircuitTestCase(TestCase):
+    def run_timed(self, pattern, engine):
+        start = time.monotonic()
+        result = petriish.run_workflow_pattern(pattern, {}, engine=engine)
+        return result, time.monotonic() - start
+
+    def test_alternative_two_successes(self):
+        pattern = petriish.Alternative([
+            SimpleCommand('true'),
+            SimpleCommand(['sleep', '10']),
+            SimpleCommand('true'),
+        ])
+        for engine in petriish.engines:
+            with self.subTest(engine=engine):
+                result, elapsed = self.run_timed(pattern, engine)
+                self.assertFalse(result.success)
+                self.assertLess(elapsed, 5)
+
+    def test_kills_process_group(self):
+        pattern = petriish.Alternative([
+            SimpleCommand('true'),
+            SimpleCommand(['sh', '-c', 'sleep 10; true']),
+            petriish.Sequence([SimpleCommand(['sleep', '0.1']), SimpleCommand('true')]),
+        ])
+        for engine in petriish.engines:
+            with self.subTest(engine=engine):
+                result, elapsed = self.run_timed(pattern, engine)
+                self.assertFalse(result.success)
+                self.assertLess(elapsed, 5)
+
+    @mock.patch.object(posix, 'TERMINATION_GRACE_PERIOD', 0.2)
+    def test_kill_after_grace_period(self):
+        pattern = petriish.Alternative([
+            SimpleCommand('true'),
+            SimpleCommand(['sh', '-c', 'trap "" TERM; sleep 10']),
+            SimpleCommand('true'),
+        ])
+        for engine in petriish.engines:
+            with self.subTest(engine=engine):
+                result, elapsed = self.run_timed(pattern, engine)
+                self.assertFalse(result.success)
+                self.assertLess(elapsed, 5)
+
+    def test_cancel_whole_run(self):
+        pattern = petriish.Repetition(
+            child=SimpleCommand(['sleep', '0.05']),
+            exit=SimpleCommand('false'),
+        )
+        for engine in petriish.engines:
+            with self.subTest(engine=engine):
+                with cancellation.scope() as scope:
+                    threading.Timer(0.2, scope.cancel).start()
+                    result, elapsed = self.run_timed(pattern, engine)
+                self.assertFalse(result.success)
+                self.assertLess(elapsed, 5)
+
+
+class FailFastTestCase(TestCase):
+    def test_cancels_siblings(self):
+        pattern = petriish.Parallelization({
+            'a': SimpleCommand(['sleep', '10']),
+            'b': SimpleCommand('false'),
+            'c': petriish.Sequence([SimpleCommand('true'), SimpleCommand(['sleep', '10'])]),
+        }, fail_fast=True)
+        for engine in petriish.engines:
+            with self.subTest(engine=engine):
+                start = time.monotonic()
+                with self.assertLogs('petriish', 'INFO') as logs:
+                    result = petriish.run_workflow_pattern(pattern, {}, engine=engine)
+                self.assertFalse(result.success)
+                self.assertLess(time.monotonic() - start, 5)
+                self.assertTrue(any(
+                    'outcome known after 1 of 3 patterns' in line
+                    for line in logs.output
+                ))
+
+    def test_waits_without_failure(self):
+        pattern = petriish.Parallelization({
+            'a': SimpleCommand(['sh', '-c', 'sleep 0.1; echo a'], capture_stdout=True),
+            'b': SimpleCommand(['echo', 'b'], capture_stdout=True),
+        }, fail_fast=True)
+        for engine in petriish.engines:
+            with self.subTest(engine=engine):
+                result = petriish.run_workflow_pattern(pattern, {}, engine=engine)
+                self.assertTrue(result.success)
+                self.assertEqual(result.output, {'a': b'a\n', 'b': b'b\n'})
+
+
+class SpeculativeRepetitionTestCase(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.log = os.path.join(directory.name, 'log')
+
+    def test_overlaps_iterations(self):
+        pattern = petriish.Repetition(
+            child=SimpleCommand(
+                ['sh', '-c', 'n=$(cat); echo child $n >> {}; test $n -lt 3 && echo $((n + 1))'.format(self.log)],
+                pass_stdin=True, capture_stdout=True,
+            ),
+            exit=SimpleCommand(
+                ['sh', '-c', 'n=$(cat); sleep 0.1; echo exit $n >> {}; test $n -ge 3 && echo done'.format(self.log)],
+                pass_stdin=True, capture_stdout=True,
+            ),
+            speculative=True,
+        )
+        for engine in petriish.engines:
+            with self.subTest(engine=engine):
+                open(self.log, 'w').close()
+                result = petriish.run_workflow_pattern(pattern, b'0', engine=engine)
+                self.assertTrue(result.success)
+                self.assertEqual(result.output, b'done\n')
+                with open(self.log) as f:
+                    log = f.read().splitlines()
+                self.assertLess(log.index('child 1'), log.index('exit 0'))
+                self.assertEqual(log.count('exit 3'), 1)
+
+    def test_cancels_speculation(self):
+        pattern = petriish.Repetition(
+            child=SimpleCommand(
+                ['sh', '-c', 'n=$(cat); test $n -ge 1 && sleep 10; echo $((n + 1))'],
+                pass_stdin=True, capture_stdout=True,
+            ),
+            exit=SimpleCommand(['sleep', '0.1']),
+            speculative=True,
+        )
+        for engine in petriish.engines:
+            with self.subTest(engine=engine):
+                start = time.monotonic()
+                result = petriish.run_workflow_pattern(pattern, b'0', engine=engine)
+                self.assertFalse(result.success)
+                self.assertLess(time.monotonic() - start, 5)
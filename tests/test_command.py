@@ -1,4 +1,6 @@
 from unittest import TestCase
+import os
+import signal
 import subprocess
 import tempfile
 
@@ -29,3 +31,31 @@ class PetriishCommandTestCase(TestCase):
                 sorted(result.stdout.split(b'\n')),
                 [b'', b'aaa', b'bbb'],
             )
+
+    def test_interrupted(self):
+        with tempfile.NamedTemporaryFile('w+t') as f:
+            f.write("type: parallelization\nchildren:\n  a: {type: command, command: [sleep, '30']}\n")
+            f.flush()
+            process = subprocess.Popen(['bin/petriish', '-v', f.name], stderr=subprocess.PIPE)
+            with process.stderr:
+                for line in process.stderr:
+                    if b'starting' in line:
+                        break
+                process.send_signal(signal.SIGINT)
+                self.assertEqual(process.wait(timeout=10), 1)
+
+    def test_commands(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'analyze')
+            with open(path, 'w') as f:
+                f.write("type: command\ncommand: [echo, aaa]\n")
+            petriish = os.path.abspath('bin/petriish')
+            for command, output in [
+                (['run', 'analyze'], b'aaa\n'),
+                (['-v', 'analyze', 'analyze'], b'Expected makespan'),
+                (['-e', 'asyncio', 'analyze'], b'aaa\n'),
+            ]:
+                with self.subTest(command=command):
+                    result = subprocess.run([petriish] + command, cwd=directory, stdout=subprocess.PIPE, env=dict(os.environ, PYTHONPATH=os.getcwd()))
+                    self.assertEqual(result.returncode, 0)
+                    self.assertTrue(result.stdout.startswith(output))
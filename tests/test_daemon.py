@@ -0,0 +1,117 @@
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+from petriish import daemon
+from petriish.patterns.posix import SimpleCommand
+
+
+class DaemonTestCase(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.address = self.start('daemon.sock', '--jobs', '1')
+
+    def start(self, name, *options):
+        address = os.path.join(self.directory, name)
+        env = dict(os.environ, PYTHONPATH=os.getcwd())
+        process = subprocess.Popen([sys.executable, 'bin/petriish', '--daemon', address] + list(options), env=env)
+        self.addCleanup(self.stop, process)
+        deadline = time.monotonic() + 10
+        while not os.path.exists(address):
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+        return address
+
+    def stop(self, process):
+        process.send_signal(signal.SIGTERM)
+        process.wait(timeout=10)
+
+    def workflow(self, text):
+        path = os.path.join(self.directory, 'workflow.yml')
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def test_description(self):
+        statuses = []
+        os.environ['PETRIISH_TEST'] = 'from client'
+        self.addCleanup(os.environ.pop, 'PETRIISH_TEST')
+        result = daemon.submit(self.address, b'\n'.join([
+            b'type: command',
+            b'command: [sh, -c, "pwd; echo $PETRIISH_TEST"]',
+            b'capture_stdout: true',
+        ]), on_status=lambda reply: statuses.append(reply['status']))
+        self.assertTrue(result.success)
+        self.assertEqual(result.output, '{}\nfrom client\n'.format(os.getcwd()).encode())
+        self.assertEqual(statuses, ['accepted', 'running', 'finished'])
+
+    def test_pattern(self):
+        pattern = SimpleCommand(['tr', 'a-z', 'A-Z'], pass_stdin=True, capture_stdout=True)
+        result = daemon.submit(self.address, pattern, input=b'abc')
+        self.assertEqual(result.output, b'ABC')
+        self.assertFalse(daemon.submit(self.address, SimpleCommand('false'), input={}).success)
+
+    def test_error(self):
+        with self.assertRaises(RuntimeError):
+            daemon.submit(self.address, b'type: nonexistent')
+
+    def test_engines(self):
+        pattern = SimpleCommand(['tr', 'a-z', 'A-Z'], pass_stdin=True, capture_stdout=True)
+        for engine in ['asyncio', 'plan']:
+            with self.subTest(engine=engine):
+                self.assertEqual(daemon.submit(self.address, pattern, input=b'abc', engine=engine).output, b'ABC')
+        # daemon's own engine, runs at once
+        address = self.start('plan.sock', '--engine', 'plan')
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(daemon.submit(address, pattern, input=b'abc'))) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([result.output for result in results], [b'ABC', b'ABC'])
+
+    def test_unknown_engine(self):
+        with self.assertRaisesRegex(RuntimeError, 'unknown engine'):
+            daemon.submit(self.address, SimpleCommand('true'), engine='nonexistent')
+
+    def test_crashed_run(self):
+        statuses = []
+        with self.assertRaisesRegex(RuntimeError, 'FileNotFoundError'):
+            daemon.submit(self.address, SimpleCommand(os.path.join(self.directory, 'nonexistent')), on_status=lambda reply: statuses.append(reply['status']))
+        self.assertEqual(statuses, ['accepted', 'running', 'error'])
+
+    def test_shared_limit(self):
+        pattern = SimpleCommand(['sleep', '0.3'])
+        start = time.monotonic()
+        threads = [threading.Thread(target=daemon.submit, args=(self.address, pattern)) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # daemon runs with --jobs 1
+        self.assertGreaterEqual(time.monotonic() - start, 0.6)
+
+    def test_client(self):
+        path = self.workflow('type: sequence\nchildren:\n  - {type: command, command: [echo, aaa]}\n')
+        result = subprocess.run(['bin/petriish-submit', self.address, path], stdout=subprocess.PIPE)
+        self.assertEqual(result.returncode, 0)
+        self.assertEqual(result.stdout, b'aaa\n')
+
+        path = self.workflow('type: command\ncommand: "false"\n')
+        self.assertEqual(subprocess.run(['bin/petriish-submit', self.address, path]).returncode, 1)
+
+    def test_client_interrupted(self):
+        path = self.workflow('type: command\ncommand: [sleep, "30"]\n')
+        client = subprocess.Popen(['bin/petriish-submit', '-v', self.address, path], stderr=subprocess.PIPE)
+        self.assertEqual(client.stderr.readline(), b'petriish-submit: accepted\n')
+        self.assertEqual(client.stderr.readline(), b'petriish-submit: running\n')
+        client.send_signal(signal.SIGINT)
+        self.assertEqual(client.wait(timeout=10), 1)
+        client.stderr.close()
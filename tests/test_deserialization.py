@@ -1,8 +1,8 @@
 from unittest import TestCase
 
 import petriish
-from petriish.serialization import deserialize
-from petriish.patterns.posix import SimpleCommand
+from petriish.serialization import deserialize, serialize
+from petriish.patterns.posix import Pipeline, SimpleCommand
 
 
 class DeserializationTestCase(TestCase):
@@ -67,3 +67,99 @@ class DeserializationTestCase(TestCase):
                 capture_stdout=False,
             ),
         )
+
+    def test_deserialize_speculative_repetition(self):
+        self.assertEqual(
+            deserialize({
+                'type': 'repetition',
+                'child': {'type': 'sequence', 'children': []},
+                'exit': {'type': 'sequence', 'children': []},
+                'speculative': True,
+            }),
+            petriish.Repetition(
+                child=petriish.Sequence([]),
+                exit=petriish.Sequence([]),
+                speculative=True,
+            ),
+        )
+
+    def test_deserialize_fail_fast_parallelization(self):
+        self.assertEqual(
+            deserialize({
+                'type': 'parallelization',
+                'children': {},
+                'fail_fast': True,
+            }),
+            petriish.Parallelization({}, fail_fast=True),
+        )
+
+
+class SharingTestCase(TestCase):
+    def test_identical_subtrees_are_shared(self):
+        command = {'type': 'command', 'command': ['echo', 'a'], 'capture_stdout': True}
+        branch = {'type': 'sequence', 'children': [command, {'type': 'alternative', 'children': [command]}]}
+        pattern = deserialize({'type': 'parallelization', 'children': {'a': branch, 'b': branch}})
+        a, b = pattern.children['a'], pattern.children['b']
+        self.assertIs(a, b)
+        self.assertIs(a.children[0], a.children[1].children[0])
+        self.assertEqual(hash(a.children[0]), hash(SimpleCommand(['echo', 'a'], capture_stdout=True)))
+
+    def test_different_subtrees_are_not(self):
+        pattern = deserialize({'type': 'sequence', 'children': [
+            {'type': 'command', 'command': ['true']},
+            {'type': 'command', 'command': ['true'], 'pass_stdin': True},
+            {'type': 'command', 'command': ['true'], 'cacheable': {'env': ['HOME']}},
+            {'type': 'command', 'command': ['true'], 'cacheable': {'env': ['USER']}},
+            {'type': 'sequence', 'children': []},
+            {'type': 'alternative', 'children': []},
+        ]})
+        self.assertEqual(len(set(map(id, pattern.children))), 6)
+
+    def test_shared_between_calls(self):
+        shared = {}
+        command = {'type': 'command', 'command': 'true'}
+        self.assertIs(deserialize(command, shared), deserialize(command, shared))
+        self.assertIsNot(deserialize(command), deserialize(command))
+
+    def test_stream_pipelines_are_shared(self):
+        pipeline = {'type': 'sequence', 'stream': True, 'children': [
+            {'type': 'command', 'command': 'cat', 'pass_stdin': True, 'capture_stdout': True},
+            {'type': 'command', 'command': 'wc', 'pass_stdin': True},
+        ]}
+        pattern = deserialize({'type': 'sequence', 'children': [pipeline, pipeline]})
+        self.assertIs(pattern.children[0], pattern.children[1])
+        self.assertIsInstance(pattern.children[0].children[0], Pipeline)
+
+
+class SerializationTestCase(TestCase):
+    def test_round_trip(self):
+        description = {
+            'type': 'sequence',
+            'children': [
+                {'type': 'parallelization', 'jobs': 2, 'children': {
+                    'a': {'type': 'command', 'command': ['echo', 'a'], 'capture_stdout': True},
+                    'b': {'type': 'alternative', 'children': [{'type': 'command', 'command': 'true'}]},
+                }},
+                {'type': 'repetition', 'speculative': True,
+                 'child': {'type': 'command', 'command': 'false', 'cacheable': {'env': ['HOME']}},
+                 'exit': {'type': 'command', 'command': 'true', 'pass_stdin': True, 'timeout': 10,
+                          'hedge': {'percentile': 95, 'after': 1}}},
+                {'type': 'pipeline', 'commands': [
+                    {'type': 'command', 'command': 'cat', 'pass_stdin': True, 'capture_stdout': True},
+                    {'type': 'command', 'command': 'wc', 'pass_stdin': True},
+                ]},
+                {'type': 'map', 'lines': 100, 'jobs': 4,
+                 'child': {'type': 'command', 'command': 'sort', 'pass_stdin': True, 'capture_stdout': True}},
+            ],
+        }
+        pattern = deserialize(description)
+        self.assertIsInstance(pattern.children[2], Pipeline)
+        self.assertEqual(serialize(pattern), description)
+        self.assertEqual(deserialize(serialize(pattern)), pattern)
+
+    def test_unknown_pattern(self):
+        class Custom(petriish.WorkflowPattern):
+            pass
+
+        with self.assertRaises(TypeError):
+            serialize(petriish.Sequence([Custom()]))
@@ -0,0 +1,174 @@
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+import petriish
+from petriish import distributed
+from petriish.patterns.posix import SimpleCommand
+
+
+def ppid_command(*extra, **kwargs):
+    """Command printing pid of the process that spawned it"""
+    return SimpleCommand(['sh', '-c', 'echo $PPID' + ''.join(extra)], capture_stdout=True, **kwargs)
+
+
+class DistributedTestCase(TestCase):
+    workers_count = 2
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.addresses = []
+        self.workers = []
+        env = dict(os.environ, PYTHONPATH=os.getcwd())
+        for i in range(self.workers_count):
+            address = os.path.join(self.directory, 'worker{}.sock'.format(i))
+            worker = subprocess.Popen([sys.executable, 'bin/petriish', '--serve', address], env=env)
+            self.addCleanup(self.stop, worker)
+            self.addresses.append(address)
+            self.workers.append(worker)
+        deadline = time.monotonic() + 10
+        while not all(os.path.exists(address) for address in self.addresses):
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+
+    def stop(self, worker):
+        worker.send_signal(signal.SIGTERM)
+        worker.wait(timeout=10)
+
+    def run_distributed(self, pattern, input={}, engine='threading', keep=distributed.KEEP_THRESHOLD):
+        with distributed.Distributor(self.addresses, keep=keep) as distributor:
+            with petriish.intercept(distributor):
+                result = petriish.run_workflow_pattern(pattern, input, engine=engine)
+            return result, distributor.materialize(result.output)
+
+    def test_spreads_work(self):
+        pattern = petriish.Parallelization({
+            k: ppid_command('; sleep 0.3')
+            for k in 'ab'
+        })
+        for engine in petriish.engines:
+            with self.subTest(engine=engine):
+                result, output = self.run_distributed(pattern, engine=engine)
+                self.assertTrue(result.success)
+                self.assertEqual(
+                    sorted(int(v) for v in output.values()),
+                    sorted(worker.pid for worker in self.workers),
+                )
+
+    def test_sequence_is_shipped_whole(self):
+        pattern = petriish.Sequence([
+            ppid_command(),
+            SimpleCommand(['sh', '-c', 'cat; echo $PPID'], pass_stdin=True, capture_stdout=True),
+        ])
+        result, output = self.run_distributed(pattern)
+        self.assertTrue(result.success)
+        first, second = output.split()
+        self.assertEqual(first, second)
+        self.assertIn(int(first), [worker.pid for worker in self.workers])
+
+    def test_big_outputs_stay_on_worker(self):
+        size = 100000
+        pattern = petriish.Sequence([
+            SimpleCommand(['sh', '-c', 'echo $PPID > {}/producer; head -c {} /dev/zero'.format(self.directory, size)], capture_stdout=True),
+            petriish.Parallelization({
+                'consumer': SimpleCommand(['sh', '-c', 'echo $PPID; wc -c'], pass_stdin=True, capture_stdout=True),
+                'other': SimpleCommand('true'),
+            }),
+        ])
+        result, output = self.run_distributed(pattern)
+        self.assertTrue(result.success)
+        with open(os.path.join(self.directory, 'producer')) as f:
+            producer = int(f.read())
+        consumer, count = output['consumer'].split()
+        self.assertEqual(int(consumer), producer)
+        self.assertEqual(int(count), size)
+
+    def test_fetch_between_workers(self):
+        size = 100000
+        pattern = petriish.Sequence([
+            SimpleCommand(['head', '-c', str(size), '/dev/zero'], capture_stdout=True),
+            SimpleCommand(['wc', '-c'], pass_stdin=True, capture_stdout=True),
+        ])
+        with distributed.Distributor(self.addresses[:1]) as producer:
+            with petriish.intercept(producer):
+                big = petriish.run_workflow_pattern(pattern.children[0], {}).output
+            self.assertIsInstance(big, distributed.RemoteBytes)
+            self.assertEqual(producer.materialize(big), b'\0' * size)
+            with distributed.Distributor(self.addresses[1:]) as consumer:
+                with petriish.intercept(consumer):
+                    result = petriish.run_workflow_pattern(pattern.children[1], big)
+            self.assertEqual(int(result.output), size)
+        with self.assertRaises(LookupError):
+            producer.materialize(big)
+
+    def test_failure_and_cancellation(self):
+        pattern = petriish.Parallelization({
+            'slow': SimpleCommand(['sleep', '10']),
+            'failing': SimpleCommand(['sh', '-c', 'sleep 0.2; exit 1']),
+        }, fail_fast=True)
+        for engine in petriish.engines:
+            with self.subTest(engine=engine):
+                start = time.monotonic()
+                result, _ = self.run_distributed(pattern, engine=engine)
+                self.assertFalse(result.success)
+                self.assertLess(time.monotonic() - start, 5)
+
+    def test_local_patterns(self):
+        class Local(petriish.WorkflowPattern):
+            def execute(self, input):
+                return petriish.Result(True, {'pid': os.getpid(), 'input': bytes(input)})
+
+        pattern = petriish.Sequence([
+            SimpleCommand(['head', '-c', '100', '/dev/zero'], capture_stdout=True),
+            Local(),
+        ])
+        result, output = self.run_distributed(pattern, keep=10)
+        self.assertEqual(output, {'pid': os.getpid(), 'input': b'\0' * 100})
+
+    def test_private_socket(self):
+        for address in self.addresses:
+            self.assertEqual(os.stat(address).st_mode & 0o777, 0o600)
+
+
+class AuthenticationTestCase(TestCase):
+    def setUp(self):
+        self.worker = distributed.Worker('127.0.0.1:0', secret=b'secret')
+        thread = threading.Thread(target=self.worker.serve_forever)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.worker.shutdown)
+        self.address = '127.0.0.1:{}'.format(self.worker.server.server_address[1])
+
+    def run_remote(self, secret):
+        with distributed.Distributor([self.address], secret=secret) as distributor:
+            with petriish.intercept(distributor):
+                return petriish.run_workflow_pattern(SimpleCommand(['echo', 'a'], capture_stdout=True), {})
+
+    def test_secret(self):
+        self.assertEqual(self.run_remote(b'secret').output, b'a\n')
+        with self.assertLogs('petriish.distributed', 'ERROR'):
+            self.assertFalse(self.run_remote(b'wrong').success)
+        with self.assertLogs('petriish.distributed', 'ERROR'):
+            self.assertFalse(self.run_remote(None).success)
+
+    def test_tcp_requires_secret(self):
+        with self.assertRaises(ValueError):
+            distributed.Worker('127.0.0.1:0')
+
+    def test_read_secret(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'secret')
+            with open(path, 'w') as f:
+                f.write('secret\n')
+            os.chmod(path, 0o644)
+            with self.assertRaises(ValueError):
+                distributed.read_secret(path)
+            os.chmod(path, 0o600)
+            self.assertEqual(distributed.read_secret(path), b'secret')
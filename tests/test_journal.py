@@ -0,0 +1,119 @@
+import json
+import os
+import tempfile
+from unittest import TestCase
+
+import petriish
+from petriish.journal import Journal
+from petriish.patterns.posix import SimpleCommand
+
+
+class JournalTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.journal_path = os.path.join(self.directory.name, 'journal')
+        self.log = os.path.join(self.directory.name, 'log')
+        self.marker = os.path.join(self.directory.name, 'marker')
+
+    def step(self, name, output='-'):
+        """Command logging its run, printing `output`"""
+        return SimpleCommand(
+            ['sh', '-c', 'echo {} >> {}; printf %s "$0"'.format(name, self.log), output],
+            capture_stdout=True,
+        )
+
+    def flaky_step(self):
+        """Fails unless the marker file exists"""
+        return SimpleCommand(['sh', '-c', 'echo flaky >> {}; test -e {}'.format(self.log, self.marker)])
+
+    def runs(self):
+        with open(self.log) as f:
+            return f.read().split()
+
+    def run_journaled(self, pattern, resume, engine='threading'):
+        with Journal(self.journal_path, resume=resume) as journal:
+            with petriish.intercept(journal):
+                return petriish.run_workflow_pattern(pattern, {}, engine=engine)
+
+    def test_resume(self):
+        pattern = petriish.Sequence([
+            petriish.Parallelization({'a': self.step('a'), 'b': self.flaky_step()}),
+            self.step('c'),
+        ])
+        for engine in petriish.engines:
+            with self.subTest(engine=engine):
+                if os.path.exists(self.marker):
+                    os.unlink(self.marker)
+                open(self.log, 'w').close()
+                self.assertFalse(self.run_journaled(pattern, resume=False, engine=engine).success)
+                self.assertEqual(sorted(self.runs()), ['a', 'flaky'])
+
+                open(self.marker, 'w').close()
+                self.assertTrue(self.run_journaled(pattern, resume=True, engine=engine).success)
+                self.assertEqual(sorted(self.runs()), ['a', 'c', 'flaky', 'flaky'])
+
+                # finished run replays completely
+                result = self.run_journaled(pattern, resume=True, engine=engine)
+                self.assertTrue(result.success)
+                self.assertEqual(result.output, b'-')
+                self.assertEqual(len(self.runs()), 4)
+
+    def test_fresh_journal_doesnt_replay(self):
+        pattern = self.step('a')
+        self.run_journaled(pattern, resume=False)
+        self.run_journaled(pattern, resume=False)
+        self.assertEqual(self.runs(), ['a', 'a'])
+
+    def test_outputs(self):
+        big = 'x' * 10000
+        pattern = petriish.Parallelization({
+            'small': self.step('small', 'abc'),
+            'big': self.step('big', big),
+            'nested': petriish.Parallelization({'deeper': self.step('deeper')}),
+        })
+        first = self.run_journaled(pattern, resume=False)
+        second = self.run_journaled(pattern, resume=True)
+        self.assertEqual(sorted(self.runs()), ['big', 'deeper', 'small'])
+        self.assertEqual(second.output, first.output)
+        self.assertEqual(second.output['big'], big.encode())
+        self.assertEqual(len(os.listdir(self.journal_path + '.blobs')), 1)
+
+    def test_input_must_match(self):
+        consumer = SimpleCommand(
+            ['sh', '-c', 'cat >> {0}; echo >> {0}'.format(self.log)],
+            pass_stdin=True,
+        )
+        self.run_journaled(petriish.Sequence([self.step('a', 'one'), consumer]), resume=False)
+        self.run_journaled(petriish.Sequence([self.step('b', 'two'), consumer]), resume=True)
+        self.assertEqual(self.runs(), ['a', 'one', 'b', 'two'])
+
+    def test_truncated_journal(self):
+        pattern = petriish.Sequence([self.step('a'), self.step('b')])
+        self.run_journaled(pattern, resume=False)
+        with open(self.journal_path) as f:
+            lines = f.readlines()
+        # keep first step, and a half of the next line
+        with open(self.journal_path, 'w') as f:
+            f.write(lines[0] + lines[1][:10])
+        with self.assertLogs('petriish.journal', 'WARNING'):
+            self.run_journaled(pattern, resume=True)
+        self.assertEqual(self.runs(), ['a', 'b', 'b'])
+        with open(self.journal_path) as f:
+            for line in f.readlines()[2:]:
+                json.loads(line)
+
+    def test_paths(self):
+        pattern = petriish.Repetition(
+            child=SimpleCommand('false'),
+            exit=SimpleCommand('true'),
+        )
+        self.run_journaled(pattern, resume=False)
+        with open(self.journal_path) as f:
+            paths = [json.loads(line)['path'] for line in f]
+        self.assertEqual(sorted(paths, key=json.dumps), [[[0], 'child'], [[0], 'exit'], []])
+
+    def test_changed_pattern_doesnt_replay(self):
+        self.run_journaled(self.step('a'), resume=False)
+        self.run_journaled(self.step('b'), resume=True)
+        self.assertEqual(self.runs(), ['a', 'b'])
@@ -0,0 +1,110 @@
+import os
+import signal
+import tempfile
+import time
+from unittest import TestCase, mock
+
+import petriish
+from petriish import launchers, storage
+from petriish.patterns.posix import Pipeline, SimpleCommand, run_commands
+
+
+class LaunchersTestCase(TestCase):
+    def each_launcher(self):
+        for name, launcher_class in launchers.launchers.items():
+            with self.subTest(launcher=name), launcher_class() as launcher:
+                with launchers.launching(launcher):
+                    yield launcher
+
+    def test_pipeline(self):
+        pattern = Pipeline([
+            SimpleCommand(['cat'], pass_stdin=True, capture_stdout=True),
+            SimpleCommand(['tr', 'a-z', 'A-Z'], pass_stdin=True, capture_stdout=True),
+        ])
+        for _ in self.each_launcher():
+            result = petriish.run_workflow_pattern(pattern, b'abc')
+            self.assertTrue(result.success)
+            self.assertEqual(result.output, b'ABC')
+
+    def test_exit_codes(self):
+        for _ in self.each_launcher():
+            self.assertFalse(petriish.run_workflow_pattern(SimpleCommand(['sh', '-c', 'exit 3']), {}).success)
+            self.assertTrue(petriish.run_workflow_pattern(SimpleCommand('true'), {}).success)
+            result = run_commands([SimpleCommand(['sh', '-c', 'kill -9 $$'])], {})
+            self.assertFalse(result.success)
+
+    def test_missing_command(self):
+        for _ in self.each_launcher():
+            with self.assertRaises(FileNotFoundError):
+                petriish.run_workflow_pattern(SimpleCommand('there-is-no-such-command'), {})
+
+    def test_own_session(self):
+        for _ in self.each_launcher():
+            result = petriish.run_workflow_pattern(
+                SimpleCommand(['sh', '-c', 'ps -o sid= -p $$'], capture_stdout=True), {},
+            )
+            self.assertEqual(int(result.output), int(result.output.split()[0]))
+            self.assertNotEqual(int(result.output), os.getsid(0))
+
+    def test_posix_spawn_unavailable(self):
+        # Python 3.7 has no os.posix_spawnp
+        with mock.patch.dict(os.__dict__), launchers.launching(launchers.PosixSpawnLauncher()):
+            del os.posix_spawnp
+            result = petriish.run_workflow_pattern(SimpleCommand(['sh', '-c', 'ps -o sid= -p $$'], capture_stdout=True), {})
+        self.assertNotEqual(int(result.output), os.getsid(0))
+
+    def test_environment(self):
+        for _ in self.each_launcher():
+            os.environ['PETRIISH_TEST'] = 'value'
+            try:
+                result = petriish.run_workflow_pattern(
+                    SimpleCommand(['sh', '-c', 'printf %s "$PETRIISH_TEST"'], capture_stdout=True), {},
+                )
+            finally:
+                del os.environ['PETRIISH_TEST']
+            self.assertEqual(result.output, b'value')
+
+    def test_invocation(self):
+        read, write = os.pipe()
+        invocation = launchers.Invocation('/', {'PETRIISH_TEST': 'invoked', 'PATH': os.environ['PATH']}, write, write)
+        pattern = Pipeline([
+            SimpleCommand(['sh', '-c', 'pwd; echo $PETRIISH_TEST; echo err >&2'], capture_stdout=True),
+            SimpleCommand(['cat'], pass_stdin=True),
+        ])
+        for _ in self.each_launcher():
+            with launchers.invoked(invocation):
+                self.assertTrue(petriish.run_workflow_pattern(pattern, {}).success)
+        os.close(write)
+        with open(read, 'rb') as f:
+            # stderr and stdout of the pipeline race each other
+            self.assertEqual(sorted(f.read().split()), sorted([b'/', b'invoked', b'err'] * len(launchers.launchers)))
+
+    def test_spilled_input(self):
+        with tempfile.TemporaryFile() as f:
+            f.write(b'x' * 1000)
+            f.flush()
+            spilled = storage.SpilledBytes(f)
+            for _ in self.each_launcher():
+                result = petriish.run_workflow_pattern(
+                    SimpleCommand(['wc', '-c'], pass_stdin=True, capture_stdout=True), spilled,
+                )
+                self.assertEqual(int(result.output), 1000)
+
+    def test_cancel(self):
+        for _ in self.each_launcher():
+            start = time.monotonic()
+            result = petriish.run_workflow_pattern(petriish.Parallelization({
+                'sleep': SimpleCommand(['sleep', '10']),
+                'fail': SimpleCommand(['sh', '-c', 'sleep 0.1; false']),
+            }, fail_fast=True), {})
+            self.assertFalse(result.success)
+            self.assertLess(time.monotonic() - start, 5)
+
+    def test_fork_server_gone(self):
+        with launchers.ForkServerLauncher() as launcher:
+            child = launcher.spawn(['true'])
+            self.assertEqual(child.wait(), 0)
+            os.kill(launcher._server.pid, signal.SIGKILL)
+            launcher._reader.join(timeout=5)
+            with self.assertRaises(BrokenPipeError):
+                launcher.spawn(['true'])
@@ -0,0 +1,142 @@
+import os
+import tempfile
+import threading
+import time
+from unittest import TestCase, mock
+
+import yaml
+
+import petriish
+from petriish import loading
+from petriish.journal import Journal
+from petriish.patterns.posix import SimpleCommand
+from petriish.serialization import deserialize
+
+DESCRIPTION = b'''
+type: sequence
+children:
+  - {type: command, command: [echo, a], capture_stdout: true}
+  - type: parallelization
+    children:
+      b: {type: command, command: [cat], pass_stdin: true, capture_stdout: true}
+  - {type: sequence, children: []}
+'''
+
+
+class LoadTestCase(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def test_load(self):
+        self.assertEqual(loading.load(DESCRIPTION), deserialize(yaml.safe_load(DESCRIPTION)))
+
+    def test_type_error_is_reported(self):
+        with self.assertLogs('petriish.loading', 'WARNING'):
+            loading.load(b'{type: sequence, children: [{type: command, command: x, capture_stdout: true}, {type: command, command: y}]}')
+
+    def test_cache(self):
+        cache = loading.PlanCache(self.directory)
+        first = loading.load(DESCRIPTION, cache=cache)
+        second = loading.load(DESCRIPTION, cache=cache)
+        self.assertEqual(first, second)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        loading.load(DESCRIPTION + b'\n# changed\n', cache=cache)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_cache_keyed_on_code(self):
+        cache = loading.PlanCache(self.directory)
+        loading.load(DESCRIPTION, cache=cache)
+        with mock.patch.object(loading, '_code_digest', lambda: 'other version'):
+            loading.load(DESCRIPTION, cache=cache)
+        self.assertEqual((cache.hits, cache.misses), (0, 2))
+
+    def test_broken_cache_entry(self):
+        cache = loading.PlanCache(self.directory)
+        loading.load(DESCRIPTION, cache=cache)
+        for name in os.listdir(self.directory):
+            with open(os.path.join(self.directory, name), 'wb') as f:
+                f.write(b'garbage')
+        with self.assertLogs('petriish.loading', 'WARNING'):
+            self.assertEqual(loading.load(DESCRIPTION, cache=cache), deserialize(yaml.safe_load(DESCRIPTION)))
+
+    def test_lazy(self):
+        workflow = loading.load(DESCRIPTION, lazy=True)
+        self.assertIsInstance(workflow.children, loading.LazyList)
+        self.assertEqual(list(workflow.children), list(deserialize(yaml.safe_load(DESCRIPTION)).children))
+        for engine in petriish.engines:
+            with self.subTest(engine=engine):
+                result = petriish.run_workflow_pattern(workflow, {}, engine=engine)
+                self.assertTrue(result.success)
+                self.assertEqual(result.output, {'b': b'a\n'})
+
+    def test_lazy_journal_digest(self):
+        journal = Journal(os.path.join(self.directory, 'journal'))
+        self.assertEqual(
+            journal.pattern_digest(loading.load(DESCRIPTION, lazy=True)),
+            journal.pattern_digest(loading.load(DESCRIPTION)),
+        )
+
+    def test_lazy_stores_in_cache(self):
+        cache = loading.PlanCache(self.directory)
+        lazy = loading.load(DESCRIPTION, cache=cache, lazy=True)
+        list(lazy.children)
+        deadline = time.monotonic() + 5
+        while not os.listdir(self.directory):
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+        # wait for the rename too
+        while any(not name.endswith('.pickle') for name in os.listdir(self.directory)):
+            time.sleep(0.01)
+        self.assertEqual(loading.load(DESCRIPTION, cache=cache), deserialize(yaml.safe_load(DESCRIPTION)))
+        self.assertEqual(cache.hits, 1)
+
+    def test_only_plain_sequence_is_lazy(self):
+        for description in [
+            b'{type: parallelization, children: {}}',
+            b'{type: command, command: x}',
+            b'{type: sequence, stream: true, children: []}',
+            b'{children: [], type: sequence}',
+        ]:
+            with self.subTest(description=description):
+                workflow = loading.load(description, lazy=True)
+                self.assertEqual(workflow, deserialize(yaml.safe_load(description)))
+                self.assertNotIsInstance(getattr(workflow, 'children', None), loading.LazyList)
+
+    def test_lazy_failure(self):
+        workflow = loading.load(b'{type: sequence, children: [{type: command, command: x}, {type: bogus}]}', lazy=True)
+        self.assertEqual(workflow.children[0], SimpleCommand('x'))
+        with self.assertRaises(RuntimeError):
+            workflow.children[1]
+
+    def test_lazy_fields_after_children(self):
+        workflow = loading.load(b'{type: sequence, children: [{type: command, command: x}], stream: true}', lazy=True)
+        with self.assertRaises(RuntimeError):
+            len(workflow.children)
+
+
+class LazyListTestCase(TestCase):
+    def test_waits_for_items(self):
+        items = loading.LazyList()
+        items.append('a')
+        self.assertEqual(items[0], 'a')
+        threading.Timer(0.1, items.append, ['b']).start()
+        self.assertEqual(items[1], 'b')
+        threading.Timer(0.1, items.close).start()
+        self.assertEqual(len(items), 2)
+        self.assertEqual(items[-1], 'b')
+        self.assertEqual(items[:], ['a', 'b'])
+        self.assertEqual(list(items), ['a', 'b'])
+        with self.assertRaises(IndexError):
+            items[2]
+
+    def test_failure(self):
+        items = loading.LazyList()
+        items.append('a')
+        items.close(ValueError())
+        self.assertEqual(items[0], 'a')
+        with self.assertRaises(RuntimeError):
+            items[1]
+        with self.assertRaises(RuntimeError):
+            len(items)
@@ -0,0 +1,88 @@
+from unittest import TestCase
+
+import petriish
+from petriish.patterns.posix import Pipeline, SimpleCommand, join_pipelines
+from petriish.serialization import deserialize
+
+
+def producer(*command):
+    return SimpleCommand(list(command), capture_stdout=True)
+
+
+def filter(*command):
+    return SimpleCommand(list(command), pass_stdin=True, capture_stdout=True)
+
+
+def consumer(*command):
+    return SimpleCommand(list(command), pass_stdin=True)
+
+
+class PipelineTestCase(TestCase):
+    def run_pattern(self, pattern, input):
+        for engine in petriish.engines:
+            with self.subTest(engine=engine):
+                yield petriish.run_workflow_pattern(pattern, input, engine=engine)
+
+    def test_streams(self):
+        pattern = Pipeline([
+            producer('printf', 'a\nb\nc\n'),
+            filter('tr', 'a-z', 'A-Z'),
+            filter('sort', '-r'),
+        ])
+        for result in self.run_pattern(pattern, {}):
+            self.assertTrue(result.success)
+            self.assertEqual(result.output, b'C\nB\nA\n')
+
+    def test_input(self):
+        pattern = Pipeline([filter('rev'), filter('tr', 'a', 'b')])
+        for result in self.run_pattern(pattern, b'abc\n'):
+            self.assertTrue(result.success)
+            self.assertEqual(result.output, b'cbb\n')
+
+    def test_runs_concurrently(self):
+        # consumer finishes early and producer dies of SIGPIPE - it would
+        # run forever if started alone
+        pattern = Pipeline([producer('yes'), filter('head', '-n', '2')])
+        for result in self.run_pattern(pattern, {}):
+            self.assertFalse(result.success)
+
+    def test_failure_of_any_process(self):
+        pattern = Pipeline([producer('sh', '-c', 'echo a; exit 3'), consumer('cat')])
+        for result in self.run_pattern(pattern, {}):
+            self.assertFalse(result.success)
+
+    def test_not_streaming(self):
+        with self.assertRaises(ValueError):
+            Pipeline([SimpleCommand('true'), consumer('cat')])
+
+
+class JoinPipelinesTestCase(TestCase):
+    def test_join(self):
+        a = producer('a')
+        b = filter('b')
+        c = consumer('c')
+        d = producer('d')
+        e = consumer('e')
+        self.assertEqual(
+            join_pipelines([a, b, c, petriish.Sequence([]), SimpleCommand('x'), d, e]),
+            [Pipeline([a, b, c]), petriish.Sequence([]), SimpleCommand('x'), Pipeline([d, e])],
+        )
+        self.assertEqual(join_pipelines([a, SimpleCommand('x')]), [a, SimpleCommand('x')])
+
+    def test_deserialize_stream(self):
+        description = {
+            'type': 'sequence',
+            'stream': True,
+            'children': [
+                {'type': 'command', 'command': ['echo', 'x'], 'capture_stdout': True},
+                {'type': 'command', 'command': ['cat'], 'pass_stdin': True},
+            ],
+        }
+        self.assertEqual(deserialize(description), petriish.Sequence([Pipeline([
+            producer('echo', 'x'),
+            consumer('cat'),
+        ])]))
+        self.assertEqual(deserialize(dict(description, stream=False)), petriish.Sequence([
+            producer('echo', 'x'),
+            consumer('cat'),
+        ]))
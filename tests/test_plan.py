@@ -0,0 +1,168 @@
+import threading
+from unittest import TestCase
+
+import petriish
+from petriish import loading, plan
+
+
+class Countdown(petriish.WorkflowPattern):
+    """Succeeds while input is positive (or, for exit, once it isn't), decrementing it"""
+
+    def __init__(self, exit=False):
+        self.exit = exit
+
+    async def execute_async(self, input):
+        if (input <= 0) == self.exit:
+            return petriish.Result(True, input - 1)
+        return petriish.Result(False)
+
+
+class PathRecorder(petriish.WorkflowPattern):
+    def __init__(self):
+        self.paths = []
+
+    async def execute_async(self, input):
+        self.paths.append(petriish.current_path())
+        return petriish.Result(True, input)
+
+
+class Unwrap(petriish.WorkflowPattern):
+    def __init__(self, key):
+        self.key = key
+
+    async def execute_async(self, input):
+        return petriish.Result(True, input[self.key])
+
+
+class Constant(petriish.WorkflowPattern):
+    def __init__(self, success, output=None):
+        self.result = petriish.Result(success, output)
+
+    async def execute_async(self, input):
+        return self.result
+
+
+class CompileTestCase(TestCase):
+    def test_layout(self):
+        a, b, c = Constant(True), Constant(True), Constant(True)
+        compiled = plan.compile(petriish.Sequence([
+            petriish.Parallelization({'x': a, 'y': b}),
+            c,
+        ]))
+        self.assertEqual(len(compiled), 5)
+        root, parallelization = compiled.nodes[0], compiled.nodes[1]
+        self.assertEqual(compiled.links[root.first:root.first + root.count], [1, 4])
+        self.assertEqual(compiled.links[parallelization.first:parallelization.first + parallelization.count], [2, 3])
+        self.assertEqual([node.end for node in compiled.nodes], [5, 4, 3, 4, 5])
+        self.assertEqual([node.pattern for node in compiled.nodes[2:]], [a, b, c])
+
+    def test_deep_tree(self):
+        pattern = Constant(True, 'out')
+        for _ in range(10000):
+            pattern = petriish.Sequence([pattern])
+        self.assertEqual(len(plan.compile(pattern)), 10001)
+        result = petriish.run_workflow_pattern(pattern, None, engine='plan')
+        self.assertTrue(result.success)
+        self.assertEqual(result.output, 'out')
+
+
+class PlanEngineTestCase(TestCase):
+    def run_pattern(self, pattern, input):
+        return petriish.run_workflow_pattern(pattern, input, engine='plan')
+
+    def test_repetition(self):
+        result = self.run_pattern(petriish.Repetition(Countdown(), Countdown(exit=True)), 1000)
+        self.assertTrue(result.success)
+        self.assertEqual(result.output, -1)
+
+    def test_nested_repetitions(self):
+        leaf = PathRecorder()
+        inner = petriish.Repetition(Countdown(), petriish.Sequence([Countdown(exit=True), leaf]))
+        outer = petriish.Repetition(
+            petriish.Sequence([
+                petriish.Parallelization({'rest': Countdown(), 'inner': inner}),
+                Unwrap('rest'),
+            ]),
+            Countdown(exit=True),
+        )
+        result = self.run_pattern(outer, 2)
+        self.assertTrue(result.success)
+        self.assertEqual(result.output, -1)
+        self.assertEqual(leaf.paths, [
+            ((i,), 'child', 0, 'inner', (j,), 'exit', 1)
+            for i, j in [(0, 2), (1, 1), (2, 0)]
+        ])
+
+    def test_alternative(self):
+        ok, failing = Constant(True, 'ok'), Constant(False)
+        self.assertEqual(self.run_pattern(petriish.Alternative([failing, ok, failing]), None).output, 'ok')
+        self.assertFalse(self.run_pattern(petriish.Alternative([ok, ok]), None).success)
+        self.assertFalse(self.run_pattern(petriish.Alternative([]), None).success)
+
+    def test_parallelization(self):
+        result = self.run_pattern(petriish.Parallelization({
+            'a': Constant(True, 1),
+            'b': petriish.Sequence([]),
+            'c': petriish.Parallelization({}),
+        }), 'in')
+        self.assertTrue(result.success)
+        self.assertEqual(result.output, {'a': 1, 'b': 'in', 'c': {}})
+
+    def test_paths(self):
+        leaf = PathRecorder()
+        pattern = petriish.Repetition(
+            petriish.Sequence([
+                petriish.Parallelization({'x': leaf, 'rest': Countdown()}),
+                Unwrap('rest'),
+            ]),
+            Countdown(exit=True),
+        )
+        with petriish._nested_path('root'):
+            self.assertTrue(self.run_pattern(pattern, 1).success)
+        self.assertEqual(leaf.paths, [
+            ('root', (0,), 'child', 0, 'x'),
+            ('root', (1,), 'child', 0, 'x'),
+        ])
+
+    def test_same_as_recursive(self):
+        pattern = petriish.Sequence([
+            petriish.Parallelization({
+                'a': petriish.Repetition(Countdown(), Countdown(exit=True)),
+                'b': petriish.Alternative([Countdown(exit=True), Countdown()]),
+            }, jobs=1),
+            petriish.Parallelization({'c': Constant(True, 'c')}),
+        ])
+        self.assertEqual(
+            repr(self.run_pattern(pattern, 5)),
+            repr(petriish.run_workflow_pattern(pattern, 5, engine='asyncio')),
+        )
+
+    def test_leaf_exception(self):
+        class Broken(petriish.WorkflowPattern):
+            async def execute_async(self, input):
+                raise ValueError('broken')
+
+        with self.assertRaises(ValueError):
+            self.run_pattern(petriish.Parallelization({'a': Broken()}), None)
+
+    def test_lazy_sequence(self):
+        started = threading.Event()
+
+        class Started(petriish.WorkflowPattern):
+            async def execute_async(self, input):
+                started.set()
+                return petriish.Result(True, input + 1)
+
+        children = loading.LazyList()
+        children.append(Started())
+        results = []
+        runner = threading.Thread(target=lambda: results.append(
+            self.run_pattern(petriish.Sequence(children), 0),
+        ))
+        runner.start()
+        # first child runs before the rest is loaded
+        self.assertTrue(started.wait(5))
+        children.append(petriish.Sequence([PathRecorder(), Constant(True, 'done')]))
+        children.close()
+        runner.join()
+        self.assertEqual(results[0].output, 'done')
@@ -0,0 +1,253 @@
+import asyncio
+import contextlib
+import contextvars
+import os
+import sys
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+import petriish
+from petriish import cancellation, scheduling
+from petriish.patterns.posix import SimpleCommand
+from petriish.serialization import deserialize
+
+
+class ConcurrencyProbe:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+
+    def enter(self):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+
+    def exit(self):
+        with self.lock:
+            self.running -= 1
+
+
+class ProbeCommand(petriish.WorkflowPattern):
+    """Leaf that takes a pool slot and records how many leaves run at once"""
+
+    def __init__(self, probe):
+        self.probe = probe
+
+    def execute(self, input):
+        with scheduling.slot():
+            self.probe.enter()
+            time.sleep(0.01)
+            self.probe.exit()
+        return petriish.Result(True)
+
+
+class LimiterTestCase(TestCase):
+    def test_handover(self):
+        limiter = scheduling.Limiter(1)
+        limiter.acquire()
+        acquired = threading.Event()
+        waiter = threading.Thread(target=lambda: (limiter.acquire(), acquired.set()))
+        waiter.start()
+        self.assertFalse(acquired.wait(timeout=0.05))
+        limiter.release()
+        self.assertTrue(acquired.wait(timeout=1))
+        waiter.join()
+
+    def test_cancelled_after_handover(self):
+        limiter = scheduling.Limiter(1)
+
+        async def main():
+            limiter.acquire()
+            task = asyncio.ensure_future(limiter.acquire_async())
+            await asyncio.sleep(0)
+            limiter.release()
+            # slot gets handed over first, task is cancelled before it resumes
+            asyncio.get_running_loop().call_soon(task.cancel)
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        asyncio.run(main())
+        self.assertEqual(limiter._free, 1)
+
+    def test_invalid_size(self):
+        with self.assertRaises(ValueError):
+            scheduling.Limiter(0)
+
+
+class JobsTestCase(TestCase):
+    def run_probes(self, engine, jobs=None, subtree_jobs=None, width=10):
+        probe = ConcurrencyProbe()
+        pattern = petriish.Parallelization(
+            {i: ProbeCommand(probe) for i in range(width)},
+            jobs=subtree_jobs,
+        )
+        result = petriish.run_workflow_pattern(pattern, {}, engine=engine, jobs=jobs)
+        self.assertTrue(result.success)
+        return probe.max_running
+
+    def test_global_limit(self):
+        for engine in petriish.engines:
+            with self.subTest(engine=engine):
+                self.assertEqual(self.run_probes(engine, jobs=3), 3)
+
+    def test_subtree_limit(self):
+        for engine in petriish.engines:
+            with self.subTest(engine=engine):
+                self.assertEqual(self.run_probes(engine, subtree_jobs=2), 2)
+                self.assertEqual(self.run_probes(engine, jobs=1, subtree_jobs=2), 1)
+
+    def test_nested_limits_dont_deadlock(self):
+        probe = ConcurrencyProbe()
+        pattern = petriish.Parallelization({
+            i: petriish.Alternative([
+                petriish.Sequence([ProbeCommand(probe), ProbeCommand(probe)]),
+                petriish.Sequence([]),
+            ], jobs=1)
+            for i in range(5)
+        }, jobs=2)
+        result = petriish.run_workflow_pattern(pattern, {}, jobs=1)
+        self.assertFalse(result.success)
+        self.assertEqual(probe.max_running, 1)
+
+    def test_deserialize(self):
+        self.assertEqual(
+            deserialize({'type': 'parallelization', 'children': {}, 'jobs': 4}),
+            petriish.Parallelization({}, jobs=4),
+        )
+        self.assertEqual(
+            deserialize({'type': 'alternative', 'children': [], 'jobs': 2}),
+            petriish.Alternative([], jobs=2),
+        )
+
+
+class ResourcePoolTestCase(TestCase):
+    def acquire_later(self, pool, requirements, path=()):
+        acquired = threading.Event()
+
+        def acquire():
+            with petriish._nested_path(path) if path else contextlib.nullcontext():
+                pool.acquire(requirements)
+            acquired.set()
+
+        threading.Thread(target=acquire, daemon=True).start()
+        return acquired
+
+    def test_waits_until_fits(self):
+        pool = scheduling.ResourcePool({'cpu': 4, 'mem': 100})
+        pool.acquire({'cpu': 3, 'mem': 10})
+        acquired = self.acquire_later(pool, {'cpu': 2})
+        self.assertFalse(acquired.wait(0.05))
+        pool.acquire({'mem': 90, 'gpu': 7})  # undeclared resources are free
+        pool.release({'cpu': 3, 'mem': 10})
+        self.assertTrue(acquired.wait(1))
+
+    def test_priority_and_backfill(self):
+        pool = scheduling.ResourcePool({'cpu': 4, 'mem': 10}, priorities={('low',): 1, ('high',): 2})
+        pool.acquire({'cpu': 3})
+        low = self.acquire_later(pool, {'cpu': 2}, 'low')
+        time.sleep(0.05)
+        high = self.acquire_later(pool, {'cpu': 4}, 'high')
+        time.sleep(0.05)
+        # the free cpu is reserved for the high one, small ones can't take it
+        small = self.acquire_later(pool, {'cpu': 1})
+        self.assertFalse(small.wait(0.05))
+        # but what fits beside the reservation goes ahead
+        pool.acquire({'mem': 10})
+        pool.release({'cpu': 3})
+        self.assertTrue(high.wait(1))
+        self.assertFalse(low.is_set())
+        self.assertFalse(small.is_set())
+        pool.release({'cpu': 4})
+        self.assertTrue(low.wait(1))
+        self.assertTrue(small.wait(1))
+
+    def test_cancelled_wait_drops_reservation(self):
+        pool = scheduling.ResourcePool({'cpu': 2})
+        pool.acquire({'cpu': 1})
+        with cancellation.scope() as scope:
+            context = contextvars.copy_context()
+            big = threading.Thread(target=context.run, args=(self.assertRaises, cancellation.Cancelled, pool.acquire, {'cpu': 2}))
+            big.start()
+            time.sleep(0.05)
+            small = self.acquire_later(pool, {'cpu': 1})
+            self.assertFalse(small.wait(0.05))
+            scope.cancel()
+            big.join()
+        self.assertTrue(small.wait(1))
+
+    def test_capped_to_capacity(self):
+        pool = scheduling.ResourcePool({'cpu': 4})
+        pool.acquire({'cpu': 100})
+        pool.release({'cpu': 100})
+        pool.acquire({'cpu': 4})
+
+    def test_cancelled_wait(self):
+        pool = scheduling.ResourcePool({'cpu': 1})
+        pool.acquire({'cpu': 1})
+        with cancellation.scope() as scope:
+            threading.Timer(0.05, scope.cancel).start()
+            with self.assertRaises(cancellation.Cancelled):
+                pool.acquire({'cpu': 1})
+        pool.release({'cpu': 1})
+        pool.acquire({'cpu': 1})
+
+    def test_cancelled_after_admission(self):
+        pool = scheduling.ResourcePool({'cpu': 1})
+
+        async def main():
+            pool.acquire({'cpu': 1})
+            task = asyncio.ensure_future(pool.acquire_async({'cpu': 1}))
+            await asyncio.sleep(0)
+            pool.release({'cpu': 1})
+            # resources get handed over first, task is cancelled before it resumes
+            asyncio.get_running_loop().call_soon(task.cancel)
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        asyncio.run(main())
+        self.assertEqual(pool._free, {'cpu': 1})
+
+
+class ResourcesTestCase(TestCase):
+    def test_admission(self):
+        with tempfile.TemporaryDirectory() as directory:
+            log = os.path.join(directory, 'log')
+            pattern = petriish.Parallelization({
+                i: SimpleCommand(
+                    ['sh', '-c', 'echo + >> {0}; sleep 0.1; echo - >> {0}'.format(log)],
+                    resources={'cpu': 2},
+                )
+                for i in range(4)
+            })
+            for engine in petriish.engines:
+                with self.subTest(engine=engine):
+                    with scheduling.resources(scheduling.ResourcePool({'cpu': 5})):
+                        self.assertTrue(petriish.run_workflow_pattern(pattern, {}, engine=engine).success)
+                    running = peak = 0
+                    with open(log) as f:
+                        for line in f:
+                            running += 1 if line.strip() == '+' else -1
+                            peak = max(peak, running)
+                    os.unlink(log)
+                    self.assertEqual(peak, 2)
+
+    def test_enforced_memory(self):
+        allocate = SimpleCommand([sys.executable, '-c', 'import time; time.sleep(0.1); bytearray(300 * 2 ** 20)'], resources={'mem': 200 * 2 ** 20})
+        for enforce in [False, True]:
+            with self.subTest(enforce=enforce):
+                with scheduling.resources(scheduling.ResourcePool({'mem': 2 ** 40}, enforce=enforce)):
+                    self.assertEqual(petriish.run_workflow_pattern(allocate, {}).success, not enforce)
+
+    def test_deserialize(self):
+        self.assertEqual(
+            deserialize({'type': 'command', 'command': 'x', 'resources': {'cpu': 8, 'mem': '4G'}}),
+            SimpleCommand('x', resources={'cpu': 8, 'mem': 4 * 2 ** 30}),
+        )
+
+    def test_normalize_path(self):
+        self.assertEqual(scheduling.normalize_path(('a', (3,), 'child', 0, (1,), 'exit')), ('a', 'child', 0, 'exit'))
+        # parallelization children may be called that too
+        self.assertEqual(scheduling.normalize_path((0, 'child', 1, 'exit')), (0, 'child', 1, 'exit'))
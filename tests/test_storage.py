@@ -0,0 +1,209 @@
+import os
+import subprocess
+import threading
+import time
+from unittest import TestCase, mock
+
+import petriish
+from petriish import storage
+from petriish.patterns.posix import Pipeline, SimpleCommand
+from petriish.serialization import deserialize
+
+
+class ParseSizeTestCase(TestCase):
+    def test_parse(self):
+        self.assertEqual(storage.parse_size(123), 123)
+        self.assertEqual(storage.parse_size('123'), 123)
+        self.assertEqual(storage.parse_size('4k'), 4096)
+        self.assertEqual(storage.parse_size('2M'), 2 * 2 ** 20)
+        self.assertEqual(storage.parse_size('4GiB'), 4 * 2 ** 30)
+        with self.assertRaises(ValueError):
+            storage.parse_size('lots')
+
+
+class OutputBufferTestCase(TestCase):
+    def test_in_memory(self):
+        buffer = storage.OutputBuffer()
+        buffer.write(b'abc')
+        buffer.write(b'def')
+        self.assertEqual(buffer.getvalue(), b'abcdef')
+        self.assertIsInstance(buffer.getvalue(), bytes)
+
+    def test_spill(self):
+        with storage.spill_threshold(4):
+            buffer = storage.OutputBuffer()
+        buffer.write(b'abc')
+        buffer.write(b'def')
+        buffer.write(b'ghi')
+        value = buffer.getvalue()
+        self.assertIsInstance(value, storage.SpilledBytes)
+        self.assertEqual(len(value), 9)
+        self.assertEqual(value, b'abcdefghi')
+        self.assertEqual(bytes(value), b'abcdefghi')
+        self.assertEqual(value.view[3:6], b'def')
+        self.assertNotEqual(value, b'abc')
+
+    def test_independent_descriptors(self):
+        with storage.spill_threshold(0):
+            buffer = storage.OutputBuffer()
+        buffer.write(b'abcdef')
+        value = buffer.getvalue()
+        a = value.open()
+        b = value.open()
+        try:
+            self.assertEqual(os.read(a, 3), b'abc')
+            self.assertEqual(os.read(b, 6), b'abcdef')
+            self.assertEqual(os.read(a, 6), b'def')
+        finally:
+            os.close(a)
+            os.close(b)
+
+    def test_limit(self):
+        buffer = storage.OutputBuffer(limit=5)
+        buffer.write(b'abc')
+        with self.assertRaises(storage.OutputLimitExceeded):
+            buffer.write(b'def')
+        self.assertEqual(buffer.budget.used, 0)
+
+
+class OutputBudgetTestCase(TestCase):
+    def test_accounting(self):
+        with storage.output_budget(None) as budget:
+            a, b = storage.OutputBuffer(), storage.OutputBuffer()
+        a.write(b'abc')
+        b.write(b'de')
+        self.assertEqual(budget.used, 5)
+        a.getvalue()
+        self.assertEqual(budget.used, 2)
+        b.release()
+        b.release()
+        self.assertEqual(budget.used, 0)
+
+    def test_spilled_data_not_counted(self):
+        with storage.output_budget(4) as budget, storage.spill_threshold(4):
+            buffer = storage.OutputBuffer()
+        buffer.write(b'abcdef')
+        self.assertEqual(budget.used, 0)
+        buffer.wait()  # doesn't block
+
+    def test_only_oldest_reads_over_budget(self):
+        with storage.output_budget(4) as budget:
+            old, new = storage.OutputBuffer(), storage.OutputBuffer()
+        old.write(b'abc')
+        new.write(b'de')
+        old.wait()
+        waited = threading.Event()
+
+        def wait():
+            new.wait()
+            waited.set()
+
+        threading.Thread(target=wait).start()
+        self.assertFalse(waited.wait(0.1))
+        old.getvalue()
+        self.assertTrue(waited.wait(5))
+        self.assertEqual(budget.used, 2)
+
+
+class SpillingCommandTestCase(TestCase):
+    expected = subprocess.run(['seq', '10000'], stdout=subprocess.PIPE).stdout
+
+    def test_spilled_output_fed_to_consumers(self):
+        pattern = petriish.Sequence([
+            SimpleCommand(['seq', '10000'], capture_stdout=True),
+            petriish.Parallelization({
+                'count': SimpleCommand(['wc', '-c'], pass_stdin=True, capture_stdout=True),
+                'copy': SimpleCommand(['cat'], pass_stdin=True, capture_stdout=True),
+            }),
+        ])
+        for engine in petriish.engines:
+            with self.subTest(engine=engine):
+                with storage.spill_threshold(1024):
+                    result = petriish.run_workflow_pattern(pattern, {}, engine=engine)
+                self.assertTrue(result.success)
+                self.assertEqual(int(result.output['count']), len(self.expected))
+                self.assertIsInstance(result.output['copy'], storage.SpilledBytes)
+                self.assertEqual(result.output['copy'], self.expected)
+
+    def test_fed_without_proc(self):
+        real_open = os.open
+
+        def open_without_proc(path, *args, **kwargs):
+            if str(path).startswith('/proc/'):
+                raise FileNotFoundError(path)
+            return real_open(path, *args, **kwargs)
+
+        pattern = petriish.Sequence([
+            SimpleCommand(['seq', '10000'], capture_stdout=True),
+            SimpleCommand(['cat'], pass_stdin=True, capture_stdout=True),
+        ])
+        for engine in petriish.engines:
+            with self.subTest(engine=engine):
+                with storage.spill_threshold(1024), mock.patch('os.open', open_without_proc):
+                    result = petriish.run_workflow_pattern(pattern, {}, engine=engine)
+                self.assertEqual(result.output, self.expected)
+
+    def test_below_threshold(self):
+        with storage.spill_threshold(len(self.expected)):
+            result = petriish.run_workflow_pattern(SimpleCommand(['seq', '10000'], capture_stdout=True), {})
+        self.assertEqual(result.output, self.expected)
+        self.assertIsInstance(result.output, bytes)
+
+
+class OutputLimitsTestCase(TestCase):
+    expected = subprocess.run(['seq', '100000'], stdout=subprocess.PIPE).stdout
+
+    def test_limit_exceeded(self):
+        for pattern in [
+            SimpleCommand(['yes'], capture_stdout=True, max_output_bytes=2 ** 20),
+            Pipeline([
+                SimpleCommand(['yes'], capture_stdout=True),
+                SimpleCommand(['cat'], pass_stdin=True, capture_stdout=True, max_output_bytes=2 ** 20),
+            ]),
+        ]:
+            for engine in petriish.engines:
+                with self.subTest(pattern=pattern, engine=engine):
+                    start = time.monotonic()
+                    result = petriish.run_workflow_pattern(pattern, {}, engine=engine)
+                    self.assertFalse(result.success)
+                    self.assertLess(time.monotonic() - start, 4)
+                    self.assertEqual(storage.current_output_budget().used, 0)
+
+    def test_within_limit(self):
+        pattern = SimpleCommand(['seq', '100000'], capture_stdout=True, max_output_bytes=len(self.expected))
+        for engine in petriish.engines:
+            with self.subTest(engine=engine):
+                self.assertEqual(petriish.run_workflow_pattern(pattern, {}, engine=engine).output, self.expected)
+
+    def test_backpressure(self):
+        pattern = petriish.Parallelization({
+            i: SimpleCommand(['seq', '100000'], capture_stdout=True)
+            for i in range(4)
+        })
+        for engine in petriish.engines:
+            with self.subTest(engine=engine):
+                with storage.output_budget(2 ** 16) as budget:
+                    result = petriish.run_workflow_pattern(pattern, {}, engine=engine)
+                self.assertTrue(result.success)
+                self.assertEqual(result.output, {i: self.expected for i in range(4)})
+                self.assertEqual(budget.used, 0)
+
+    def test_paused_reader_terminated(self):
+        pattern = petriish.Parallelization({
+            # holds the budget, being the oldest capture
+            'holding': SimpleCommand(['sh', '-c', 'head -c 100000 /dev/zero; sleep 10'], capture_stdout=True, timeout=5),
+            'paused': SimpleCommand(['sh', '-c', 'sleep 0.2; yes'], capture_stdout=True, timeout=1),
+        }, fail_fast=True)
+        for engine in petriish.engines:
+            with self.subTest(engine=engine):
+                start = time.monotonic()
+                with storage.output_budget(2 ** 16) as budget, self.assertLogs('petriish.patterns.posix', 'ERROR'):
+                    self.assertFalse(petriish.run_workflow_pattern(pattern, {}, engine=engine).success)
+                self.assertLess(time.monotonic() - start, 3)
+                self.assertEqual(budget.used, 0)
+
+    def test_deserialize(self):
+        self.assertEqual(
+            deserialize({'type': 'command', 'command': ['yes'], 'capture_stdout': True, 'max_output_bytes': '1K'}),
+            SimpleCommand(['yes'], capture_stdout=True, max_output_bytes=1024),
+        )
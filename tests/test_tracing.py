@@ -0,0 +1,87 @@
+import json
+import os
+import tempfile
+from unittest import TestCase
+
+import petriish
+from petriish.patterns.posix import Pipeline, SimpleCommand
+from petriish.tracing import Tracer
+
+
+class TracingTestCase(TestCase):
+    def run_traced(self, pattern, input={}, engine='threading'):
+        tracer = Tracer()
+        with petriish.intercept(tracer):
+            result = petriish.run_workflow_pattern(pattern, input, engine=engine)
+        return result, tracer
+
+    def test_spans(self):
+        pattern = petriish.Sequence([
+            petriish.Parallelization({
+                'a': SimpleCommand(['true']),
+                'b': SimpleCommand(['sleep', '0.1']),
+            }),
+            SimpleCommand(['false']),
+        ])
+        for engine in petriish.engines:
+            with self.subTest(engine=engine):
+                result, tracer = self.run_traced(pattern, engine=engine)
+                self.assertFalse(result.success)
+                spans = {span.path: span for span in tracer.spans}
+                self.assertEqual(set(spans), {(), (0,), (0, 'a'), (0, 'b'), (1,)})
+                self.assertEqual(spans[(0,)].type, 'Parallelization')
+                self.assertEqual(spans[(1,)].details['exit_codes'], [1])
+                self.assertFalse(spans[(1,)].success)
+                self.assertTrue(spans[(0, 'b')].success)
+                self.assertGreaterEqual(spans[(0, 'b')].end - spans[(0, 'b')].start, 0.1)
+                self.assertLessEqual(spans[()].start, spans[(0, 'b')].start)
+                self.assertGreaterEqual(spans[()].end, spans[(1,)].end)
+
+    def test_leaf_details(self):
+        pattern = Pipeline([
+            SimpleCommand(['cat'], pass_stdin=True, capture_stdout=True),
+            SimpleCommand(['head', '-c', '3'], pass_stdin=True, capture_stdout=True),
+        ])
+        result, tracer = self.run_traced(pattern, input=b'abcdef')
+        self.assertEqual(result.output, b'abc')
+        details, = [span.details for span in tracer.spans]
+        self.assertEqual(details['commands'], [['cat'], ['head', '-c', '3']])
+        self.assertEqual(details['exit_codes'], [0, 0])
+        self.assertEqual(details['bytes_in'], 6)
+        self.assertEqual(details['bytes_out'], 3)
+        self.assertGreater(details['max_rss'], 0)
+        self.assertGreaterEqual(details['user_time'], 0)
+
+    def test_buffered_output_samples(self):
+        pattern = SimpleCommand(['seq', '100000'], capture_stdout=True)
+        for engine in petriish.engines:
+            with self.subTest(engine=engine):
+                result, tracer = self.run_traced(pattern, engine=engine)
+                span, = tracer.spans
+                self.assertEqual(span.samples[-1][::2], ('buffered output', 0))
+                self.assertEqual(max(value for _, _, value in span.samples), len(result.output))
+                counters = [event for event in tracer.chrome_trace()['traceEvents'] if event['ph'] == 'C']
+                self.assertEqual(len(counters), len(span.samples))
+
+    def test_chrome_trace(self):
+        pattern = petriish.Parallelization({
+            'a': SimpleCommand(['true']),
+            'b': SimpleCommand(['true']),
+        })
+        _, tracer = self.run_traced(pattern)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'trace.json')
+            tracer.export(path)
+            with open(path) as f:
+                trace = json.load(f)
+        spans = [event for event in trace['traceEvents'] if event['ph'] == 'X']
+        lanes = [event for event in trace['traceEvents'] if event['ph'] == 'M']
+        self.assertEqual(
+            sorted(event['name'] for event in spans),
+            ['Parallelization /', 'SimpleCommand /a', 'SimpleCommand /b'],
+        )
+        # one branch runs inline, the other in its own thread
+        self.assertEqual(len(lanes), 2)
+        for event in spans:
+            self.assertGreaterEqual(event['dur'], 0)
+            self.assertEqual(event['pid'], os.getpid())
@@ -1,4 +1,7 @@
 from unittest import TestCase
+
+import petriish
+from petriish.patterns.posix import SimpleCommand
 from petriish.types import Resolver, TypeResolutionError, PolymorphicType, Record, Bytes
 
 
@@ -82,3 +85,78 @@ class TypesTestCase(TestCase):
         with self.assertRaises(TypeResolutionError):
             self.resolver.unify(x, Bytes())
         self.assertEqual(self.resolver.get_best_bind(x), Record())
+
+    def test_unify_bytes_with_record(self):
+        with self.assertRaises(TypeResolutionError):
+            self.resolver.unify(Bytes(), Record())
+
+    def test_unify_all(self):
+        x = PolymorphicType()
+        self.assertEqual(self.resolver.unify_all([x, Record({'a': Bytes()})]), Record({'a': Bytes()}))
+        self.assertEqual(self.resolver.get_best_bind(x), Record({'a': Bytes()}))
+        self.assertTrue(Resolver.is_polymorphic(self.resolver.unify_all([])))
+
+    def test_long_chain(self):
+        variables = [PolymorphicType() for _ in range(10000)]
+        for a, b in zip(variables, variables[1:]):
+            self.resolver.unify(a, b)
+        self.resolver.unify(variables[-1], Bytes())
+        self.assertEqual(self.resolver.get_best_bind(variables[0]), Bytes())
+
+
+class InterningTestCase(TestCase):
+    def test_records(self):
+        x = PolymorphicType()
+        self.assertIs(Record({'a': Bytes(), 'b': x}), Record({'b': x, 'a': Bytes()}))
+        self.assertIsNot(Record({'a': Bytes()}), Record({'a': Record()}))
+        self.assertIs(Record(), Record({}))
+        self.assertIs(Bytes(), Bytes())
+
+    def test_polymorphic_set(self):
+        x = PolymorphicType()
+        y = PolymorphicType()
+        self.assertEqual(Record({'a': x, 'b': Record({'c': y, 'd': Bytes()})}).polymorphic_set, {x, y})
+        self.assertEqual(Record({'a': Bytes()}).polymorphic_set, set())
+
+
+class CheckTypesTestCase(TestCase):
+    def test_output_type(self):
+        pattern = petriish.Parallelization({
+            'a': SimpleCommand('true', capture_stdout=True),
+            'b': petriish.Sequence([
+                SimpleCommand('true', capture_stdout=True),
+                SimpleCommand('cat', pass_stdin=True),
+            ]),
+            'c': petriish.Alternative([
+                SimpleCommand('true', capture_stdout=True),
+                petriish.Repetition(SimpleCommand('true'), SimpleCommand('false', capture_stdout=True)),
+            ]),
+        })
+        self.assertEqual(petriish.check_types(pattern), Record({'a': Bytes(), 'b': Record(), 'c': Bytes()}))
+
+    def test_mismatch(self):
+        with self.assertRaises(TypeResolutionError):
+            petriish.check_types(petriish.Sequence([
+                SimpleCommand('true', capture_stdout=True),
+                SimpleCommand('true'),
+            ]))
+
+    def test_map(self):
+        upper = SimpleCommand(['tr', 'a-z', 'A-Z'], pass_stdin=True, capture_stdout=True)
+        self.assertEqual(petriish.check_types(petriish.Map(upper), Bytes()), Bytes())
+        with self.assertRaises(TypeResolutionError):
+            petriish.check_types(petriish.Map(upper))  # input isn't bytes
+        with self.assertRaises(TypeResolutionError):
+            petriish.check_types(petriish.Map(SimpleCommand('true', pass_stdin=True)), Bytes())
+
+    def test_memoized(self):
+        class Counting(petriish.WorkflowPattern):
+            calls = 0
+
+            def output_type(self, resolver, input_type):
+                Counting.calls += 1
+                return input_type
+
+        leaf = Counting()
+        petriish.check_types(petriish.Parallelization({i: leaf for i in range(100)}))
+        self.assertEqual(Counting.calls, 1)
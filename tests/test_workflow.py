@@ -1,8 +1,12 @@
+import os
+import tempfile
 import threading
+import time
 from unittest import TestCase
 
 import petriish
-from petriish.patterns.posix import SimpleCommand
+from petriish.analysis import History
+from petriish.patterns.posix import Pipeline, SimpleCommand
 
 
 class DummyCommand(petriish.WorkflowPattern):
@@ -146,3 +150,275 @@ class CommandTestCase(TestCase, WorkflowPatternAssertsMixin):
         self.assertNotFinished(state)
         state.start()
         self.assertSucceeded(state, None)
+
+
+class ThreadRecorder(petriish.WorkflowPattern):
+    def __init__(self):
+        self.threads = []
+
+    def execute(self, input):
+        self.threads.append(threading.current_thread())
+        return petriish.Result(True, input)
+
+
+class DirectDispatchTestCase(TestCase):
+    def test_sequence_runs_on_caller_thread(self):
+        leaf = ThreadRecorder()
+        result = petriish.run_workflow_pattern(petriish.Sequence([leaf] * 3), 'in')
+        self.assertTrue(result.success)
+        self.assertEqual(result.output, 'in')
+        self.assertEqual(leaf.threads, [threading.current_thread()] * 3)
+
+    def test_thread_only_for_parallel_branches(self):
+        leaf = ThreadRecorder()
+        result = petriish.run_workflow_pattern(petriish.Parallelization({
+            'a': leaf, 'b': leaf, 'c': leaf,
+        }), {})
+        self.assertTrue(result.success)
+        self.assertEqual(len(set(leaf.threads)), 3)
+        self.assertIn(threading.current_thread(), leaf.threads)
+
+
+class AsyncioEngineTestCase(TestCase):
+    def run_pattern(self, pattern, input):
+        return petriish.run_workflow_pattern(pattern, input, engine='asyncio')
+
+    def test_command(self):
+        self.assertTrue(self.run_pattern(SimpleCommand('true'), None).success)
+        self.assertFalse(self.run_pattern(SimpleCommand('false'), None).success)
+
+    def test_sequence_passes_output(self):
+        result = self.run_pattern(petriish.Sequence([
+            SimpleCommand(['echo', 'aaa'], capture_stdout=True),
+            SimpleCommand(['tr', 'a', 'b'], pass_stdin=True, capture_stdout=True),
+        ]), {})
+        self.assertTrue(result.success)
+        self.assertEqual(result.output, b'bbb\n')
+
+    def test_parallelization(self):
+        result = self.run_pattern(petriish.Parallelization({
+            'a': SimpleCommand(['echo', 'a'], capture_stdout=True),
+            'b': SimpleCommand(['echo', 'b'], capture_stdout=True),
+        }), {})
+        self.assertTrue(result.success)
+        self.assertEqual(result.output, {'a': b'a\n', 'b': b'b\n'})
+
+    def test_alternative(self):
+        result = self.run_pattern(petriish.Alternative([
+            SimpleCommand('false'),
+            SimpleCommand(['echo', 'ok'], capture_stdout=True),
+        ]), {})
+        self.assertTrue(result.success)
+        self.assertEqual(result.output, b'ok\n')
+        self.assertFalse(self.run_pattern(petriish.Alternative([
+            SimpleCommand('true'),
+            SimpleCommand('true'),
+        ]), {}).success)
+
+    def test_repetition(self):
+        child = DummyCommand()
+        exit = DummyCommand()
+        pattern = petriish.Repetition(child=child, exit=exit)
+        runner = threading.Thread(target=lambda: setattr(self, 'result', self.run_pattern(pattern, 'in')))
+        runner.start()
+        self.assertEqual(exit.trigger(petriish.Result(False)), 'in')
+        self.assertEqual(child.trigger(petriish.Result(True, 'child out')), 'in')
+        self.assertEqual(exit.trigger(petriish.Result(True, 'exit out')), 'child out')
+        self.assertEqual(child.trigger(petriish.Result(False)), 'child out')
+        runner.join(timeout=1)
+        self.assertTrue(self.result.success)
+        self.assertEqual(self.result.output, 'exit out')
+
+    def test_from_other_threads(self):
+        results = {}
+        command = SimpleCommand(['sh', '-c', 'sleep 0.1; echo ok'], capture_stdout=True)
+
+        def run(engine):
+            results[engine] = petriish.run_workflow_pattern(command, {}, engine=engine)
+
+        # at once, so they share the child watcher
+        threads = [threading.Thread(target=run, args=(engine,)) for engine in ['asyncio', 'plan']]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for engine in ['asyncio', 'plan']:
+            self.assertTrue(results[engine].success)
+            self.assertEqual(results[engine].output, b'ok\n')
+
+
+class Chunks(petriish.WorkflowPattern):
+    """Records chunks it gets, outputs them upper-cased"""
+
+    def __init__(self, fail_on=None):
+        self.lock = threading.Lock()
+        self.chunks = []
+        self.paths = []
+        self.fail_on = fail_on
+
+    def execute(self, input):
+        with self.lock:
+            self.chunks.append(input)
+            self.paths.append(petriish.current_path())
+        if bytes(input) == self.fail_on:
+            return petriish.Result(False)
+        return petriish.Result(True, bytes(input).upper())
+
+    async def execute_async(self, input):
+        return self.execute(input)
+
+
+class MapTestCase(TestCase):
+    def test_lines(self):
+        for engine in petriish.engines:
+            child = Chunks()
+            result = petriish.run_workflow_pattern(petriish.Map(child, lines=2, jobs=3), b'a\nb\nc\nd\ne', engine=engine)
+            self.assertTrue(result.success)
+            self.assertEqual(result.output, b'A\nB\nC\nD\nE')
+            self.assertEqual(sorted(bytes(c) for c in child.chunks), [b'a\nb\n', b'c\nd\n', b'e'])
+            self.assertEqual(sorted(child.paths), [(0,), (1,), (2,)])
+
+    def test_chunks_are_views(self):
+        child = Chunks()
+        petriish.run_workflow_pattern(petriish.Map(child, size=3), b'abcdefgh')
+        self.assertEqual(sorted(bytes(c) for c in child.chunks), [b'abc', b'def', b'gh'])
+        self.assertTrue(all(isinstance(c, memoryview) for c in child.chunks))
+
+    def test_empty_input(self):
+        result = petriish.run_workflow_pattern(petriish.Map(Chunks()), b'')
+        self.assertTrue(result.success)
+        self.assertEqual(result.output, b'')
+
+    def test_failed_chunk(self):
+        for engine in petriish.engines:
+            pattern = petriish.Map(Chunks(fail_on=b'b\n'), jobs=1)
+            self.assertFalse(petriish.run_workflow_pattern(pattern, b'a\nb\nc\n', engine=engine).success)
+            # chunks after the failed one aren't even started
+            self.assertEqual([bytes(c) for c in pattern.child.chunks], [b'a\n', b'b\n'])
+
+    def test_commands(self):
+        pattern = petriish.Map(SimpleCommand(['tr', 'a-z', 'A-Z'], pass_stdin=True, capture_stdout=True), jobs=2)
+        for engine in petriish.engines:
+            result = petriish.run_workflow_pattern(pattern, b'one\ntwo\nthree\n', engine=engine)
+            self.assertEqual(result.output, b'ONE\nTWO\nTHREE\n')
+
+    def test_workers_on_demand(self):
+        threads = []
+
+        class Threads(petriish.WorkflowPattern):
+            def execute(self, input):
+                threads.append(threading.active_count())
+                return petriish.Result(True, b'')
+
+        before = threading.active_count()
+        petriish.run_workflow_pattern(petriish.Map(Threads(), jobs=8), b'one chunk')
+        self.assertEqual(threads, [before])
+        petriish.run_workflow_pattern(petriish.Map(Threads(), jobs=8), b'a\nb\nc\n')
+        self.assertLessEqual(max(threads), before + 2)
+
+    def test_lines_or_size(self):
+        with self.assertRaises(ValueError):
+            petriish.Map(Chunks(), lines=2, size=10)
+        with self.assertRaises(ValueError):
+            petriish.Map(Chunks(), size=0)
+
+
+class TimeoutTestCase(TestCase):
+    def test_timeout(self):
+        for engine in petriish.engines:
+            start = time.monotonic()
+            result = petriish.run_workflow_pattern(petriish.Parallelization({
+                'slow': SimpleCommand(['sleep', '10'], timeout=0.2),
+                'fast': SimpleCommand(['true'], timeout=5),
+            }), {}, engine=engine)
+            self.assertFalse(result.success)
+            self.assertLess(time.monotonic() - start, 5)
+
+    def test_timeout_in_pipeline(self):
+        result = petriish.run_workflow_pattern(Pipeline([
+            SimpleCommand(['yes'], capture_stdout=True, timeout=0.2),
+            SimpleCommand(['cat'], pass_stdin=True, capture_stdout=True, max_output_bytes=2 ** 30),
+        ]), {})
+        self.assertFalse(result.success)
+
+
+class HedgingTestCase(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def straggler(self, name, **kwargs):
+        """Command hanging the first time it runs, fast every other time"""
+        return SimpleCommand(['sh', '-c', 'if mkdir "$0" 2>/dev/null; then sleep 10; fi; echo done', os.path.join(self.directory, name)], capture_stdout=True, **kwargs)
+
+    def test_duplicate_wins(self):
+        for engine in petriish.engines:
+            start = time.monotonic()
+            result = petriish.run_workflow_pattern(self.straggler(engine, hedge=0.1), {}, engine=engine)
+            self.assertTrue(result.success)
+            self.assertEqual(result.output, b'done\n')
+            self.assertLess(time.monotonic() - start, 5)
+
+    def test_learned_threshold(self):
+        command = self.straggler('learned', hedge={'percentile': 90})
+        self.assertIsNone(command._hedge_after())
+        history = History()
+        with petriish.analysis.learning(history):
+            for _ in range(5):
+                history.record([command], 0.1)
+            self.assertEqual(command._hedge_after(), 0.1)
+            start = time.monotonic()
+            result = petriish.run_workflow_pattern(command, {})
+        self.assertTrue(result.success)
+        self.assertLess(time.monotonic() - start, 5)
+        # the winning run got recorded
+        self.assertLess(history.percentile([command], 0), 0.1)
+
+    def test_first_finished_wins(self):
+        command = SimpleCommand(['sh', '-c', 'sleep 0.3; exit 3'], hedge=0.1)
+        self.assertFalse(petriish.run_workflow_pattern(command, {}).success)
+
+    def test_not_spawned(self):
+        command = SimpleCommand([os.path.join(self.directory, 'nonexistent')], hedge=0.5)
+        for engine in petriish.engines:
+            with self.subTest(engine=engine):
+                with self.assertRaises(FileNotFoundError):
+                    petriish.run_workflow_pattern(command, {}, engine=engine)
+
+
+class InputRecorder(petriish.WorkflowPattern):
+    def execute(self, input):
+        self.input = input
+        return petriish.Result(True)
+
+    async def execute_async(self, input):
+        return self.execute(input)
+
+
+class FanOutTestCase(TestCase):
+    def test_big_input_to_many_readers(self):
+        data = b'x' * petriish.FAN_OUT_THRESHOLD
+        count = SimpleCommand(['wc', '-c'], pass_stdin=True, capture_stdout=True)
+        for engine in petriish.engines:
+            recorder = InputRecorder()
+            result = petriish.run_workflow_pattern(petriish.Parallelization({
+                'a': count,
+                'b': petriish.Sequence([count]),
+                'recorder': recorder,
+            }), data, engine=engine)
+            self.assertEqual(result.output['a'].strip(), str(len(data)).encode())
+            self.assertEqual(result.output['b'].strip(), str(len(data)).encode())
+            self.assertIsInstance(recorder.input, petriish.storage.SpilledBytes)
+            self.assertEqual(recorder.input, data)
+
+    def test_kept_in_memory(self):
+        count = SimpleCommand(['wc', '-c'], pass_stdin=True, capture_stdout=True)
+        cases = [
+            (b'x' * (petriish.FAN_OUT_THRESHOLD - 1), count),  # small
+            (b'x' * petriish.FAN_OUT_THRESHOLD, SimpleCommand(['true'])),  # single reader
+        ]
+        for data, other in cases:
+            recorder = InputRecorder()
+            petriish.run_workflow_pattern(petriish.Alternative([other, recorder]), data)
+            self.assertIsInstance(recorder.input, bytes)